@@ -0,0 +1,14 @@
+"""
+Load the modules under test without running the package ``__init__``, which builds the
+whole Flask application and needs its database.
+"""
+import os
+import sys
+import types
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "web", "myproject")
+
+if "myproject" not in sys.modules:
+    package = types.ModuleType("myproject")
+    package.__path__ = [PACKAGE_DIR]
+    sys.modules["myproject"] = package
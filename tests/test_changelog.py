@@ -0,0 +1,75 @@
+"""
+Cursor semantics of the VM change log shared through a file by the leader.
+"""
+import pytest
+
+from myproject.changelog import ChangeLog
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "changes.log")
+
+
+@pytest.fixture
+def leader(path):
+    log = ChangeLog(path, capacity=4)
+    log.publish()
+    return log
+
+
+@pytest.fixture
+def worker(path):
+    # Same file, never published from: stands in for another uWSGI worker
+    return ChangeLog(path, capacity=4)
+
+
+def test_no_cursor_before_a_log_is_published(path):
+    log = ChangeLog(path)
+    assert log.cursor is None
+    assert log.since("anything-0") is None
+
+
+def test_changes_since_a_cursor(leader, worker):
+    cursor = worker.cursor
+    leader.record({"a": {"name": "a", "state": "running"}})
+    leader.record({"b": {"name": "b"}, "a": {"name": "a", "state": "shut off"}})
+
+    changes, next_cursor = worker.since(cursor)
+    assert changes == {"a": {"name": "a", "state": "shut off"}, "b": {"name": "b"}}
+    assert next_cursor == worker.cursor == leader.cursor
+
+    leader.record({"b": None})
+    assert worker.since(next_cursor) == ({"b": None}, worker.cursor)
+    assert worker.since(worker.cursor) == ({}, worker.cursor)
+
+
+def test_only_the_publishing_process_records(leader, worker):
+    cursor = worker.cursor
+    worker.record({"a": {"name": "a"}})
+    assert worker.since(cursor) == ({}, cursor)
+
+
+def test_cursors_too_old_or_from_elsewhere_are_refused(leader, worker):
+    cursor = worker.cursor
+    for index in range(10):
+        leader.record({f"vm-{index}": {"name": f"vm-{index}"}})
+    assert worker.since(cursor) is None
+
+    current = worker.cursor
+    epoch, _, seq = current.partition("-")
+    assert worker.since(f"{epoch}-{int(seq) + 1}") is None
+    assert worker.since(f"other-{seq}") is None
+    assert worker.since("garbage") is None
+
+    recent = f"{epoch}-{int(seq) - 2}"
+    assert set(worker.since(recent)[0]) == {"vm-8", "vm-9"}
+
+
+def test_new_leader_starts_a_new_epoch(path, leader, worker):
+    leader.record({"a": {"name": "a"}})
+    cursor = worker.cursor
+    successor = ChangeLog(path, capacity=4)
+    successor.publish()
+    assert worker.since(cursor) is None
+    assert worker.cursor != cursor
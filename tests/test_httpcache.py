@@ -0,0 +1,91 @@
+"""
+Conditional and compressed JSON responses served through ``cached_json_response``.
+"""
+import gzip
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+from myproject import httpcache  # noqa: E402
+from myproject.httpcache import COMPRESS_MIN_SIZE, RepresentationCache, cached_json_response  # noqa: E402
+
+
+@pytest.fixture
+def state(monkeypatch):
+    monkeypatch.setattr(httpcache, "representation_cache", RepresentationCache())
+    return {"generation": 1, "renders": 0, "size": 1}
+
+
+@pytest.fixture
+def client(state):
+    app = flask.Flask(__name__)
+
+    @app.route("/items")
+    def items():
+        def render():
+            state["renders"] += 1
+            return {"generation": state["generation"], "items": ["x" * 10] * state["size"]}
+
+        return cached_json_response("items", state["generation"], render)
+
+    return app.test_client()
+
+
+def test_body_is_rendered_once_per_generation(client, state):
+    first = client.get("/items")
+    second = client.get("/items")
+    assert first.status_code == second.status_code == 200
+    assert first.data == second.data
+    assert state["renders"] == 1
+
+    state["generation"] = 2
+    third = client.get("/items")
+    assert third.get_json()["generation"] == 2
+    assert state["renders"] == 2
+
+
+def test_matching_etag_gets_not_modified(client, state):
+    first = client.get("/items")
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    cached = client.get("/items", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert cached.headers["ETag"] == etag
+
+    state["generation"] = 2
+    changed = client.get("/items", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_etag_depends_on_content_not_generation():
+    # Workers render at generations of their own, so equal content must get equal ETags
+    cache = RepresentationCache()
+    etag = cache.get("a", 1, lambda: {"items": []}).etag
+    assert cache.get("a", 2, lambda: {"items": []}).etag == etag
+    assert RepresentationCache().get("a", 7, lambda: {"items": []}).etag == etag
+    assert cache.get("a", 3, lambda: {"items": [1]}).etag != etag
+
+
+def test_large_bodies_are_compressed_when_accepted(client, state):
+    state["size"] = COMPRESS_MIN_SIZE
+    plain = client.get("/items")
+    assert "Content-Encoding" not in plain.headers
+
+    compressed = client.get("/items", headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    assert gzip.decompress(compressed.data) == plain.data
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+
+    # A client holding the uncompressed variant is not sent the body again either
+    cached = client.get("/items", headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"]})
+    assert cached.status_code == 304
+
+
+def test_small_bodies_are_not_compressed(client):
+    response = client.get("/items", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
@@ -0,0 +1,85 @@
+"""
+The background job queue: per-VM ordering, parallelism across VMs and job outcomes.
+"""
+import threading
+import time
+
+import pytest
+
+from myproject.jobs import FAILED, SUCCEEDED, JobQueue
+
+
+class PartialError(Exception):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+@pytest.fixture
+def queue():
+    return JobQueue(workers=4, history=2)
+
+
+def wait(queue, *jobs, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not all(job.done for job in jobs):
+        assert time.monotonic() < deadline, "timed out waiting for jobs"
+        time.sleep(0.01)
+
+
+def test_jobs_for_one_vm_run_one_at_a_time_in_order(queue):
+    events = []
+
+    def step(index):
+        events.append(("start", index))
+        time.sleep(0.02)
+        events.append(("end", index))
+        return index
+
+    jobs = [queue.submit("vm", "step", lambda index=index: step(index)) for index in range(4)]
+    wait(queue, *jobs)
+    assert events == [(kind, index) for index in range(4) for kind in ("start", "end")]
+    assert [job.result for job in jobs] == [0, 1, 2, 3]
+
+
+def test_jobs_for_different_vms_run_in_parallel(queue):
+    barrier = threading.Barrier(2, timeout=5)
+    jobs = [queue.submit(vm, "meet", barrier.wait) for vm in ("a", "b")]
+    wait(queue, *jobs)
+    assert all(job.status == SUCCEEDED for job in jobs)
+
+
+def test_failed_job_keeps_error_and_partial_result(queue):
+    def fail():
+        raise PartialError("second step failed", {"done": ["first"]})
+
+    job = queue.submit("vm", "fail", fail)
+    following = queue.submit("vm", "after", lambda: "ran")
+    wait(queue, job, following)
+    assert job.status == FAILED
+    assert job.error == "second step failed"
+    assert job.result == {"done": ["first"]}
+    assert following.result == "ran"
+
+
+def test_listeners_and_on_finish_see_finished_jobs(queue):
+    seen, finished = [], []
+    queue.add_listener(lambda job: seen.append((job.id, job.status)))
+    job = queue.submit("vm", "noop", lambda: None, on_finish=finished.append)
+    wait(queue, job)
+    deadline = time.monotonic() + 5
+    while not seen:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert finished == [job]
+    assert seen == [(job.id, SUCCEEDED)]
+
+
+def test_only_recent_finished_jobs_are_kept(queue):
+    jobs = []
+    for index in range(4):
+        jobs.append(queue.submit("vm", "noop", lambda: None))
+        wait(queue, jobs[-1])
+    queue.submit("vm", "noop", lambda: None)
+    assert queue.get(jobs[0].id) is None
+    assert queue.get(jobs[-1].id) is jobs[-1]
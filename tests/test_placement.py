@@ -0,0 +1,152 @@
+"""
+NUMA placement against the host topology of libvirt's built-in test driver.
+"""
+import xml.etree.ElementTree as ET
+
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from myproject.placement import PlacementEngine, domain_pins  # noqa: E402
+from myproject.vmcache import get_inventory_cache  # noqa: E402
+
+TEST_URI = "test:///default"
+# KiB; small enough for the free memory the test driver reports per cell
+MEMORY = 512
+
+
+@pytest.fixture
+def conn():
+    conn = libvirt.open(TEST_URI)
+    defined = []
+    conn.defined = defined
+    yield conn
+    for name in defined:
+        domain = conn.lookupByName(name)
+        if domain.isActive():
+            domain.destroy()
+        domain.undefine()
+    conn.close()
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return PlacementEngine(TEST_URI, path=str(tmp_path / "placement.lock"))
+
+
+def define(conn, name, vcpus=2, cpus=None):
+    domain = ET.Element("domain", type="test")
+    ET.SubElement(domain, "name").text = name
+    ET.SubElement(domain, "memory", unit="KiB").text = str(MEMORY)
+    ET.SubElement(domain, "vcpu").text = str(vcpus)
+    ET.SubElement(ET.SubElement(domain, "os"), "type").text = "hvm"
+    if cpus:
+        cputune = ET.SubElement(domain, "cputune")
+        for vcpu, cpu in enumerate(cpus):
+            ET.SubElement(cputune, "vcpupin", vcpu=str(vcpu), cpuset=str(cpu))
+    defined = conn.defineXML(ET.tostring(domain, encoding="unicode"))
+    conn.defined.append(name)
+    return defined
+
+
+def settle():
+    # Events reach the inventory cache asynchronously; reload it rather than wait for them
+    get_inventory_cache(TEST_URI).refresh()
+
+
+def free_cpus(conn, engine, count):
+    settle()
+    cell = engine.topology(conn).cells[0]
+    owners = engine.allocation(conn)
+    return [cpu for cpu in cell.cpus if cpu not in owners][:count]
+
+
+def test_topology_has_cells_with_cpus(conn, engine):
+    cells = engine.topology(conn).cells
+    assert cells
+    assert all(cell.cpus for cell in cells)
+
+
+def test_place_pins_every_vcpu_within_one_cell(conn, engine):
+    placement = engine.place(conn, "placed", 2, MEMORY)
+    assert placement is not None
+    cell = next(cell for cell in engine.topology(conn).cells if cell.id == placement.cell)
+    assert len(set(placement.cpus)) == 2
+    assert set(placement.cpus) <= set(cell.cpus)
+
+    other = engine.place(conn, "other", 2, MEMORY)
+    assert other is not None
+    assert not set(other.cpus) & set(placement.cpus)
+
+
+def test_pins_of_inactive_domains_are_taken(conn, engine):
+    cpus = free_cpus(conn, engine, 2)
+    define(conn, "stopped", cpus=cpus)
+    settle()
+    owners = engine.allocation(conn)
+    assert [owners.get(cpu) for cpu in cpus] == ["stopped", "stopped"]
+
+    placement = engine.place(conn, "new", 2, MEMORY)
+    assert placement is not None
+    assert not set(placement.cpus) & set(cpus)
+
+
+def test_start_keeps_free_pins(conn, engine):
+    cpus = free_cpus(conn, engine, 2)
+    domain = define(conn, "pinned", cpus=cpus)
+    assert engine.place_defined(conn, domain) is None
+    domain.create()
+    assert set(cpus) <= domain_pins(domain.XMLDesc(0))
+
+
+def test_start_places_unpinned_domain(conn, engine):
+    domain = define(conn, "unpinned")
+    placement = engine.place_defined(conn, domain)
+    engine.release("unpinned")
+    assert placement is not None
+    assert domain_pins(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)) == set(placement.cpus)
+
+
+def test_start_moves_domain_off_cpus_taken_while_stopped(conn, engine):
+    cpus = free_cpus(conn, engine, 2)
+    first = define(conn, "first", cpus=cpus)
+    second = define(conn, "second", cpus=cpus)
+    first.create()
+    settle()
+
+    placement = engine.place_defined(conn, second)
+    engine.release("second")
+    assert placement is not None
+    assert not set(placement.cpus) & set(cpus)
+    second.create()
+    assert domain_pins(second.XMLDesc(0)) == set(placement.cpus)
+
+
+def test_reservations_are_shared_through_the_lock_file(conn, engine):
+    other = PlacementEngine(TEST_URI, path=engine.path)
+    placement = engine.place(conn, "reserved", 2, MEMORY)
+    assert placement is not None
+    assert all(other.allocation(conn).get(cpu) == "reserved" for cpu in placement.cpus)
+
+    concurrent = other.place(conn, "concurrent", 2, MEMORY)
+    assert concurrent is not None
+    assert not set(concurrent.cpus) & set(placement.cpus)
+
+
+def test_placement_reads_each_domain_xml_once(conn, engine):
+    settle()
+    engine.place(conn, "warm", 1, MEMORY)
+    calls = []
+    original = libvirt.virDomain.XMLDesc
+
+    def counting(domain, flags=0):
+        calls.append(domain.name())
+        return original(domain, flags)
+
+    libvirt.virDomain.XMLDesc = counting
+    try:
+        for index in range(3):
+            engine.place(conn, f"batch-{index}", 1, MEMORY)
+    finally:
+        libvirt.virDomain.XMLDesc = original
+    assert calls == []
@@ -0,0 +1,141 @@
+"""
+The inventory cache against libvirt's built-in test driver: event-driven updates, the
+``max_age`` bound and forced reloads.
+"""
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from myproject import vmcache  # noqa: E402
+from myproject.vmcache import InventoryCache  # noqa: E402
+
+TEST_URI = "test:///default"
+
+
+@pytest.fixture
+def conn():
+    conn = libvirt.open(TEST_URI)
+    defined = []
+    conn.defined = defined
+    yield conn
+    for name in defined:
+        try:
+            domain = conn.lookupByName(name)
+        except libvirt.libvirtError:
+            continue
+        if domain.isActive():
+            domain.destroy()
+        domain.undefine()
+    conn.close()
+
+
+@pytest.fixture
+def cache():
+    cache = InventoryCache(TEST_URI, max_age=60)
+    cache.list_vms()
+    assert cache.connected
+    yield cache
+    cache.stop()
+
+
+def define(conn, name):
+    domain = ET.Element("domain", type="test")
+    ET.SubElement(domain, "name").text = name
+    ET.SubElement(domain, "memory", unit="KiB").text = "512"
+    ET.SubElement(domain, "vcpu").text = "1"
+    ET.SubElement(ET.SubElement(domain, "os"), "type").text = "hvm"
+    defined = conn.defineXML(ET.tostring(domain, encoding="unicode"))
+    conn.defined.append(name)
+    return defined
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for a domain event"
+        time.sleep(0.01)
+
+
+def listed(cache):
+    return {vm["name"]: vm for vm in cache.list_vms()}
+
+
+class Loader:
+    """
+    A view loader that counts how often it ran.
+    """
+
+    def __init__(self):
+        self.loads = 0
+
+    def __call__(self, conn, name):
+        self.loads += 1
+        return self.loads
+
+
+def test_listing_follows_events(conn, cache):
+    domain = define(conn, "evented")
+    wait_for(lambda: "evented" in listed(cache))
+
+    domain.create()
+    wait_for(lambda: listed(cache)["evented"]["id"] != -1)
+
+    domain.destroy()
+    domain.undefine()
+    wait_for(lambda: "evented" not in listed(cache))
+
+
+def test_listeners_get_changed_and_removed_vms(conn, cache):
+    changes = []
+    cache.add_listener(changes.append)
+    domain = define(conn, "watched")
+    wait_for(lambda: any(change.get("watched") for change in changes))
+
+    domain.undefine()
+    wait_for(lambda: any("watched" in change and change["watched"] is None for change in changes))
+
+
+def test_event_drops_domain_views(conn, cache):
+    domain = define(conn, "viewed")
+    wait_for(lambda: "viewed" in listed(cache))
+    loader = Loader()
+    assert cache.domain_view("count", "viewed", loader) == 1
+    assert cache.domain_view("count", "viewed", loader) == 1
+
+    domain.create()
+    wait_for(lambda: cache.domain_view("count", "viewed", loader) == 2)
+    assert cache.domain_view("count", "viewed", loader) == 2
+
+
+def test_views_expire_after_max_age(conn, cache):
+    define(conn, "aging")
+    wait_for(lambda: "aging" in listed(cache))
+    cache.max_age = 0.1
+    loader = Loader()
+    assert cache.domain_view("count", "aging", loader) == 1
+    time.sleep(0.2)
+    assert cache.domain_view("count", "aging", loader) == 2
+
+
+def test_refresh_reloads_and_keeps_the_result(conn, cache):
+    define(conn, "refreshed")
+    wait_for(lambda: "refreshed" in listed(cache))
+    loader = Loader()
+    first, _ = cache.versioned_domain_view("count", "refreshed", loader)
+    second, value = cache.versioned_domain_view("count", "refreshed", loader, refresh=True)
+    assert (value, loader.loads) == (2, 2)
+    assert second != first
+    assert cache.versioned_domain_view("count", "refreshed", loader) == (second, 2)
+
+
+def test_refresh_reloads_listing(cache, monkeypatch):
+    calls = []
+    collect_vms = vmcache.collect_vms
+    monkeypatch.setattr(vmcache, "collect_vms", lambda conn: calls.append(1) or collect_vms(conn))
+    cache.list_vms()
+    assert calls == []
+    cache.list_vms(refresh=True)
+    assert calls == [1]
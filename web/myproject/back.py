@@ -10,6 +10,14 @@ from flask_cors import CORS
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 
+from domxml import parse_domain_xml
+from inventory import collect_vms, vm_summary
+import tracing
+from pool import get_pool, is_connection_error, set_instrumentation
+
+# Time every libvirt call made over pooled connections; see tracing.py.
+set_instrumentation(tracing)
+
 sessions = {}
 vms = []
 state = None
@@ -32,18 +40,7 @@ def extract_os_from_metadata(xml_desc):
 	- ET.ParseError: If there is an error parsing the XML.
 	"""
 	try:
-		# Parse the XML
-		root = ET.fromstring(xml_desc)
-		
-		# Find the OS ID in the metadata
-		namespace = {"libosinfo": "http://libosinfo.org/xmlns/libvirt/domain/1.0"}
-		os_info = root.find(".//libosinfo:os", namespace)
-		
-		if os_info is not None:
-			os_id = os_info.get("id", "Unknown OS")
-			return os_id
-		else:
-			return "Unknown OS"
+		return parse_domain_xml(xml_desc).os_id
 	except ET.ParseError as e:
 		print(f"XML Parse Error: {e}")
 		return "Unknown OS"
@@ -86,18 +83,33 @@ def extract_os_from_metadata(xml_desc):
 
 def get_libvirt_connection():
 	"""
-	Tries to establish a connection to the libvirt daemon running on the system.
+	Borrows a connection to the libvirt daemon running on the system from the connection pool.
+
+	The connection must be handed back with `release_libvirt_connection` instead of being closed.
 
 	Returns:
 	- libvirt.virConnect: A connection object representing the libvirt connection if successful, None otherwise.
 	"""
+	pool = get_pool()
 	try:
-		return libvirt.open("qemu:///system")
-	except libvirt.libvirtError as e:
-		print(f"Failed to open connection to qemu:///system: {e}")
+		return pool.acquire()
+	except (libvirt.libvirtError, TimeoutError) as e:
+		print(f"Failed to get connection to {pool.uri}: {e}")
 		return None
 
 
+def release_libvirt_connection(conn, discard=False):
+	"""
+	Returns a connection obtained from `get_libvirt_connection` to the connection pool.
+
+	Parameters:
+	- conn (libvirt.virConnect): The borrowed connection. None is ignored.
+	- discard (bool): Close the connection instead of reusing it, e.g. after a libvirt error
+	  for which `is_connection_error` holds.
+	"""
+	get_pool().release(conn, discard=discard)
+
+
 def login():
 	"""
 	Handles the login process for the API.
@@ -212,67 +224,19 @@ def list_vms():
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
-		domains = conn.listAllDomains()
-		dom = conn.listAllDomains(2)
-		dom.append(domains)
-		if not domains:
+		# One bulk stats round trip for the whole host instead of several RPCs per domain
+		vms = collect_vms(conn)
+		if not vms:
 			return json.dumps({"message": "No VMs found"}), 404
 		
-		vms = []
-		for domain in domains:
-			# xml_desc = domain.XMLDesc()
-			# root = ET.fromstring(xml_desc)
-			
-			# # Extract VM OS from the metadata
-			# vm_os = extract_os_from_metadata(xml_desc)
-			# disks = root.findall("devices/disk")
-			disk_info = []
-			cdrom_info = []
-			
-			# for disk in disks:
-			#     disk_target = disk.find("target").get("dev")
-			#     source = disk.find("source")
-			#     if source is not None:
-			#         disk_location = source.get("file")
-			#     else:
-			#         disk_location = None
-			
-			#     # Determine if it's a disk or a CD-ROM
-			#     if disk.get("device") == "cdrom":
-			#         cdrom_info.append(
-			#             {
-			#                 "target": disk_target,
-			#                 "location": disk_location,
-			#             }
-			#         )
-			#     else:
-			#         disk_info.append({"location": disk_location, "target": disk_target})
-			
-			# sizes = domain.blockInfo(disk_target)
-			vm_info = {
-					"name"      : domain.name(),
-					"id"        : domain.ID(),
-					"state"     : domain.state()[0],
-					"uuid"      : domain.UUIDString(),
-					# "vm_os": vm_os,
-					"max_memory": domain.maxMemory(),
-					"memory"    : domain.info()[2],  # Memory in use
-					"vcpus"     : domain.info()[3],  # Number of virtual CPUs
-					"autostart" : domain.autostart(),
-					# "disk_capacity": sizes[0],
-					# "disks": disk_info,
-					# "cdroms": cdrom_info,
-			}
-			vms.append(vm_info)
-		
-		# Return the collected VMs outside the loop
 		return json.dumps({"vms": vms})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		if conn:
-			conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def details_vm(name):
@@ -290,57 +254,20 @@ def details_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
-		xml_desc = domain.XMLDesc()
-		root = ET.fromstring(xml_desc)
-		os_type = domain.OSType()
-		# Extract VM OS from the metadata
-		vm_os = extract_os_from_metadata(xml_desc)
-		# Parse disk information
-		disks = root.findall("devices/disk")
-		disk_info = []
-		cdrom_info = []
-		print(os_type)
-		for disk in disks:
-			disk_target = disk.find("target").get("dev")
-			source = disk.find("source")
-			if source is not None:
-				disk_location = source.get("file")
-			else:
-				disk_location = None
-			
-			# Determine if it's a disk or a CD-ROM
-			if disk.get("device") == "cdrom":
-				cdrom_info.append(
-						{
-								"target"  : disk_target,
-								"location": disk_location,
-						}
-				)
-			else:
-				disk_info.append({"location": disk_location, "target": disk_target})
-		
-		vm_details = {
-				"name"      : domain.name(),
-				"id"        : domain.ID(),
-				"state"     : domain.state()[0],
-				"uuid"      : domain.UUIDString(),
-				"vm_os"     : vm_os,
-				"max_memory": domain.maxMemory(),
-				"memory"    : domain.info()[2],  # Memory in use
-				"vcpus"     : domain.info()[3],  # Number of virtual CPUs
-				"autostart" : domain.autostart(),
-				"disks"     : disk_info,
-				"cdroms"    : cdrom_info,
-		}
+		# Single streaming pass over the XML for the OS id, disks, CD-ROMs and NICs
+		description = parse_domain_xml(domain.XMLDesc())
+		vm_details = vm_summary(domain)
+		vm_details.update(description.as_dict())
 		
 		return json.dumps(vm_details), 200
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": f"VM not found: {str(e)}"}), 404
 	finally:
-		if conn is not None:
-			conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def delete_vm(name):
@@ -365,15 +292,17 @@ def delete_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		domain.destroy()
 		domain.undefine()
 		return json.dumps({"message": f"VM {name} deleted successfully"}), 200
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def create_vm():
@@ -402,6 +331,7 @@ def create_vm():
 	cpus = vm_data.get("cpus")
 	memory = vm_data.get("memory")  # Expecting memory in KiB
 	
+	discard = False
 	try:
 		# Define a new domain (example XML)
 		vm_xml = f"""
@@ -428,9 +358,10 @@ def create_vm():
 		conn.createXML(vm_xml, 0)
 		return json.dumps({"message": f"VM {name} created successfully"}), 201
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def list_snapshots(name):
@@ -461,6 +392,7 @@ def list_snapshots(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		snapshot = domain.snapshotListNames()
@@ -469,9 +401,10 @@ def list_snapshots(name):
 			snapshots.append(shots)
 		return json.dumps({"snapshots": snapshots})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def create_snapshot(name):
@@ -491,6 +424,7 @@ def create_snapshot(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		xml = f"""
@@ -502,9 +436,10 @@ def create_snapshot(name):
 		domain.snapshotCreateXML(xml, 0)
 		return json.dumps({"message": "Snapshot created successfully"}), 201
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def restore_snapshot(name, snapshot_name):
@@ -512,15 +447,17 @@ def restore_snapshot(name, snapshot_name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		snapshot = domain.snapshotLookupByName(snapshot_name)
 		domain.revertToSnapshot(snapshot, 0)
 		return json.dumps({"message": "Snapshot restored successfully"})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def delete_snapshot(name, snapshot_name):
@@ -528,15 +465,17 @@ def delete_snapshot(name, snapshot_name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		snapshot = domain.snapshotLookupByName(snapshot_name)
 		snapshot.delete(0)
 		return json.dumps({"message": "Snapshot deleted successfully"})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def schedule_snapshot():
@@ -593,6 +532,7 @@ def start_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		domain.create()  # Start the VM
@@ -600,9 +540,10 @@ def start_vm(name):
 		# socketio.emit('vm_status_updated', {"id": domain.ID(), "status": "start"})
 		return json.dumps({"message": "Domain started"})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def resume_vm(name):
@@ -621,15 +562,17 @@ def resume_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		domain.resume()  # Resume the VM
 		# socketio.emit('handle_vm', {"message": "Domain resumed"})
 		return json.dumps({"message": "Domain resumed"})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def reboot_vm(name):
@@ -648,15 +591,17 @@ def reboot_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		domain.reboot()  # Reboot the VM
 		# socketio.emit('handle_vm', {"message": "Domain rebooted"})
 		return json.dumps({"message": "Domain rebooted"})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def shutdown_vm(name):
@@ -676,15 +621,17 @@ def shutdown_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		domain.shutdown()  # Shutdown the VM
 		return json.dumps({"message": "Domain shut down"})
 	
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
 
 
 def power_vm(name):
@@ -704,6 +651,7 @@ def power_vm(name):
 	if not conn:
 		return json.dumps({"error": "Could not connect to libvirt"}), 500
 	
+	discard = False
 	try:
 		domain = conn.lookupByName(name)
 		# socketio.emit('vm_status_updated', {"id": domain.ID(), "status": "poweroff"})
@@ -711,6 +659,7 @@ def power_vm(name):
 		
 		return json.dumps({"message": "Domain powered down"})
 	except libvirt.libvirtError as e:
+		discard = is_connection_error(e)
 		return json.dumps({"error": str(e)}), 500
 	finally:
-		conn.close()
+		release_libvirt_connection(conn, discard)
@@ -0,0 +1,133 @@
+import os
+import queue
+import xml.etree.ElementTree as ET
+from collections import deque
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+import libvirt
+
+from .jobs import JOB_WORKERS, SUCCEEDED, Job, job_queue
+from .pool import get_pool
+
+# Actions run at once in a batch when the request does not ask for a number.
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", "8"))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "32"))
+
+# Labels are stored in the domain XML as
+# <metadata><qw:labels xmlns:qw="..."><label key="tenant">acme</label></qw:labels></metadata>
+LABELS_NS = "https://github.com/uberkie/qemu_web/labels"
+
+
+def parse_selector(selector: str) -> Dict[str, str]:
+    """
+    Parse a label selector such as ``"tenant=acme,role=web"``.
+
+    :param selector: Comma-separated ``key=value`` pairs.
+    :return: A mapping of label key to required value.
+    :raises ValueError: If a pair has no ``=``.
+    """
+    required = {}
+    for pair in filter(None, (item.strip() for item in selector.split(","))):
+        key, sep, value = pair.partition("=")
+        if not sep or not key.strip():
+            raise ValueError(f"Invalid label selector term: {pair!r}")
+        required[key.strip()] = value.strip()
+    return required
+
+
+def domain_labels(domain: libvirt.virDomain) -> Dict[str, str]:
+    """
+    Read the labels stored in a domain's metadata.
+
+    :return: A mapping of label key to value, empty if the domain has no labels.
+    """
+    try:
+        xml = domain.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, LABELS_NS, 0)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            return {}
+        raise
+    return {label.get("key"): label.text or "" for label in ET.fromstring(xml).iter("label") if label.get("key")}
+
+
+def select_domains(conn: libvirt.virConnect, selector: str) -> List[str]:
+    """
+    Find the domains whose labels match a selector.
+
+    :param conn: The libvirt connection.
+    :param selector: A label selector, see ``parse_selector``.
+    :return: The names of the matching domains.
+    """
+    required = parse_selector(selector)
+    names = []
+    for domain in conn.listAllDomains(0):
+        labels = domain_labels(domain)
+        if all(labels.get(key) == value for key, value in required.items()):
+            names.append(domain.name())
+    return names
+
+
+def batch_parallelism(requested: Any) -> int:
+    """
+    Clamp the parallelism asked for by a batch request to ``1..BATCH_MAX_PARALLELISM``.
+    """
+    if requested is None:
+        requested = BATCH_PARALLELISM
+    return max(1, min(int(requested), BATCH_MAX_PARALLELISM))
+
+
+def run_batch(
+    names: Iterable[str],
+    action: str,
+    func: Callable[..., Any],
+    *args: Any,
+    parallelism: int = BATCH_PARALLELISM,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Run ``func(conn, name, *args)`` for many VMs as background jobs.
+
+    Every VM gets its own job on ``job_queue``, so a batch item waits for, and never overlaps,
+    other jobs on the same VM such as a snapshot or a resize. Jobs borrow their connection
+    from the ``"jobs"`` pool like any other job. At most ``parallelism`` jobs of the batch are
+    queued at once, and results are yielded as each VM finishes, not in input order; a failure
+    on one VM is reported in its result and does not stop the others. VMs not yet submitted
+    when the caller stops iterating are skipped, while submitted jobs run to completion.
+
+    :param names: The VMs to act on.
+    :param action: The job action, also reported in each result.
+    :param func: The operation, called as ``func(conn, name, *args)``.
+    :param parallelism: The number of jobs of this batch queued at once.
+    :return: An iterator of ``{"vm", "action", "job_id", "status", "result" | "error", "elapsed"}``
+        dicts. Failed items also carry a ``"result"`` when the operation got part of the way.
+    """
+    finished: "queue.Queue[Job]" = queue.Queue()
+    pending = deque(dict.fromkeys(names))
+    running = 0
+
+    def run(name):
+        with get_pool(name="jobs", size=JOB_WORKERS).connection() as conn:
+            return func(conn, name, *args)
+
+    while pending or running:
+        while pending and running < parallelism:
+            name = pending.popleft()
+            job_queue.submit(name, action, partial(run, name), on_finish=finished.put)
+            running += 1
+        job = finished.get()
+        running -= 1
+        yield batch_result(job)
+
+
+def batch_result(job: Job) -> Dict[str, Any]:
+    """
+    Report a finished batch job the way ``run_batch`` yields it.
+    """
+    if job.status == SUCCEEDED:
+        outcome = {"status": "ok", "result": job.result}
+    else:
+        outcome = {"status": "error", "error": job.error}
+        if job.result is not None:
+            outcome["result"] = job.result
+    elapsed = round(job.finished_at - job.started_at, 3)
+    return {"vm": job.vm, "action": job.action, "job_id": job.id, **outcome, "elapsed": elapsed}
@@ -0,0 +1,137 @@
+"""
+Benchmark the GET /api/vms collection paths against a libvirt driver.
+
+Compares the old per-domain loop, the per-domain path with a single ``info()`` call and the
+bulk ``getAllDomainStats`` path, reporting libvirt API calls and latency for each.
+
+Usage:
+    python3 bench_list_vms.py [--uri test:///default] [--domains 300] [--rounds 5]
+"""
+import argparse
+import statistics
+import time
+from collections import Counter
+
+import libvirt
+
+from inventory import list_vms_bulk, list_vms_per_domain
+
+# Served from the local domain handle without a round trip to the daemon.
+LOCAL_CALLS = {"name", "ID", "UUIDString"}
+
+DOMAIN_XML = """
+<domain type='test'>
+  <name>{name}</name>
+  <memory>262144</memory>
+  <vcpu>2</vcpu>
+  <os>
+    <type arch='x86_64'>hvm</type>
+  </os>
+</domain>
+"""
+
+
+class CountingProxy:
+	"""
+	Wraps a libvirt object and counts every API method called through it.
+
+	Domains returned by the wrapped calls are wrapped too, so per-domain calls are counted.
+	"""
+
+	def __init__(self, target, counter):
+		self._target = target
+		self._counter = counter
+
+	def __getattr__(self, attr):
+		value = getattr(self._target, attr)
+		if not callable(value):
+			return value
+
+		def call(*args, **kwargs):
+			self._counter[attr] += 1
+			return self._wrap(value(*args, **kwargs))
+
+		return call
+
+	def _wrap(self, value):
+		if isinstance(value, libvirt.virDomain):
+			return CountingProxy(value, self._counter)
+		if isinstance(value, list):
+			return [self._wrap(item) for item in value]
+		if isinstance(value, tuple) and value and isinstance(value[0], libvirt.virDomain):
+			return (CountingProxy(value[0], self._counter),) + value[1:]
+		return value
+
+
+def legacy_list_vms(conn):
+	"""
+	The per-domain loop GET /api/vms used before bulk stats.
+	"""
+	vms = []
+	for domain in conn.listAllDomains():
+		vms.append({
+				"name"      : domain.name(),
+				"id"        : domain.ID(),
+				"state"     : domain.state()[0],
+				"uuid"      : domain.UUIDString(),
+				"max_memory": domain.maxMemory(),
+				"memory"    : domain.info()[2],
+				"vcpus"     : domain.info()[3],
+				"autostart" : domain.autostart(),
+		})
+	return vms
+
+
+def define_domains(conn, count):
+	existing = {domain.name() for domain in conn.listAllDomains()}
+	for i in range(count):
+		name = f"bench-{i}"
+		if name in existing:
+			continue
+		domain = conn.defineXML(DOMAIN_XML.format(name=name))
+		if i % 2 == 0:
+			domain.create()
+
+
+def run(conn, collect, rounds):
+	counter = Counter()
+	proxy = CountingProxy(conn, counter)
+	timings = []
+	vms = []
+	for _ in range(rounds):
+		started = time.perf_counter()
+		vms = collect(proxy)
+		timings.append(time.perf_counter() - started)
+	calls = sum(counter.values()) // rounds
+	remote = sum(n for attr, n in counter.items() if attr not in LOCAL_CALLS) // rounds
+	return len(vms), calls, remote, statistics.median(timings), max(timings)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--uri", default="test:///default")
+	parser.add_argument("--domains", type=int, default=300)
+	parser.add_argument("--rounds", type=int, default=5)
+	args = parser.parse_args()
+
+	conn = libvirt.open(args.uri)
+	define_domains(conn, args.domains)
+
+	print(f"{'path':<12} {'vms':>5} {'calls':>7} {'rpcs':>7} {'median ms':>10} {'max ms':>8}")
+	for label, collect in (
+			("legacy", legacy_list_vms),
+			("per-domain", list_vms_per_domain),
+			("bulk", list_vms_bulk),
+	):
+		try:
+			vms, calls, remote, median, worst = run(conn, collect, args.rounds)
+		except libvirt.libvirtError as e:
+			print(f"{label:<12} unsupported: {e}")
+			continue
+		print(f"{label:<12} {vms:>5} {calls:>7} {remote:>7} {median * 1000:>10.2f} {worst * 1000:>8.2f}")
+
+	conn.close()
+
+
+if __name__ == "__main__":
+	main()
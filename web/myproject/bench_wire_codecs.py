@@ -0,0 +1,64 @@
+"""
+Micro-benchmark the KVM agent payload encodings on a large VM listing.
+
+Reports the encoded size and the median encode and decode time of a ``list_vms`` response frame
+for every codec installed here (msgpack and cbor2 are optional).
+
+Usage:
+    python3 bench_wire_codecs.py [--vms 1000] [--rounds 50]
+"""
+import argparse
+import statistics
+import time
+import uuid
+
+from kvmproto import CODECS, decode_payload, encode_frame
+
+
+def vm_listing(count):
+	return [
+			{
+					"name"      : f"vm-{i:05d}",
+					"id"        : i + 1 if i % 3 else -1,
+					"state"     : 1 if i % 3 else 5,
+					"uuid"      : str(uuid.UUID(int=i)),
+					"max_memory": 4194304,
+					"memory"    : 2097152 + i,
+					"vcpus"     : 2 + i % 6,
+					"autostart" : bool(i % 2),
+			}
+			for i in range(count)
+	]
+
+
+def measure(func, rounds):
+	timings = []
+	for _ in range(rounds):
+		started = time.perf_counter()
+		func()
+		timings.append(time.perf_counter() - started)
+	return statistics.median(timings)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--vms", type=int, default=1000)
+	parser.add_argument("--rounds", type=int, default=50)
+	args = parser.parse_args()
+
+	message = {"id": 1, "response": {"vms": vm_listing(args.vms)}}
+	print(f"{'codec':<8} {'bytes':>9} {'encode ms':>10} {'decode ms':>10}")
+	for name, codec in CODECS.items():
+		frame = encode_frame(message, codec)
+		payload = frame[4:]
+		assert decode_payload(payload, codec) == message
+		encode = measure(lambda: encode_frame(message, codec), args.rounds)
+		decode = measure(lambda: decode_payload(payload, codec), args.rounds)
+		print(f"{name:<8} {len(frame):>9} {encode * 1000:>10.3f} {decode * 1000:>10.3f}")
+	missing = sorted({"msgpack", "cbor"} - set(CODECS))
+	if missing:
+		print(f"not installed: {', '.join(missing)}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,156 @@
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from .vmcache import get_inventory_cache
+
+logger = logging.getLogger(__name__)
+
+HOST_ID = os.getenv("QEMU_WEB_HOST_ID", socket.gethostname())
+# Changes to the same VM within this many seconds are merged into one message.
+BROADCAST_INTERVAL = float(os.getenv("BROADCAST_INTERVAL", "0.5"))
+# Seconds between comparisons of the full inventory with what was last sent.
+BROADCAST_RESYNC_INTERVAL = float(os.getenv("BROADCAST_RESYNC_INTERVAL", "5"))
+
+
+def host_room(host: str = HOST_ID) -> str:
+    return f"host:{host}"
+
+
+def vm_room(name: str) -> str:
+    return f"vm:{name}"
+
+
+class VMBroadcaster:
+    """
+    Pushes VM inventory changes to Socket.IO rooms.
+
+    Changes reported by the inventory cache are collected per VM and flushed every
+    ``interval`` seconds as deltas against the last state that was sent, so a burst of
+    events for one VM becomes a single message. Each flush emits ``vm_changes`` to the host
+    room with every delta, and to each VM room with the delta of that VM only.
+
+    Every ``resync_interval`` seconds the whole listing is compared with what was sent as
+    well. That read also reconnects the cache's event connection when it dropped and polls
+    libvirt while it is down, so pushes keep flowing without any HTTP reads.
+    """
+
+    def __init__(
+        self,
+        socketio: Any,
+        host: str = HOST_ID,
+        interval: float = BROADCAST_INTERVAL,
+        resync_interval: float = BROADCAST_RESYNC_INTERVAL,
+    ):
+        self.socketio = socketio
+        self.host = host
+        self.interval = interval
+        self.resync_interval = resync_interval
+
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._sent: Dict[str, Dict[str, Any]] = {}
+        self._started = False
+
+    def start(self) -> None:
+        """
+        Subscribe to the inventory cache and start the flush task. Calling it again is a no-op.
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        cache = get_inventory_cache()
+        cache.add_listener(self._on_changes)
+        try:
+            self._sent = {vm["name"]: vm for vm in cache.list_vms()}
+        except Exception as e:
+            logger.warning(f"Broadcaster started without an initial inventory: {e}")
+        self.socketio.start_background_task(self._run)
+
+    def _on_changes(self, changes: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        with self._lock:
+            self._pending.update(changes)
+
+    def _run(self) -> None:
+        resync_at = time.monotonic() + self.resync_interval
+        while True:
+            self.socketio.sleep(self.interval)
+            if time.monotonic() >= resync_at:
+                resync_at = time.monotonic() + self.resync_interval
+                try:
+                    self.resync()
+                except Exception as e:
+                    logger.warning(f"VM broadcast resync failed: {e}")
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"VM broadcast failed: {e}")
+
+    def resync(self) -> None:
+        """
+        Queue every difference between the current inventory and what was last sent,
+        including VMs that disappeared without an event.
+        """
+        vms = {vm["name"]: vm for vm in get_inventory_cache().list_vms()}
+        with self._lock:
+            for name in self._sent:
+                if name not in vms:
+                    self._pending.setdefault(name, None)
+            for name, vm in vms.items():
+                self._pending.setdefault(name, vm)
+
+    def _delta(self, name: str, vm: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        previous = self._sent.get(name)
+        if vm is None:
+            if previous is None:
+                return None
+            del self._sent[name]
+            return {"name": name, "uuid": previous.get("uuid"), "removed": True}
+
+        self._sent[name] = vm
+        if previous is None:
+            return {"name": name, "uuid": vm.get("uuid"), "added": True, "changes": vm}
+        changes = {key: value for key, value in vm.items() if previous.get(key) != value}
+        if not changes:
+            return None
+        return {"name": name, "uuid": vm.get("uuid"), "changes": changes}
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """
+        Emit the deltas collected since the last flush.
+
+        :return: The deltas that were emitted.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        deltas = [delta for delta in (self._delta(name, vm) for name, vm in pending.items()) if delta]
+        if not deltas:
+            return deltas
+
+        self.socketio.emit("vm_changes", {"host": self.host, "changes": deltas}, to=host_room(self.host))
+        for delta in deltas:
+            self.socketio.emit("vm_changes", {"host": self.host, "changes": [delta]}, to=vm_room(delta["name"]))
+        return deltas
+
+
+_broadcaster: Optional[VMBroadcaster] = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster(socketio: Any) -> VMBroadcaster:
+    """
+    Get the process-wide broadcaster, starting it on first use.
+
+    :param socketio: The Flask-SocketIO server to emit on.
+    :return: The running broadcaster.
+    """
+    global _broadcaster
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            _broadcaster = VMBroadcaster(socketio)
+    _broadcaster.start()
+    return _broadcaster
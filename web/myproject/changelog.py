@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Changes kept for clients to catch up on; clients further behind get a full listing.
+CHANGE_LOG_SIZE = int(os.getenv("CHANGE_LOG_SIZE", "10000"))
+# File the leader publishes the change log to, so that every worker on the host serves the same log.
+CHANGE_LOG_FILE = os.getenv("CHANGE_LOG_FILE", os.path.join(tempfile.gettempdir(), "qemu_web.changes.log"))
+# Seconds between the leader's checks that its inventory, and so the log, is current.
+CHANGE_LOG_POLL = float(os.getenv("CHANGE_LOG_POLL", "5"))
+
+
+class ChangeLog:
+    """
+    A bounded log of VM inventory changes, read by clients from a cursor.
+
+    One process per host, the leader (see leader.py), records the changes reported by its
+    inventory cache and appends them to ``path``. Every worker reads ``cursor`` and ``since``
+    from that file, so successive polls of a client may land on any worker. A cursor names
+    the log it came from as well as a position in it. A new leader cannot know what changed
+    while there was none, so it starts a new log with a new epoch, and cursors into the old
+    one are recognized as unusable instead of silently skipping changes.
+
+    The file holds a JSON header ``{"epoch", "evicted"}`` followed by a ``[seq, name, vm]``
+    JSON line per change. Once it holds twice ``capacity`` changes the leader rewrites it
+    with the newest ``capacity`` and atomically replaces it. Readers notice the new header and
+    read the file again from the start; otherwise they only read what was appended since.
+    """
+
+    def __init__(self, path: str = CHANGE_LOG_FILE, capacity: int = CHANGE_LOG_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # Writer state, only used in the process that publishes the log
+        self._publisher: Optional[int] = None
+        self._epoch: Optional[str] = None
+        self._seq = 0
+        self._written = 0
+        self._recent: Deque[List[Any]] = deque(maxlen=capacity)
+        # Reader state: the header and entries of the file as of the last read
+        self._header: Optional[bytes] = None
+        self._offset = 0
+        self._read_epoch: Optional[str] = None
+        # Highest sequence number that fell off the log
+        self._evicted = 0
+        self._entries: Deque[Tuple[int, str, Optional[Dict[str, Any]]]] = deque()
+
+    # Writing, in the leader
+
+    def publish(self, poll: Optional[Callable[[], Any]] = None, interval: float = CHANGE_LOG_POLL) -> None:
+        """
+        Start a new log in ``path`` and append the changes recorded by this process to it.
+
+        :param poll: Called every ``interval`` seconds on a thread of its own, to keep the
+            source of the changes current, e.g. ``InventoryCache.list_vms``.
+        """
+        with self._lock:
+            self._publisher = os.getpid()
+            self._start(f"{os.getpid():x}{os.urandom(4).hex()}")
+        if poll is not None:
+            threading.Thread(target=self._poll_loop, args=(poll, interval), name="change-log", daemon=True).start()
+
+    def _poll_loop(self, poll: Callable[[], Any], interval: float) -> None:
+        while True:
+            try:
+                poll()
+            except Exception as e:
+                logger.warning(f"Could not bring the change log up to date: {e}")
+            time.sleep(interval)
+
+    def _start(self, epoch: str) -> None:
+        # Called with the lock held
+        self._epoch = epoch
+        self._seq = 0
+        self._recent.clear()
+        self._rewrite(0)
+
+    def _rewrite(self, evicted: int) -> None:
+        # Called with the lock held. Replaces the file with the header and the recent entries.
+        header = json.dumps({"epoch": self._epoch, "evicted": evicted})
+        try:
+            with open(self.path + ".tmp", "w") as file:
+                file.write(header + "\n")
+                file.writelines(json.dumps(entry) + "\n" for entry in self._recent)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logger.error(f"Could not publish the change log to {self.path}: {e}")
+            self._epoch = None
+            return
+        self._written = len(self._recent)
+
+    def record(self, changes: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        """
+        Append changes in the shape delivered by ``InventoryCache`` listeners.
+
+        Only the process that called ``publish`` records anything; the inventory caches of the
+        other workers see the same changes.
+        """
+        with self._lock:
+            if self._publisher != os.getpid():
+                return
+            if self._epoch is None:
+                # The last write failed, so readers may have missed changes: start over
+                self._start(f"{os.getpid():x}{os.urandom(4).hex()}")
+                if self._epoch is None:
+                    return
+            entries = []
+            for name, vm in changes.items():
+                self._seq += 1
+                entries.append([self._seq, name, vm])
+            self._recent.extend(entries)
+            if self._written + len(entries) > 2 * self.capacity:
+                self._rewrite(self._recent[0][0] - 1)
+                return
+            try:
+                with open(self.path, "a") as file:
+                    file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            except OSError as e:
+                logger.error(f"Could not append to the change log {self.path}: {e}")
+                self._epoch = None
+                return
+            self._written += len(entries)
+
+    # Reading, in every worker
+
+    def _load(self) -> None:
+        # Called with the lock held. Brings the reader state up to date with the file.
+        try:
+            with open(self.path, "rb") as file:
+                header = file.readline()
+                if header != self._header:
+                    self._header, self._offset = header, len(header)
+                    self._entries.clear()
+                    self._read_epoch = None
+                    if header.endswith(b"\n"):
+                        published = json.loads(header)
+                        self._read_epoch, self._evicted = published["epoch"], published["evicted"]
+                file.seek(self._offset)
+                appended = file.read()
+        except FileNotFoundError:
+            self._header, self._read_epoch = None, None
+            self._entries.clear()
+            return
+        # The leader may be halfway through appending a line
+        complete = appended.rfind(b"\n") + 1
+        for line in appended[:complete].splitlines():
+            seq, name, vm = json.loads(line)
+            self._entries.append((seq, name, vm))
+        self._offset += complete
+
+    def _position(self) -> int:
+        # Called with the lock held
+        return self._entries[-1][0] if self._entries else self._evicted
+
+    @property
+    def cursor(self) -> Optional[str]:
+        """
+        The cursor of the newest change, or None while no log has been published.
+        """
+        with self._lock:
+            self._load()
+            if self._read_epoch is None:
+                return None
+            return f"{self._read_epoch}-{self._position()}"
+
+    def since(self, cursor: str) -> Optional[Tuple[Dict[str, Optional[Dict[str, Any]]], str]]:
+        """
+        Collect what changed after a cursor.
+
+        :param cursor: A cursor previously returned by this log.
+        :return: The newest state of each VM that changed, ``None`` for removed VMs, and the
+            cursor to pass next time; or None if the cursor is unknown or too old, in which
+            case the client has to start over from a full listing.
+        """
+        with self._lock:
+            self._load()
+            epoch, _, seq = cursor.partition("-")
+            if self._read_epoch is None or epoch != self._read_epoch or not seq.isdigit():
+                return None
+            seq = int(seq)
+            if seq < self._evicted or seq > self._position():
+                return None
+            changes: Dict[str, Optional[Dict[str, Any]]] = {}
+            # Walk back from the newest entry, so the work is proportional to the changes
+            for entry_seq, name, vm in reversed(self._entries):
+                if entry_seq <= seq:
+                    break
+                changes.setdefault(name, vm)
+            return changes, f"{self._read_epoch}-{self._position()}"
+
+
+change_log = ChangeLog()
@@ -0,0 +1,149 @@
+import io
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+LIBOSINFO_OS = "{http://libosinfo.org/xmlns/libvirt/domain/1.0}os"
+UNKNOWN_OS = "Unknown OS"
+
+# Number of domain descriptions kept before the least recently used are dropped.
+DESCRIPTION_CACHE_SIZE = 4096
+# Seconds a description is reused at most, for changes that raise no domain event.
+DESCRIPTION_MAX_AGE = float(os.getenv("DESCRIPTION_MAX_AGE", "60"))
+
+
+class DomainDescription:
+    """
+    The parts of a domain XML description shown on the VM detail page.
+    """
+
+    __slots__ = ("uuid", "os_id", "disks", "cdroms", "nics")
+
+    def __init__(self):
+        self.uuid: Optional[str] = None
+        self.os_id: str = UNKNOWN_OS
+        self.disks: List[Dict[str, Optional[str]]] = []
+        self.cdroms: List[Dict[str, Optional[str]]] = []
+        self.nics: List[Dict[str, Optional[str]]] = []
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "vm_os": self.os_id,
+            "disks": self.disks,
+            "cdroms": self.cdroms,
+            "nics": self.nics,
+        }
+
+
+def _attr(element: ET.Element, child: str, name: str) -> Optional[str]:
+    found = element.find(child)
+    return found.get(name) if found is not None else None
+
+
+def _disk(element: ET.Element) -> Dict[str, Optional[str]]:
+    source = element.find("source")
+    location = None
+    if source is not None:
+        location = source.get("file") or source.get("dev") or source.get("name")
+    return {"location": location, "target": _attr(element, "target", "dev")}
+
+
+def _nic(element: ET.Element) -> Dict[str, Optional[str]]:
+    source = element.find("source")
+    network = None
+    if source is not None:
+        network = source.get("network") or source.get("bridge") or source.get("dev")
+    return {
+        "type": element.get("type"),
+        "mac": _attr(element, "mac", "address"),
+        "source": network,
+        "model": _attr(element, "model", "type"),
+        "target": _attr(element, "target", "dev"),
+    }
+
+
+def parse_domain_xml(xml_desc: str) -> DomainDescription:
+    """
+    Extract the OS id, disks, CD-ROMs and NICs from a domain XML description in one pass.
+
+    The document is streamed with ``iterparse``; each device element is read when it closes
+    and then cleared, so the full tree is never held in memory.
+
+    :param xml_desc: The domain XML as returned by ``virDomain.XMLDesc``.
+    :return: The extracted description.
+    :raises ET.ParseError: If the XML is malformed.
+    """
+    description = DomainDescription()
+    path: List[str] = []
+    for event, element in ET.iterparse(io.StringIO(xml_desc), events=("start", "end")):
+        if event == "start":
+            path.append(element.tag)
+            continue
+
+        path.pop()
+        depth = len(path)
+        if element.tag == LIBOSINFO_OS:
+            description.os_id = element.get("id", UNKNOWN_OS)
+        elif depth == 1 and element.tag == "uuid":
+            description.uuid = (element.text or "").strip()
+        elif depth == 2 and path[1] == "devices":
+            if element.tag == "disk":
+                if element.get("device") == "cdrom":
+                    description.cdroms.append(_disk(element))
+                else:
+                    description.disks.append(_disk(element))
+            elif element.tag == "interface":
+                description.nics.append(_nic(element))
+            element.clear()
+    return description
+
+
+class DescriptionCache:
+    """
+    Parsed domain descriptions keyed by domain UUID and configuration generation.
+
+    A description is reused as long as the caller passes the same generation it was stored
+    with and it is less than ``max_age`` seconds old. Passing ``None`` as the generation
+    always fetches and parses the XML again.
+    """
+
+    def __init__(self, size: int = DESCRIPTION_CACHE_SIZE, max_age: float = DESCRIPTION_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, domain: Any, generation: Optional[Hashable]) -> DomainDescription:
+        """
+        Return the description of a domain, fetching its XML only when not cached.
+
+        :param domain: The libvirt domain.
+        :param generation: The configuration generation of the domain, or None if unknown.
+        :return: The domain description.
+        """
+        uuid = domain.UUIDString()
+        if generation is not None:
+            with self._lock:
+                entry = self._entries.get(uuid)
+                if entry is not None and entry[0] == generation and time.monotonic() - entry[1] < self.max_age:
+                    self._entries.move_to_end(uuid)
+                    return entry[2]
+
+        description = parse_domain_xml(domain.XMLDesc())
+        if generation is not None:
+            with self._lock:
+                self._entries[uuid] = (generation, time.monotonic(), description)
+                self._entries.move_to_end(uuid)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return description
+
+    def discard(self, uuid: str) -> None:
+        with self._lock:
+            self._entries.pop(uuid, None)
+
+
+description_cache = DescriptionCache()
@@ -0,0 +1,406 @@
+"""
+Prometheus text exposition of host, guest and HTTP request metrics.
+
+Host and guest metrics come from a few bulk libvirt calls whose rendered output is cached
+for ``METRICS_CACHE_TTL`` seconds, so any number of scrapers cost at most one collection
+per interval. Request latency histograms are kept per process and, when ``METRICS_DIR`` is
+set, shared through that directory so every worker renders the sum over all workers.
+"""
+import bisect
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import libvirt
+
+from .pool import DEFAULT_URI, get_pool
+
+logger = logging.getLogger(__name__)
+
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", "10"))
+# Upper bounds, in seconds, of the request latency histogram buckets.
+LATENCY_BUCKETS = tuple(
+    float(bound)
+    for bound in os.getenv("METRICS_LATENCY_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(",")
+)
+# Directory where each worker process publishes its request histograms, so a scrape answered
+# by any worker reports the totals of all of them. Required with more than one uWSGI worker,
+# or counters jump between the workers' values; empty it when the service starts.
+METRICS_DIR = os.getenv("METRICS_DIR")
+# Seconds between publications of a worker's histograms to METRICS_DIR.
+METRICS_SYNC_INTERVAL = float(os.getenv("METRICS_SYNC_INTERVAL", "1"))
+
+DOMAIN_STATS = (
+    libvirt.VIR_DOMAIN_STATS_STATE
+    | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+    | libvirt.VIR_DOMAIN_STATS_BALLOON
+    | libvirt.VIR_DOMAIN_STATS_VCPU
+    | libvirt.VIR_DOMAIN_STATS_INTERFACE
+    | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+
+# (metric suffix, stats key, scale, help) of the per-device counters
+_BLOCK_COUNTERS = (
+    ("read_bytes_total", "rd.bytes", 1, "Bytes read from the block device."),
+    ("write_bytes_total", "wr.bytes", 1, "Bytes written to the block device."),
+    ("read_requests_total", "rd.reqs", 1, "Read requests to the block device."),
+    ("write_requests_total", "wr.reqs", 1, "Write requests to the block device."),
+    ("read_seconds_total", "rd.times", 1e-9, "Time spent reading from the block device."),
+    ("write_seconds_total", "wr.times", 1e-9, "Time spent writing to the block device."),
+)
+_NET_COUNTERS = (
+    ("receive_bytes_total", "rx.bytes", 1, "Bytes received on the interface."),
+    ("transmit_bytes_total", "tx.bytes", 1, "Bytes transmitted on the interface."),
+    ("receive_packets_total", "rx.pkts", 1, "Packets received on the interface."),
+    ("transmit_packets_total", "tx.pkts", 1, "Packets transmitted on the interface."),
+    ("receive_drops_total", "rx.drop", 1, "Received packets dropped on the interface."),
+    ("transmit_drops_total", "tx.drop", 1, "Transmitted packets dropped on the interface."),
+)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricFamily:
+    """
+    The samples of one metric, rendered with its HELP and TYPE lines.
+    """
+
+    def __init__(self, name: str, kind: str, help_text: str):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.samples: List[Tuple[str, Dict[str, Any], float]] = []
+
+    def add(self, value: float, suffix: str = "", **labels: Any) -> "MetricFamily":
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for suffix, labels, value in self.samples:
+            yield f"{self.name}{suffix}{_labels(labels)} {float(value)!r}"
+
+
+def collect_host(conn: libvirt.virConnect) -> List[MetricFamily]:
+    """
+    Host metrics from ``getInfo``, ``getCPUStats`` and ``getMemoryStats``.
+    """
+    model, memory_mb, cpus, mhz, nodes, sockets, cores, threads = conn.getInfo()
+    families = [
+        MetricFamily("libvirt_node_info", "gauge", "Host CPU model and topology.").add(
+            1, model=model, nodes=nodes, sockets=sockets, cores=cores, threads=threads
+        ),
+        MetricFamily("libvirt_node_cpus", "gauge", "Active host CPUs.").add(cpus),
+        MetricFamily("libvirt_node_cpu_frequency_hertz", "gauge", "Host CPU frequency.").add(mhz * 1e6),
+        MetricFamily("libvirt_node_memory_size_bytes", "gauge", "Host memory size.").add(memory_mb * 1024 * 1024),
+    ]
+
+    cpu = MetricFamily("libvirt_node_cpu_seconds_total", "counter", "Host CPU time by mode.")
+    for mode, nanoseconds in conn.getCPUStats(libvirt.VIR_NODE_CPU_STATS_ALL_CPUS, 0).items():
+        cpu.add(nanoseconds / 1e9, mode=mode)
+    memory = MetricFamily("libvirt_node_memory_bytes", "gauge", "Host memory by type.")
+    for kind, kibibytes in conn.getMemoryStats(libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS, 0).items():
+        memory.add(kibibytes * 1024, type=kind)
+    return families + [cpu, memory]
+
+
+def collect_domains(conn: libvirt.virConnect) -> List[MetricFamily]:
+    """
+    Per-domain metrics of every domain from one ``getAllDomainStats`` call.
+    """
+
+    def family(name, kind, help_text):
+        return MetricFamily(f"libvirt_domain_{name}", kind, help_text)
+
+    state = family("state", "gauge", "Domain state as a virDomainState code.")
+    vcpus = family("vcpus", "gauge", "Current vCPUs of the domain.")
+    cpu = family("cpu_seconds_total", "counter", "CPU time used by the domain.")
+    memory_current = family("memory_current_bytes", "gauge", "Memory currently assigned to the domain.")
+    memory_maximum = family("memory_maximum_bytes", "gauge", "Maximum memory of the domain.")
+    memory_rss = family("memory_rss_bytes", "gauge", "Resident memory of the domain process.")
+    block = {key: (family(f"block_{suffix}", "counter", text), scale) for suffix, key, scale, text in _BLOCK_COUNTERS}
+    net = {key: (family(f"interface_{suffix}", "counter", text), scale) for suffix, key, scale, text in _NET_COUNTERS}
+    memory = ((memory_current, "balloon.current"), (memory_maximum, "balloon.maximum"), (memory_rss, "balloon.rss"))
+
+    for domain, stats in conn.getAllDomainStats(DOMAIN_STATS, 0):
+        labels = {"domain": domain.name(), "uuid": domain.UUIDString()}
+        state.add(stats.get("state.state", 0), **labels)
+        if "vcpu.current" in stats:
+            vcpus.add(stats["vcpu.current"], **labels)
+        if "cpu.time" in stats:
+            cpu.add(stats["cpu.time"] / 1e9, **labels)
+        for metric, key in memory:
+            if key in stats:
+                metric.add(stats[key] * 1024, **labels)
+        for group, counters in (("block", block), ("net", net)):
+            for index in range(stats.get(f"{group}.count", 0)):
+                device = stats.get(f"{group}.{index}.name", str(index))
+                for key, (metric, scale) in counters.items():
+                    value = stats.get(f"{group}.{index}.{key}")
+                    if value is not None:
+                        metric.add(value * scale, device=device, **labels)
+
+    families = [state, vcpus, cpu, memory_current, memory_maximum, memory_rss]
+    families += [metric for metric, _ in block.values()] + [metric for metric, _ in net.values()]
+    return families
+
+
+class RequestMetrics:
+    """
+    Latency histograms of HTTP requests by route template, method and status.
+
+    With a ``directory``, each process writes its histograms to a file of its own there every
+    ``sync_interval`` seconds while it has new observations, and ``family`` sums the files of
+    all processes. Files of exited workers, or of earlier workers whose PID was reused, are
+    added to ``requests-archive.json`` and deleted, so the totals never go backwards and the
+    directory does not grow with every worker restart.
+    """
+
+    ARCHIVE = "requests-archive.json"
+
+    def __init__(
+        self,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        directory: Optional[str] = METRICS_DIR,
+        sync_interval: float = METRICS_SYNC_INTERVAL,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # (route, method, status) -> [count per bucket and +Inf, sum]
+        self._series: Dict[Tuple[str, str, str], List[float]] = {}
+        # The process the series belong to and the file it publishes them to
+        self._pid: Optional[int] = None
+        self._path: Optional[str] = None
+        self._dirty = False
+
+    def _claim(self) -> None:
+        # Called with the lock held. A forked worker starts from empty series and a file of its own.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._series = {}
+        if self.directory:
+            self._path = os.path.join(self.directory, f"requests-{self._pid}-{time.time_ns()}.json")
+            threading.Thread(target=self._sync_loop, name="metrics-sync", daemon=True).start()
+
+    def observe(self, route: str, method: str, status: int, seconds: float) -> None:
+        key = (route, method, str(status))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._claim()
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+            self._dirty = True
+
+    def _sync_loop(self) -> None:
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.sync_interval)
+            self.sync()
+
+    def sync(self) -> None:
+        """
+        Publish this process's histograms to the shared directory if they changed.
+        """
+        with self._lock:
+            if not self._dirty or self._path is None:
+                return
+            series = dict(self._series)
+            path, self._dirty = self._path, False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(path, series)
+        except OSError as e:
+            logger.error(f"Could not publish request metrics to {path}: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def _write(self, path: str, series: Dict[Tuple[str, str, str], List[float]]) -> None:
+        payload = json.dumps({"buckets": self.buckets, "series": [[*key, values] for key, values in series.items()]})
+        with open(path + ".tmp", "w") as file:
+            file.write(payload)
+        os.replace(path + ".tmp", path)
+
+    def _read(self, path: str) -> Optional[Dict[Tuple[str, str, str], List[float]]]:
+        try:
+            with open(path) as file:
+                published = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping request metrics in {path}: {e}")
+            return None
+        if tuple(published["buckets"]) != self.buckets:
+            logger.warning(f"Skipping request metrics in {path}: different buckets")
+            return None
+        return {(route, method, status): values for route, method, status, values in published["series"]}
+
+    def _merged(self) -> Dict[Tuple[str, str, str], List[float]]:
+        if not self.directory:
+            with self._lock:
+                return {key: list(values) for key, values in self._series.items()}
+        self.sync()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lock = open(os.path.join(self.directory, "requests.lock"), "a")
+        except OSError as e:
+            logger.error(f"Could not read request metrics from {self.directory}: {e}")
+            return {}
+        with lock:
+            # Held while reading too, so a scrape never sees a worker both archived and still on file
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            published = {}
+            for path in glob.glob(os.path.join(self.directory, "requests-*.json")):
+                series = self._read(path)
+                if series is not None:
+                    published[path] = series
+            exited = _exited_workers(published, self._path)
+            if exited:
+                self._archive(published, exited)
+
+        merged: Dict[Tuple[str, str, str], List[float]] = {}
+        for series in published.values():
+            _add_series(merged, series)
+        return merged
+
+    def _archive(self, published: Dict[str, Dict[Tuple[str, str, str], List[float]]], exited: List[str]) -> None:
+        # Called with the directory lock held. Updates ``published`` to match the directory.
+        path = os.path.join(self.directory, self.ARCHIVE)
+        archive = {key: list(values) for key, values in published.get(path, {}).items()}
+        for exited_path in exited:
+            _add_series(archive, published[exited_path])
+        try:
+            self._write(path, archive)
+        except OSError as e:
+            logger.error(f"Could not archive request metrics of exited workers to {path}: {e}")
+            return
+        published[path] = archive
+        for exited_path in exited:
+            del published[exited_path]
+            try:
+                os.remove(exited_path)
+            except OSError as e:
+                logger.error(f"Could not remove archived request metrics {exited_path}: {e}")
+
+    def family(self) -> MetricFamily:
+        metric = MetricFamily(
+            "qemu_web_http_request_duration_seconds", "histogram", "Latency of HTTP requests by route."
+        )
+        for (route, method, status), values in sorted(self._merged().items()):
+            labels = {"route": route, "method": method, "status": status}
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                metric.add(cumulative, "_bucket", le="+Inf" if bound == float("inf") else repr(bound), **labels)
+            metric.add(values[-1], "_sum", **labels)
+            metric.add(cumulative, "_count", **labels)
+        return metric
+
+
+def _add_series(
+    total: Dict[Tuple[str, str, str], List[float]], series: Dict[Tuple[str, str, str], List[float]]
+) -> None:
+    for key, values in series.items():
+        summed = total.setdefault(key, [0] * len(values))
+        for index, value in enumerate(values):
+            summed[index] += value
+
+
+def _exited_workers(paths: Iterable[str], own: Optional[str]) -> List[str]:
+    """
+    Pick the worker files, named ``requests-<pid>-<start ns>.json``, of processes that are gone.
+
+    A file is stale if its PID is not running, or if a later file has the same PID, which
+    means the PID was reused by a newer worker.
+    """
+    workers = {}
+    for path in paths:
+        match = re.fullmatch(r"requests-(\d+)-(\d+)\.json", os.path.basename(path))
+        if match and path != own:
+            workers[path] = (int(match.group(1)), int(match.group(2)))
+    newest: Dict[int, int] = {}
+    for pid, started in workers.values():
+        newest[pid] = max(newest.get(pid, started), started)
+    return [path for path, (pid, started) in workers.items() if started < newest[pid] or not _is_alive(pid)]
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsExporter:
+    """
+    Renders the ``/metrics`` page, collecting libvirt metrics at most once per ``ttl`` seconds.
+    """
+
+    def __init__(self, uri: str = DEFAULT_URI, ttl: float = METRICS_CACHE_TTL):
+        self.uri = uri
+        self.ttl = ttl
+        self.requests = RequestMetrics()
+        # Held while collecting, so concurrent scrapes wait for one collection instead of each running one.
+        self._lock = threading.Lock()
+        self._collected_at: Optional[float] = None
+        self._libvirt_text = ""
+
+    def _collect(self) -> str:
+        started = time.monotonic()
+        families = []
+        up = 1
+        try:
+            with get_pool(self.uri).connection() as conn:
+                families += collect_host(conn)
+                families += collect_domains(conn)
+        except (libvirt.libvirtError, TimeoutError) as e:
+            logger.warning(f"Metrics collection from {self.uri} failed: {e}")
+            families, up = [], 0
+        families.append(MetricFamily("libvirt_up", "gauge", "Whether libvirt answered the last collection.").add(up))
+        families.append(
+            MetricFamily("libvirt_scrape_duration_seconds", "gauge", "Time the last collection took.").add(
+                time.monotonic() - started
+            )
+        )
+        families.append(
+            MetricFamily("libvirt_scrape_timestamp_seconds", "gauge", "When the last collection ran.").add(time.time())
+        )
+        return "\n".join(line for family in families for line in family.render())
+
+    def libvirt_metrics(self) -> str:
+        with self._lock:
+            now = time.monotonic()
+            if self._collected_at is None or now - self._collected_at >= self.ttl:
+                self._libvirt_text = self._collect()
+                self._collected_at = time.monotonic()
+            return self._libvirt_text
+
+    def render(self) -> str:
+        """
+        The full exposition: cached libvirt metrics followed by the request histograms.
+        """
+        return self.libvirt_metrics() + "\n" + "\n".join(self.requests.family().render()) + "\n"
+
+
+metrics_exporter = MetricsExporter()
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+from kvmproto import KVMClient
+
+DEFAULT_PORT = 12345
+# Seconds each host gets to answer a fan-out request before it is reported as timed out.
+FANOUT_TIMEOUT = float(os.getenv("KVM_FANOUT_TIMEOUT", "5"))
+# Upper bound on the per-host timeout a caller may ask a fan-out for.
+FANOUT_MAX_TIMEOUT = float(os.getenv("KVM_FANOUT_MAX_TIMEOUT", "30"))
+# Seconds the host found to have a VM is remembered before it is looked up again.
+OWNER_TTL = float(os.getenv("KVM_OWNER_TTL", "300"))
+FANOUT_WORKERS = int(os.getenv("KVM_FANOUT_WORKERS", "32"))
+
+
+def parse_hosts(spec: str) -> Dict[str, tuple]:
+    """
+    Parse a host list such as ``"kvm1=10.0.0.1:12345,kvm2=10.0.0.2"``.
+
+    Names are optional and default to the address; ports default to 12345.
+
+    :param spec: Comma-separated ``[name=]address[:port]`` entries.
+    :return: A mapping of host name to ``(address, port)``.
+    """
+    hosts = {}
+    for entry in filter(None, (item.strip() for item in spec.split(","))):
+        name, _, target = entry.rpartition("=")
+        address, _, port = target.partition(":")
+        hosts[name or address] = (address, int(port or DEFAULT_PORT))
+    return hosts
+
+
+class HostRegistry:
+    """
+    The KVM agents fronted by the proxy, each with its own persistent client, and which of
+    them has each VM.
+    """
+
+    def __init__(
+        self,
+        hosts: Optional[Dict[str, tuple]] = None,
+        timeout: float = FANOUT_TIMEOUT,
+        max_timeout: float = FANOUT_MAX_TIMEOUT,
+        owner_ttl: float = OWNER_TTL,
+    ):
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.owner_ttl = owner_ttl
+        self._lock = threading.Lock()
+        self._clients: Dict[str, KVMClient] = {}
+        # VM name -> (host name, monotonic expiry)
+        self._owners: Dict[str, Tuple[str, float]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="kvm-fanout")
+        for name, (address, port) in (hosts or {}).items():
+            self.register(name, address, port)
+
+    def register(self, name: str, address: str, port: int = DEFAULT_PORT) -> None:
+        """
+        Add a host, or point an existing name at a new address.
+        """
+        client = KVMClient(address, port)
+        with self._lock:
+            previous = self._clients.get(name)
+            self._clients[name] = client
+            self._forget_host(name)
+        if previous is not None:
+            previous.close()
+
+    def unregister(self, name: str) -> bool:
+        """
+        Remove a host and close its connection.
+
+        :return: False if no host had that name.
+        """
+        with self._lock:
+            client = self._clients.pop(name, None)
+            self._forget_host(name)
+        if client is None:
+            return False
+        client.close()
+        return True
+
+    def hosts(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            clients = dict(self._clients)
+        return [
+            {"name": name, "address": client.host, "port": client.port, "codec": client.codec.name}
+            for name, client in clients.items()
+        ]
+
+    def client(self, name: Optional[str] = None) -> KVMClient:
+        """
+        Get the client of a host, or of the first registered host when no name is given.
+
+        :raises KeyError: If the host is not registered.
+        """
+        with self._lock:
+            if name is None:
+                if not self._clients:
+                    raise KeyError("No KVM hosts registered")
+                return next(iter(self._clients.values()))
+            return self._clients[name]
+
+    def fan_out(self, request: Dict[str, Any], timeout: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Send the same request to every host concurrently.
+
+        A host that fails or does not answer within ``timeout`` is reported with an error
+        instead of holding up the others.
+
+        :param request: The command and its parameters.
+        :param timeout: Seconds each host gets to answer, at most ``max_timeout``. Defaults to
+            the registry timeout, as does anything that is not a positive number.
+        :return: A mapping of host name to ``{"status": "ok", "response": ...}`` or
+            ``{"status": "error", "message": ...}``.
+        """
+        timeout = self.timeout if timeout is None or not timeout > 0 else min(timeout, self.max_timeout)
+        with self._lock:
+            clients = dict(self._clients)
+        futures = {
+            name: self._executor.submit(client.call, request, timeout) for name, client in clients.items()
+        }
+        # Every host started at the same time, so one shared deadline also covers slow connects.
+        deadline = time.monotonic() + timeout
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = {"status": "ok", "response": future.result(max(0.0, deadline - time.monotonic()))}
+            except FutureTimeoutError:
+                results[name] = {"status": "error", "message": f"Timed out after {timeout}s"}
+            except Exception as e:
+                results[name] = {"status": "error", "message": str(e) or type(e).__name__}
+        return results
+
+    def _forget_host(self, host: str) -> None:
+        # Called with the lock held
+        for vm in [vm for vm, (owner, _) in self._owners.items() if owner == host]:
+            del self._owners[vm]
+
+    def owner(self, vm: str) -> Optional[str]:
+        """
+        The host remembered to have a VM, or None if it has to be looked up.
+        """
+        with self._lock:
+            entry = self._owners.get(vm)
+            if entry is None or entry[1] < time.monotonic() or entry[0] not in self._clients:
+                return None
+            return entry[0]
+
+    def forget(self, vm: str) -> None:
+        """
+        Drop the remembered host of a VM, e.g. after that host said it does not have it.
+        """
+        with self._lock:
+            self._owners.pop(vm, None)
+
+    def locate(self, vm: str) -> Tuple[List[str], List[str]]:
+        """
+        Ask every host for its VMs and remember the host of each VM found on exactly one.
+
+        :return: The hosts that have ``vm`` and the hosts that could not be asked.
+        """
+        found: Dict[str, List[str]] = {}
+        unreachable = []
+        for host, result in self.fan_out({"command": "list_vms"}).items():
+            if result["status"] == "ok" and isinstance(result["response"], list):
+                for name in result["response"]:
+                    found.setdefault(name, []).append(host)
+            else:
+                unreachable.append(host)
+        expires = time.monotonic() + self.owner_ttl
+        with self._lock:
+            if not unreachable:
+                # Every host answered, so VMs not listed anywhere are gone
+                self._owners = {}
+            for name, hosts in found.items():
+                if len(hosts) == 1:
+                    self._owners[name] = (hosts[0], expires)
+                else:
+                    self._owners.pop(name, None)
+        return found.get(vm, []), unreachable
@@ -0,0 +1,131 @@
+"""
+Conditional and compressed JSON responses for endpoints backed by the inventory cache.
+
+A rendered body is kept per endpoint until the inventory generation changes, so repeated
+polls neither re-serialize nor re-compress anything. Each body gets a strong ETag hashed
+from its bytes, which stays the same across uWSGI workers and cache reloads as long as the
+content does, and a matching ``If-None-Match`` is answered with ``304 Not Modified``.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from flask import Response, json, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this many bytes are sent uncompressed.
+COMPRESS_MIN_SIZE = int(os.getenv("HTTP_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "5"))
+# Rendered bodies kept at once; the least recently used endpoint is dropped first.
+REPRESENTATION_CACHE_SIZE = int(os.getenv("HTTP_REPRESENTATION_CACHE_SIZE", "256"))
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL)
+
+
+class Representation:
+    """
+    One rendered JSON body with its ETag and its compressed variants, made on first request.
+    """
+
+    __slots__ = ("body", "etag", "_encoded", "_lock")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self._encoded: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding: Optional[str]) -> Tuple[bytes, str]:
+        """
+        The body in a content coding, with the strong ETag of that variant.
+        """
+        if encoding is None:
+            return self.body, self.etag
+        with self._lock:
+            body = self._encoded.get(encoding)
+            if body is None:
+                body = self._encoded[encoding] = _compress(self.body, encoding)
+        return body, f"{self.etag}-{encoding}"
+
+
+def choose_encoding(size: int) -> Optional[str]:
+    """
+    Pick the content coding for a body of ``size`` bytes from the request's ``Accept-Encoding``.
+    """
+    if size < COMPRESS_MIN_SIZE:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+class RepresentationCache:
+    """
+    Rendered bodies by key, each valid for the generation it was rendered at.
+    """
+
+    def __init__(self, size: int = REPRESENTATION_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries: Dict[Hashable, Tuple[Any, Representation]] = {}
+
+    def get(self, key: Hashable, generation: Any, render: Callable[[], Any]) -> Representation:
+        """
+        The representation of ``key`` at ``generation``, rendering ``render()`` as JSON when missing.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] == generation:
+                self._entries[key] = entry
+                return entry[1]
+        representation = Representation(json.dumps(render()).encode())
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (generation, representation)
+            while len(self._entries) > self.size:
+                del self._entries[next(iter(self._entries))]
+        return representation
+
+
+representation_cache = RepresentationCache()
+
+
+def cached_json_response(key: Hashable, generation: Any, render: Callable[[], Any]) -> Response:
+    """
+    Answer with the JSON of ``render()``, reusing the body rendered for ``key`` at ``generation``.
+
+    Clients that already have the body get ``304 Not Modified``; others get it compressed
+    when they accept it and it is large enough.
+
+    :param key: Identifies the endpoint and its arguments.
+    :param generation: Changes whenever the rendered body may change.
+    :param render: Returns the JSON-serializable response data.
+    """
+    representation = representation_cache.get(key, generation, render)
+    encoding = choose_encoding(len(representation.body))
+    body, etag = representation.encoded(encoding)
+
+    if request.if_none_match.contains_weak(etag) or request.if_none_match.contains_weak(representation.etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "no-cache"
+    return response
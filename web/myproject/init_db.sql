@@ -8,4 +8,46 @@ CREATE TABLE IF NOT EXISTS users (
     password VARCHAR(255) NOT NULL
 );
 
-INSERT INTO users (username, password) VALUES ('admin', 'hashed_password_here');
\ No newline at end of file
+INSERT INTO users (username, password) VALUES ('admin', 'hashed_password_here');
+
+CREATE TABLE IF NOT EXISTS snapshot_schedules (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    vm_name VARCHAR(255) NOT NULL,
+    snapshot_prefix VARCHAR(200) NOT NULL,
+    cron VARCHAR(100) NOT NULL,
+    jitter INT NULL,
+    keep_last INT NULL,
+    max_age_days INT NULL,
+    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+    last_run_at DATETIME NULL,
+    last_status VARCHAR(20) NULL,
+    last_error TEXT NULL,
+    INDEX (vm_name)
+);
+
+CREATE TABLE IF NOT EXISTS snapshot_retention (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    vm_name VARCHAR(255) UNIQUE NOT NULL,
+    prefix VARCHAR(200) NOT NULL DEFAULT '',
+    keep_last INT NULL,
+    keep_daily INT NULL,
+    keep_weekly INT NULL,
+    max_age_days INT NULL
+);
+
+CREATE TABLE IF NOT EXISTS vm_templates (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(255) UNIQUE NOT NULL,
+    image_path VARCHAR(1024) NOT NULL,
+    image_format VARCHAR(20) NOT NULL,
+    capacity BIGINT NOT NULL,
+    storage_pool VARCHAR(255) NOT NULL,
+    cpus INT NOT NULL DEFAULT 1,
+    memory INT NOT NULL DEFAULT 1048576
+);
+
+CREATE TABLE IF NOT EXISTS qos_classes (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(100) UNIQUE NOT NULL,
+    settings TEXT NOT NULL
+);
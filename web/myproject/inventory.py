@@ -0,0 +1,82 @@
+from typing import Any, Dict, List
+
+import libvirt
+
+# Stat groups needed to build a VM listing: state, memory and vCPU counts.
+LIST_STATS = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU
+
+
+def _vm_from_stats(domain: libvirt.virDomain, stats: Dict[str, Any], autostart: bool) -> Dict[str, Any]:
+    # name(), ID() and UUIDString() are read from the domain handle and cost no RPC.
+    return {
+        "name": domain.name(),
+        "id": domain.ID(),
+        "state": stats.get("state.state"),
+        "uuid": domain.UUIDString(),
+        "max_memory": stats.get("balloon.maximum"),
+        "memory": stats.get("balloon.current"),  # Memory in use
+        "vcpus": stats.get("vcpu.current"),  # Number of virtual CPUs
+        "autostart": autostart,
+    }
+
+
+def list_vms_bulk(conn: libvirt.virConnect) -> List[Dict[str, Any]]:
+    """
+    Collect the VM listing for every domain with two RPCs, independent of the number of domains.
+
+    :param conn: An open libvirt connection.
+    :return: A list of VM dictionaries as served by ``GET /api/vms``.
+    :raises libvirt.libvirtError: If the driver does not support bulk stats or the call fails.
+    """
+    autostart = {
+        domain.UUIDString() for domain in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_AUTOSTART)
+    }
+    return [
+        _vm_from_stats(domain, stats, domain.UUIDString() in autostart)
+        for domain, stats in conn.getAllDomainStats(LIST_STATS)
+    ]
+
+
+def vm_summary(domain: libvirt.virDomain) -> Dict[str, Any]:
+    """
+    Collect the listing fields of a single domain with one ``info()`` call.
+
+    :param domain: The libvirt domain.
+    :return: The VM dictionary for the domain.
+    """
+    state, max_memory, memory, vcpus, _ = domain.info()
+    return {
+        "name": domain.name(),
+        "id": domain.ID(),
+        "state": state,
+        "uuid": domain.UUIDString(),
+        "max_memory": max_memory,
+        "memory": memory,  # Memory in use
+        "vcpus": vcpus,  # Number of virtual CPUs
+        "autostart": domain.autostart(),
+    }
+
+
+def list_vms_per_domain(conn: libvirt.virConnect) -> List[Dict[str, Any]]:
+    """
+    Collect the VM listing one domain at a time, for drivers without bulk stats support.
+
+    :param conn: An open libvirt connection.
+    :return: A list of VM dictionaries as served by ``GET /api/vms``.
+    """
+    return [vm_summary(domain) for domain in conn.listAllDomains()]
+
+
+def collect_vms(conn: libvirt.virConnect) -> List[Dict[str, Any]]:
+    """
+    Collect the VM listing, using bulk domain stats when the driver supports them.
+
+    :param conn: An open libvirt connection.
+    :return: A list of VM dictionaries as served by ``GET /api/vms``.
+    """
+    try:
+        return list_vms_bulk(conn)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+            raise
+    return list_vms_per_domain(conn)
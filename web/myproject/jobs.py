@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+# Finished jobs kept for GET /api/jobs/<id> before the oldest are forgotten.
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "1000"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class Job:
+    """
+    A long-running operation on one VM and its outcome.
+    """
+
+    __slots__ = (
+        "id",
+        "vm",
+        "action",
+        "func",
+        "on_finish",
+        "status",
+        "result",
+        "error",
+        "created_at",
+        "started_at",
+        "finished_at",
+    )
+
+    def __init__(
+        self, vm: str, action: str, func: Callable[[], Any], on_finish: Optional[Callable[["Job"], None]] = None
+    ):
+        self.id = uuid.uuid4().hex
+        self.vm = vm
+        self.action = action
+        self.func = func
+        self.on_finish = on_finish
+        self.status = QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "vm": self.vm,
+            "action": self.action,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    Runs VM operations on a background thread pool.
+
+    Jobs for the same VM run one at a time in submission order; jobs for different VMs run in
+    parallel up to ``workers`` at once.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, history: int = JOB_HISTORY):
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vm-jobs")
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._waiting: Dict[str, Deque[Job]] = {}
+        self._listeners: List[Callable[[Job], None]] = []
+
+    def add_listener(self, listener: Callable[[Job], None]) -> None:
+        """
+        Register a callback run on the worker thread whenever a job finishes.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def submit(
+        self, vm: str, action: str, func: Callable[[], Any], on_finish: Optional[Callable[[Job], None]] = None
+    ) -> Job:
+        """
+        Queue an operation on a VM.
+
+        :param vm: The VM the operation acts on; operations on the same VM never overlap.
+        :param action: A short name for the operation, e.g. ``"create_snapshot"``.
+        :param func: Called with no arguments on a worker thread. Its return value becomes the
+            job result and any exception marks the job failed.
+        :param on_finish: Called with the job on the worker thread once it has finished, before
+            the listeners.
+        :return: The queued job.
+        """
+        job = Job(vm, action, func, on_finish)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+            waiting = self._waiting.get(vm)
+            if waiting is not None:
+                # Another job for this VM is running; this one starts when it finishes.
+                waiting.append(job)
+                return job
+            self._waiting[vm] = deque()
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[: max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: Job) -> None:
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            job.result = job.func()
+            job.status = SUCCEEDED
+        except Exception as e:
+            logger.error(f"Job {job.id} ({job.action} {job.vm}) failed: {e}")
+            job.error = str(e)
+            # Exceptions may carry what the job got done before it failed, e.g. ResizeError
+            job.result = getattr(e, "result", None)
+            job.status = FAILED
+        job.finished_at = time.time()
+        job.func = None
+        on_finish, job.on_finish = job.on_finish, None
+
+        with self._lock:
+            waiting = self._waiting[job.vm]
+            following = waiting.popleft() if waiting else None
+            if following is None:
+                del self._waiting[job.vm]
+            listeners = list(self._listeners)
+        if following is not None:
+            self._executor.submit(self._run, following)
+
+        for listener in ([on_finish] if on_finish else []) + listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                logger.error(f"Job listener {listener!r} failed: {e}")
+
+
+job_queue = JobQueue()
@@ -0,0 +1,291 @@
+"""
+Wire protocol between the Flask proxy (main.py) and the KVM agent (sock_srv.py).
+
+Every message is a frame: a 4-byte big-endian payload length followed by the payload.
+Requests carry an ``id`` that the agent echoes back as ``{"id": ..., "response": ...}``, so
+one persistent connection can carry many pipelined requests whose responses arrive in any
+order.
+
+A client may open the connection with a JSON ``{"hello": {"codecs": [...]}}`` frame listing
+the payload encodings it supports in order of preference. The agent answers with
+``{"hello": {"codec": ...}}`` naming the first one it also supports, and every later frame in
+both directions uses it. Connections that skip the handshake use JSON.
+"""
+import asyncio
+import itertools
+import json
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+CONNECT_TIMEOUT = float(os.getenv("KVM_AGENT_CONNECT_TIMEOUT", "5"))
+CALL_TIMEOUT = float(os.getenv("KVM_AGENT_CALL_TIMEOUT", "60"))
+# Payload encodings offered in the handshake, most preferred first.
+PREFERRED_CODECS = os.getenv("KVM_AGENT_CODECS", "msgpack,cbor,json").split(",")
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a frame that cannot be decoded.
+    """
+
+
+class Codec:
+    """
+    A named payload encoding.
+    """
+
+    def __init__(self, name: str, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self) -> str:
+        return f"Codec({self.name!r})"
+
+
+JSON = Codec("json", lambda message: json.dumps(message).encode(), json.loads)
+
+CODECS: Dict[str, Codec] = {"json": JSON}
+if msgpack is not None:
+    CODECS["msgpack"] = Codec(
+        "msgpack",
+        lambda message: msgpack.packb(message, use_bin_type=True),
+        lambda payload: msgpack.unpackb(payload, raw=False, strict_map_key=False),
+    )
+if cbor2 is not None:
+    CODECS["cbor"] = Codec("cbor", cbor2.dumps, cbor2.loads)
+
+
+def available_codecs(preferred: Optional[List[str]] = None) -> List[str]:
+    """
+    List the codecs installed here, in order of preference.
+
+    :param preferred: Codec names in order of preference. Defaults to ``KVM_AGENT_CODECS``.
+    :return: The names of the preferred codecs that are available, always ending with JSON.
+    """
+    names = [name for name in (preferred or PREFERRED_CODECS) if name in CODECS and name != "json"]
+    return names + ["json"]
+
+
+def choose_codec(offered: List[str]) -> Codec:
+    """
+    Pick the first codec offered by a client that is installed here.
+
+    :param offered: Codec names sent by the client, most preferred first.
+    :return: The agreed codec, JSON if there is nothing in common.
+    """
+    for name in offered:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def encode_frame(message: Dict[str, Any], codec: Codec = JSON) -> bytes:
+    """
+    Encode a message as a length-prefixed frame.
+
+    :param message: The message.
+    :param codec: The payload encoding agreed for the connection.
+    :return: The frame bytes.
+    """
+    payload = codec.dumps(message)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_payload(payload: bytes, codec: Codec = JSON) -> Dict[str, Any]:
+    try:
+        message = codec.loads(payload)
+    except Exception as e:
+        # msgpack and cbor2 raise their own exception types for malformed input.
+        raise ProtocolError(f"Invalid {codec.name} frame payload: {e}") from e
+    if not isinstance(message, dict):
+        raise ProtocolError(f"Expected a {codec.name} map, got {type(message).__name__}")
+    return message
+
+
+def _check_length(header: bytes) -> int:
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+    return length
+
+
+async def read_frame(
+    reader: asyncio.StreamReader,
+    header: bytes = b"",
+    codec: Codec = JSON,
+) -> Optional[Dict[str, Any]]:
+    """
+    Read one frame from an asyncio stream.
+
+    :param reader: The stream to read from.
+    :param header: Header bytes already consumed from the stream, if any.
+    :param codec: The payload encoding agreed for the connection.
+    :return: The decoded message, or None if the stream ended cleanly between frames.
+    :raises ProtocolError: If the stream ended mid-frame or the frame is invalid.
+    """
+    try:
+        header += await reader.readexactly(HEADER.size - len(header))
+        payload = await reader.readexactly(_check_length(header))
+    except asyncio.IncompleteReadError as e:
+        if not header and not e.partial:
+            return None
+        raise ProtocolError("Connection closed in the middle of a frame") from e
+    return decode_payload(payload, codec)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the KVM agent")
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket, codec: Codec = JSON) -> Dict[str, Any]:
+    """
+    Read one frame from a blocking socket.
+
+    :param sock: The connected socket.
+    :param codec: The payload encoding agreed for the connection.
+    :return: The decoded message.
+    :raises ConnectionError: If the peer closed the connection.
+    :raises ProtocolError: If the frame is invalid.
+    """
+    length = _check_length(_recv_exactly(sock, HEADER.size))
+    return decode_payload(_recv_exactly(sock, length), codec)
+
+
+class KVMClient:
+    """
+    A persistent, multiplexed connection to one KVM agent.
+
+    ``call`` may be used from many threads at once: requests are written back to back on the
+    same socket and a reader thread hands each response to the caller waiting on its id. The
+    connection is opened on first use and reopened after it fails, negotiating the payload
+    encoding each time.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        timeout: float = CALL_TIMEOUT,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        codecs: Optional[List[str]] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.codecs = available_codecs(codecs)
+        self.codec = JSON
+
+        # Guards the socket and the pending futures; the reader thread takes it for every response.
+        self._lock = threading.Lock()
+        # Keeps frames whole on the wire. Sends never hold ``_lock``, so a sender blocked on a
+        # full socket buffer cannot stop the reader from draining responses.
+        self._send_lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count(1)
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(encode_frame({"hello": {"codecs": self.codecs}}))
+            hello = recv_frame(sock).get("hello") or {}
+        except (OSError, ProtocolError):
+            sock.close()
+            raise
+        self.codec = CODECS.get(hello.get("codec"), JSON)
+        sock.settimeout(None)
+        self._sock = sock
+        threading.Thread(
+            target=self._read_responses, args=(sock, self.codec), name=f"kvm-client-{self.host}", daemon=True
+        ).start()
+        return sock
+
+    def _drop(self, sock: socket.socket, error: Exception) -> None:
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            pending, self._pending = self._pending, {}
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _read_responses(self, sock: socket.socket, codec: Codec) -> None:
+        try:
+            while True:
+                message = recv_frame(sock, codec)
+                with self._lock:
+                    future = self._pending.pop(message.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(message.get("response"))
+        except (OSError, ProtocolError) as e:
+            self._drop(sock, e)
+
+    def call(self, request: Dict[str, Any], timeout: Optional[float] = None) -> Any:
+        """
+        Send a request and wait for its response.
+
+        :param request: The command and its parameters.
+        :param timeout: Seconds to wait for the response. Defaults to the client timeout.
+        :return: The agent's response to the request.
+        :raises OSError: If the agent could not be reached or the connection failed.
+        :raises TimeoutError: If no response arrived in time.
+        :raises ProtocolError: If the agent sent an invalid frame.
+        """
+        future: Future = Future()
+        with self._lock:
+            sock = self._sock or self._connect()
+            request_id = next(self._ids)
+            frame = encode_frame(dict(request, id=request_id), self.codec)
+            self._pending[request_id] = future
+        try:
+            with self._send_lock:
+                sock.sendall(frame)
+        except OSError as e:
+            # A partly written frame leaves the stream unusable for every other caller too.
+            self._drop(sock, e)
+            raise
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise TimeoutError(f"No response from {self.host}:{self.port} after {timeout or self.timeout}s")
+
+    def close(self) -> None:
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            self._drop(sock, ConnectionError("Client closed"))
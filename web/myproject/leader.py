@@ -0,0 +1,96 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional, TextIO
+
+logger = logging.getLogger(__name__)
+
+# File locked by the one process on this host that runs the background services.
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", os.path.join(tempfile.gettempdir(), "qemu_web.leader.lock"))
+# Seconds between attempts of a follower to take over from a leader that exited.
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "30"))
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+
+class LeaderLease:
+    """
+    Elects one process per host to run the background services that must not be duplicated,
+    such as the snapshot scheduler and the telemetry sampler.
+
+    The leader holds an exclusive ``flock`` on ``path``, which the kernel releases when the
+    process exits, so a follower's next ``try_acquire`` takes over. The lease must only be
+    taken after uWSGI forked its workers: threads do not survive a fork, and a lock taken
+    in the master would be shared by every worker.
+    """
+
+    def __init__(self, path: str = LEADER_LOCK_FILE, retry_interval: float = LEADER_RETRY_INTERVAL):
+        self.path = path
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+        self._pid: Optional[int] = None
+        self._retry_at = 0.0
+        self._callbacks: List[Callable[[], None]] = []
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None and self._pid == os.getpid()
+
+    def on_acquire(self, callback: Callable[[], None]) -> None:
+        """
+        Register a callback run once, in the process that becomes the leader.
+        """
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def try_acquire(self) -> bool:
+        """
+        Become the leader if no other process is, at most once per ``retry_interval``.
+
+        :return: True if this process is the leader.
+        """
+        with self._lock:
+            if self.held:
+                return True
+            now = time.monotonic()
+            if now < self._retry_at:
+                return False
+            self._retry_at = now + self.retry_interval
+            try:
+                file = open(self.path, "a+")
+            except OSError as e:
+                logger.error(f"Cannot open leader lock {self.path}: {e}")
+                return False
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                file.close()
+                return False
+            file.seek(0)
+            file.truncate()
+            file.write(str(os.getpid()))
+            file.flush()
+            self._file, self._pid = file, os.getpid()
+            callbacks = list(self._callbacks)
+        logger.info(f"Process {os.getpid()} runs the background services")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Background service {callback!r} failed to start: {e}")
+        return True
+
+
+leader_lease = LeaderLease()
+
+if postfork is not None:
+    # Under uWSGI every worker competes right after the fork, so the services run even
+    # before the first request arrives.
+    postfork(leader_lease.try_acquire)
@@ -0,0 +1,128 @@
+"""
+Load-test the KVM agent socket server.
+
+Opens N concurrent clients that each send M requests and reports latency percentiles and throughput.
+By default each client keeps one persistent framed connection with up to --pipeline requests in
+flight; --legacy opens a new connection per request with the old unframed protocol instead.
+
+Usage:
+    python3 loadtest_sock_srv.py [--host 127.0.0.1] [--port 12345] [--clients 50] [--requests 20]
+                                 [--pipeline 1] [--legacy] [--codec json] [--command list_vms] [--name VM]
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from kvmproto import CODECS, JSON, encode_frame, read_frame
+
+
+def percentile(samples, pct):
+	ordered = sorted(samples)
+	index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+	return ordered[index]
+
+
+async def send_legacy_request(host, port, request):
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		writer.write(json.dumps(request).encode())
+		await writer.drain()
+		return json.loads((await reader.read()).decode())
+	finally:
+		writer.close()
+
+
+def record(response, started, latencies, errors):
+	latencies.append(time.perf_counter() - started)
+	if isinstance(response, dict) and response.get('status') == 'error':
+		errors.append(response.get('message'))
+
+
+async def legacy_client(args, request, latencies, errors):
+	for _ in range(args.requests):
+		started = time.perf_counter()
+		try:
+			response = await send_legacy_request(args.host, args.port, request)
+		except (OSError, ValueError) as e:
+			errors.append(str(e))
+			continue
+		record(response, started, latencies, errors)
+
+
+async def framed_client(args, request, latencies, errors):
+	try:
+		reader, writer = await asyncio.open_connection(args.host, args.port)
+	except OSError as e:
+		errors.extend([str(e)] * args.requests)
+		return
+	codec = JSON
+	if args.codec != 'json':
+		writer.write(encode_frame({'hello': {'codecs': [args.codec]}}))
+		hello = (await read_frame(reader) or {}).get('hello') or {}
+		codec = CODECS.get(hello.get('codec'), JSON)
+	sent = {}
+	slots = asyncio.Semaphore(args.pipeline)
+
+	async def send_all():
+		for request_id in range(args.requests):
+			await slots.acquire()
+			sent[request_id] = time.perf_counter()
+			writer.write(encode_frame(dict(request, id=request_id), codec))
+			await writer.drain()
+
+	sender = asyncio.ensure_future(send_all())
+	received = 0
+	try:
+		while received < args.requests:
+			message = await read_frame(reader, codec=codec)
+			if message is None:
+				raise ConnectionError('Connection closed by server')
+			record(message.get('response'), sent.pop(message.get('id')), latencies, errors)
+			received += 1
+			slots.release()
+		await sender
+	except (OSError, ValueError) as e:
+		sender.cancel()
+		errors.extend([str(e)] * (args.requests - received))
+	finally:
+		writer.close()
+
+
+async def run(args):
+	request = {'command': args.command}
+	if args.name:
+		request['name'] = args.name
+	latencies, errors = [], []
+	started = time.perf_counter()
+	client = legacy_client if args.legacy else framed_client
+	await asyncio.gather(*(client(args, request, latencies, errors) for _ in range(args.clients)))
+	elapsed = time.perf_counter() - started
+
+	mode = 'legacy' if args.legacy else f'framed pipeline={args.pipeline} codec={args.codec}'
+	print(f"mode={mode} clients={args.clients} requests={args.clients * args.requests} errors={len(errors)} "
+		  f"elapsed={elapsed:.2f}s throughput={len(latencies) / elapsed:.1f} req/s")
+	if latencies:
+		print(f"latency ms: p50={percentile(latencies, 50) * 1000:.2f} p99={percentile(latencies, 99) * 1000:.2f} "
+			  f"mean={statistics.mean(latencies) * 1000:.2f} max={max(latencies) * 1000:.2f}")
+	for message in sorted(set(map(str, errors)))[:5]:
+		print(f"error: {message}")
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=12345)
+	parser.add_argument('--clients', type=int, default=50)
+	parser.add_argument('--requests', type=int, default=20)
+	parser.add_argument('--pipeline', type=int, default=1, help='requests in flight per framed connection')
+	parser.add_argument('--legacy', action='store_true', help='one unframed request per connection')
+	parser.add_argument('--codec', default='json', choices=sorted(CODECS), help='payload encoding to negotiate')
+	parser.add_argument('--command', default='list_vms')
+	parser.add_argument('--name', default=None)
+	asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+	main()
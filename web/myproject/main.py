@@ -1,55 +1,168 @@
 from flask import Flask, jsonify, request, Response
+import os
 import socket
 import json
 import logging
 
+from hosts import HostRegistry, parse_hosts
+from kvmproto import ProtocolError
+
 app = Flask(__name__)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 
 
-def send_request_to_kvm(request_data):
+KVM_HOST = os.getenv('KVM_AGENT_HOST', '192.168.111.145')
+KVM_PORT = int(os.getenv('KVM_AGENT_PORT', '12345'))
+
+# Every hypervisor agent fronted by this proxy, e.g. KVM_AGENT_HOSTS="kvm1=10.0.0.1:12345,kvm2=10.0.0.2".
+# Each host gets one persistent, multiplexed connection shared by every request handled by this process.
+registry = HostRegistry(parse_hosts(os.getenv('KVM_AGENT_HOSTS') or f'{KVM_HOST}:{KVM_PORT}'))
+
+
+def send_request_to_kvm(request_data, host=None):
 	"""
 	Sends a request to the KVM hypervisor using the provided request data.
 
+	The request travels as a length-prefixed frame over the host's persistent connection, so
+	responses of any size arrive whole and no TCP connection is opened per call.
+
 	Parameters:
-	- request_data (dict): The data to be sent as a JSON-encoded string.
+	- request_data (dict): The command and its parameters.
+	- host (str): The registered host to send it to. Defaults to the first registered host.
 
 	Returns:
 	- dict: The response from the KVM hypervisor, parsed as a JSON object.
 	"""
-	host = '192.168.111.145'
-	port = 12345
-	
 	try:
-		client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		client_socket.connect((host, port))
-		client_socket.send(json.dumps(request_data).encode())
-		
-		response = client_socket.recv(4096).decode()  # Increased buffer size for larger responses
-		client_socket.close()
-		
-		return json.loads(response)
+		return registry.client(host).call(request_data)
+	except KeyError:
+		return {"status": "error", "message": f"Unknown host {host}"}
+	except TimeoutError as e:
+		logging.error(f"Timeout: {e}")
+		return {"status": "error", "message": str(e)}
 	except socket.error as e:
 		logging.error(f"Socket error: {e}")
 		return {"status": "error", "message": str(e)}
-	except json.JSONDecodeError as e:
-		logging.error(f"JSON decode error: {e}")
+	except ProtocolError as e:
+		logging.error(f"Protocol error: {e}")
 		return {"status": "error", "message": "Invalid response format"}
 	except Exception as e:
 		logging.error(f"Unexpected error: {e}")
 		return {"status": "error", "message": str(e)}
 
 
+def send_vm_request(request_data, name):
+	"""
+	Sends a request about one VM to the host given by ``?host=``, or else to the host that has the VM.
+
+	With a single registered host that host is used. With several, the host remembered to have
+	``name`` is used; when there is none, or it answers with an error, every host is asked for its
+	VMs once and the request goes to the one that has ``name``.
+
+	Parameters:
+	- request_data (dict): The command and its parameters.
+	- name (str): The VM the request is about.
+
+	Returns:
+	- Response: The agent's response; 404 if no host has the VM, 400 if several do, or 503 if it was
+	  not found but some hosts could not be asked.
+	"""
+	host = request.args.get("host")
+	if host is not None or len(registry.hosts()) <= 1:
+		return jsonify(send_request_to_kvm(request_data, host))
+	cached = registry.owner(name)
+	if cached is not None:
+		response = send_request_to_kvm(request_data, cached)
+		if not (isinstance(response, dict) and response.get("status") == "error"):
+			return jsonify(response)
+		# The VM may have moved or gone since its host was remembered
+		registry.forget(name)
+	owners, unreachable = registry.locate(name)
+	if len(owners) > 1:
+		message = f"VM {name} exists on {', '.join(owners)}; choose one with ?host="
+		return Response(json.dumps({"status": "error", "message": message}), status=400,
+						mimetype='application/json')
+	if not owners:
+		status = 503 if unreachable else 404
+		message = f"VM {name} not found" + (f"; could not reach {', '.join(unreachable)}" if unreachable else "")
+		return Response(json.dumps({"status": "error", "message": message}), status=status,
+						mimetype='application/json')
+	if owners[0] == cached:
+		# The VM is still there, so the error was the answer; do not run the command twice
+		return jsonify(response)
+	return jsonify(send_request_to_kvm(request_data, owners[0]))
+
+
+@app.route('/hosts', methods=['GET'])
+def list_hosts():
+	"""
+	List the registered hypervisor hosts.
+	"""
+	return jsonify({"hosts": registry.hosts()})
+
+
+@app.route('/hosts', methods=['POST'])
+def register_host():
+	"""
+	Register a hypervisor host, or move an existing name to a new address.
+	"""
+	data = request.json or {}
+	address = data.get("address")
+	if not address:
+		return Response(json.dumps({"status": "error", "message": "Host address is required"}), status=400,
+						mimetype='application/json')
+	try:
+		port = int(data.get("port") or KVM_PORT)
+	except (TypeError, ValueError):
+		port = 0
+	if not 0 < port < 65536:
+		return Response(json.dumps({"status": "error", "message": "Port must be an integer between 1 and 65535"}),
+						status=400, mimetype='application/json')
+	registry.register(data.get("name") or address, address, port)
+	return jsonify({"status": "success", "hosts": registry.hosts()}), 201
+
+
+@app.route('/hosts/<name>', methods=['DELETE'])
+def unregister_host(name):
+	"""
+	Remove a hypervisor host.
+	"""
+	if not registry.unregister(name):
+		return Response(json.dumps({"status": "error", "message": f"Unknown host {name}"}), status=404,
+						mimetype='application/json')
+	return jsonify({"status": "success"})
+
+
 @app.route('/list_vms', methods=['GET'])
 def list_vms():
 	"""
-	List virtual machines.
+	List virtual machines on every registered host, or only on ``?host=``.
+
+	All hosts are queried at once and each gets ``?timeout=`` seconds (KVM_FANOUT_TIMEOUT by
+	default, at most KVM_FANOUT_MAX_TIMEOUT). Hosts that fail or time out are reported under
+	``hosts`` and the VMs of the others are still returned.
 	"""
 	request_data = {'command': 'list_vms'}
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	host = request.args.get('host')
+	if host:
+		return jsonify(send_request_to_kvm(request_data, host))
+	
+	results = registry.fan_out(request_data, request.args.get('timeout', type=float))
+	vms = []
+	hosts = {}
+	for name, result in results.items():
+		response = result.get('response')
+		if result['status'] == 'ok' and isinstance(response, list):
+			vms.extend({"host": name, "name": vm_name} for vm_name in response)
+			hosts[name] = {"status": "ok", "count": len(response)}
+		elif result['status'] == 'ok':
+			hosts[name] = {"status": "error", "message": (response or {}).get("message", "Invalid response")}
+		else:
+			logging.error(f"list_vms failed on {name}: {result['message']}")
+			hosts[name] = result
+	return jsonify({"vms": vms, "hosts": hosts})
 
 
 @app.route("/<name>/snapshots", methods=["GET"])
@@ -60,8 +173,7 @@ def list_snapshots(name):
 	request_data = {"command": "get_snapshots", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/snapshots/<name>", methods=["POST"])
@@ -77,8 +189,7 @@ def create_snapshots(name):
 	request_data = {"command": "create_snapshots", "name": name, "snapshot": snapshot_name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/start/<name>", methods=["POST"])
@@ -89,8 +200,7 @@ def start_vm(name):
 	request_data = {"command": "start_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/stop/<name>", methods=["POST"])
@@ -101,8 +211,7 @@ def stop_vm(name):
 	request_data = {"command": "stop_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/reboot/<name>", methods=["POST"])
@@ -113,8 +222,7 @@ def reboot_vm(name):
 	request_data = {"command": "reboot_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/shutdown/<name>", methods=["POST"])
@@ -125,8 +233,7 @@ def shutdown_vm(name):
 	request_data = {"command": "shutdown_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/suspend/<name>", methods=["POST"])
@@ -137,8 +244,7 @@ def suspend_vm(name):
 	request_data = {"command": "suspend_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/resume/<name>", methods=["POST"])
@@ -149,8 +255,7 @@ def resume_vm(name):
 	request_data = {"command": "resume_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 @app.route("/poweroff/<name>", methods=["POST"])
@@ -161,8 +266,7 @@ def poweroff_vm(name):
 	request_data = {"command": "poweroff_vm", "name": name}
 	logging.info(f"Request data: {request_data}")
 	
-	response = send_request_to_kvm(request_data)
-	return jsonify(response)
+	return send_vm_request(request_data, name)
 
 
 # Add similar functions for other commands as needed
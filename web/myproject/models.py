@@ -1,6 +1,101 @@
+import json
+
 from . import db
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
-    password = db.Column(db.String(255), nullable=False)
\ No newline at end of file
+    password = db.Column(db.String(255), nullable=False)
+
+class SnapshotSchedule(db.Model):
+    __tablename__ = "snapshot_schedules"
+
+    id = db.Column(db.Integer, primary_key=True)
+    vm_name = db.Column(db.String(255), nullable=False, index=True)
+    # Snapshots are named "<snapshot_prefix>-<YYYYmmdd-HHMMSS>"
+    snapshot_prefix = db.Column(db.String(200), nullable=False)
+    cron = db.Column(db.String(100), nullable=False)
+    # Seconds; NULL spreads the schedule over part of its interval, see scheduler.default_jitter
+    jitter = db.Column(db.Integer, nullable=True)
+    keep_last = db.Column(db.Integer, nullable=True)
+    max_age_days = db.Column(db.Integer, nullable=True)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    last_run_at = db.Column(db.DateTime, nullable=True)
+    last_status = db.Column(db.String(20), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "vm_name": self.vm_name,
+            "snapshot_prefix": self.snapshot_prefix,
+            "cron": self.cron,
+            "jitter": self.jitter,
+            "keep_last": self.keep_last,
+            "max_age_days": self.max_age_days,
+            "enabled": self.enabled,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+        }
+
+
+class SnapshotRetention(db.Model):
+    __tablename__ = "snapshot_retention"
+
+    id = db.Column(db.Integer, primary_key=True)
+    vm_name = db.Column(db.String(255), unique=True, nullable=False)
+    prefix = db.Column(db.String(200), nullable=False, default="")
+    keep_last = db.Column(db.Integer, nullable=True)
+    keep_daily = db.Column(db.Integer, nullable=True)
+    keep_weekly = db.Column(db.Integer, nullable=True)
+    max_age_days = db.Column(db.Integer, nullable=True)
+
+    def as_dict(self):
+        return {
+            "vm_name": self.vm_name,
+            "prefix": self.prefix,
+            "keep_last": self.keep_last,
+            "keep_daily": self.keep_daily,
+            "keep_weekly": self.keep_weekly,
+            "max_age_days": self.max_age_days,
+        }
+
+
+class VMTemplate(db.Model):
+    __tablename__ = "vm_templates"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), unique=True, nullable=False)
+    # The golden image; VMs get qcow2 overlays backed by it, so it must never change.
+    image_path = db.Column(db.String(1024), nullable=False)
+    image_format = db.Column(db.String(20), nullable=False)
+    # Virtual size of the image in bytes, which every overlay inherits
+    capacity = db.Column(db.BigInteger, nullable=False)
+    storage_pool = db.Column(db.String(255), nullable=False)
+    cpus = db.Column(db.Integer, nullable=False, default=1)
+    # KiB
+    memory = db.Column(db.Integer, nullable=False, default=1048576)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "image_path": self.image_path,
+            "image_format": self.image_format,
+            "capacity": self.capacity,
+            "storage_pool": self.storage_pool,
+            "cpus": self.cpus,
+            "memory": self.memory,
+        }
+
+
+class QosClass(db.Model):
+    __tablename__ = "qos_classes"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False)
+    # JSON of the block and network limits, as accepted by qos.validate_qos
+    settings = db.Column(db.Text, nullable=False)
+
+    def as_dict(self):
+        return {"name": self.name, **json.loads(self.settings)}
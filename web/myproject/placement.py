@@ -0,0 +1,382 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import libvirt
+
+from .pool import DEFAULT_URI
+from .vmcache import get_inventory_cache
+
+logger = logging.getLogger(__name__)
+
+NUMA_PLACEMENT = os.getenv("NUMA_PLACEMENT", "1").lower() in ("1", "true", "yes")
+# Seconds the host topology from getCapabilities is reused before it is read again.
+TOPOLOGY_CACHE_TTL = float(os.getenv("TOPOLOGY_CACHE_TTL", "300"))
+# File locked by whichever process on this host is placing a domain; it also holds the
+# CPUs reserved for domains still being created or started.
+PLACEMENT_LOCK_FILE = os.getenv(
+    "PLACEMENT_LOCK_FILE", os.path.join(tempfile.gettempdir(), "qemu_web.placement.lock")
+)
+# Seconds a released reservation is kept, until every worker's inventory cache has seen the
+# events of the domain it was made for.
+PLACEMENT_SETTLE = float(os.getenv("PLACEMENT_SETTLE", "10"))
+
+
+def parse_cpuset(spec: Optional[str]) -> Set[int]:
+    """
+    Parse a libvirt cpuset such as ``"0-3,8,^2"``.
+    """
+    cpus: Set[int] = set()
+    excluded: Set[int] = set()
+    for term in filter(None, (item.strip() for item in (spec or "").split(","))):
+        target = cpus
+        if term.startswith("^"):
+            target, term = excluded, term[1:]
+        start, _, end = term.partition("-")
+        target.update(range(int(start), int(end or start) + 1))
+    return cpus - excluded
+
+
+def format_cpuset(cpus: Set[int]) -> str:
+    """
+    Render CPUs as a libvirt cpuset, merging runs into ranges.
+    """
+    ranges: List[List[int]] = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+class NumaCell:
+    __slots__ = ("id", "memory", "cpus", "siblings")
+
+    def __init__(self, cell_id: int, memory: int, cpus: List[int], siblings: Dict[int, Set[int]]):
+        self.id = cell_id
+        # KiB
+        self.memory = memory
+        self.cpus = cpus
+        self.siblings = siblings
+
+
+class HostTopology:
+    """
+    The NUMA cells of a host and the CPUs in each, from the ``<host><topology>`` of its capabilities.
+    """
+
+    def __init__(self, cells: List[NumaCell]):
+        self.cells = cells
+
+    @classmethod
+    def from_capabilities(cls, xml: str) -> "HostTopology":
+        cells = []
+        for cell in ET.fromstring(xml).iterfind("host/topology/cells/cell"):
+            memory = cell.find("memory")
+            cpus, siblings = [], {}
+            for cpu in cell.iterfind("cpus/cpu"):
+                cpu_id = int(cpu.get("id"))
+                cpus.append(cpu_id)
+                siblings[cpu_id] = parse_cpuset(cpu.get("siblings")) or {cpu_id}
+            cells.append(NumaCell(int(cell.get("id")), int(memory.text) if memory is not None else 0, cpus, siblings))
+        return cls(cells)
+
+
+def domain_pins(xml: str) -> Set[int]:
+    """
+    The host CPUs a domain's vCPUs and emulator threads are pinned to.
+    """
+    cputune = ET.fromstring(xml).find("cputune")
+    if cputune is None:
+        return set()
+    pinned: Set[int] = set()
+    for pin in list(cputune.iterfind("vcpupin")) + list(cputune.iterfind("emulatorpin")):
+        pinned |= parse_cpuset(pin.get("cpuset"))
+    return pinned
+
+
+class Placement:
+    """
+    The NUMA cell and host CPUs chosen for a new domain.
+    """
+
+    __slots__ = ("name", "cell", "cpus")
+
+    def __init__(self, name: str, cell: int, cpus: List[int]):
+        self.name = name
+        self.cell = cell
+        # One host CPU per vCPU, in vCPU order
+        self.cpus = cpus
+
+    def apply(self, domain: ET.Element) -> ET.Element:
+        """
+        Set the ``<cputune>`` pins and ``<numatune>`` of a ``<domain>`` element to this placement.
+
+        Each vCPU is pinned to its own host CPU, the emulator threads float over those
+        CPUs, and memory is allocated strictly from the chosen cell. Pins the domain
+        already had are replaced; its other CPU tuning is kept.
+        """
+        cputune = domain.find("cputune")
+        if cputune is None:
+            cputune = ET.SubElement(domain, "cputune")
+        for pin in list(cputune.iterfind("vcpupin")) + list(cputune.iterfind("emulatorpin")):
+            cputune.remove(pin)
+        for vcpu, cpu in enumerate(self.cpus):
+            ET.SubElement(cputune, "vcpupin", vcpu=str(vcpu), cpuset=str(cpu))
+        ET.SubElement(cputune, "emulatorpin", cpuset=format_cpuset(set(self.cpus)))
+        for numatune in domain.findall("numatune"):
+            domain.remove(numatune)
+        numatune = ET.SubElement(domain, "numatune")
+        ET.SubElement(numatune, "memory", mode="strict", nodeset=str(self.cell))
+        return domain
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"vm": self.name, "cell": self.cell, "cpus": self.cpus}
+
+
+class PlacementEngine:
+    """
+    Picks the NUMA cell and host CPUs for domains being created or started.
+
+    The CPUs pinned by defined domains, running or not, come from views of their XML kept
+    by the inventory cache, so a domain's XML is only read again after an event for it, and
+    a stopped domain finds its CPUs free when it starts again. Placements on the host are
+    serialized by an exclusive ``flock`` on ``path``, which also records the CPUs reserved
+    for domains still being created or started, so no two uWSGI workers hand out the same CPUs.
+    """
+
+    def __init__(
+        self,
+        uri: str = DEFAULT_URI,
+        ttl: float = TOPOLOGY_CACHE_TTL,
+        path: str = PLACEMENT_LOCK_FILE,
+        settle: float = PLACEMENT_SETTLE,
+    ):
+        self.uri = uri
+        self.ttl = ttl
+        self.path = path
+        self.settle = settle
+        self._lock = threading.Lock()
+        # Threads of one process take turns before competing with other processes for the flock
+        self._place_lock = threading.Lock()
+        self._topology: Optional[HostTopology] = None
+        self._topology_at = 0.0
+
+    def topology(self, conn: libvirt.virConnect) -> HostTopology:
+        with self._lock:
+            if self._topology is not None and time.monotonic() - self._topology_at < self.ttl:
+                return self._topology
+        topology = HostTopology.from_capabilities(conn.getCapabilities())
+        with self._lock:
+            self._topology, self._topology_at = topology, time.monotonic()
+        return topology
+
+    @contextmanager
+    def _reservations(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """
+        Hold the host-wide placement lock and edit the reservations it records.
+
+        Reservations map a domain name to its ``cpus``, the ``pid`` that made it and, once
+        released, when it ``expires``. Those of processes that exited without releasing
+        them are dropped.
+        """
+        with self._place_lock, open(self.path, "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            try:
+                reserved = json.loads(file.read() or "{}")
+            except ValueError:
+                logger.warning(f"Ignoring unreadable placement reservations in {self.path}")
+                reserved = {}
+            now = time.time()
+            for name, entry in list(reserved.items()):
+                if entry.get("expires") is not None:
+                    if entry["expires"] < now:
+                        del reserved[name]
+                elif not _is_alive(entry["pid"]):
+                    del reserved[name]
+            yield reserved
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(reserved))
+            file.flush()
+
+    def allocation(
+        self,
+        conn: libvirt.virConnect,
+        inactive: bool = True,
+        exclude: Optional[str] = None,
+        reserved: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> Dict[int, str]:
+        """
+        Map each pinned host CPU to the domain that holds it.
+
+        Running domains come first, then reservations, then, with ``inactive``, defined
+        domains that are shut off.
+
+        :param exclude: A domain whose own pins and reservation are left out.
+        :param reserved: The reservations, when the caller already holds the placement lock.
+        """
+        if reserved is None:
+            with self._reservations() as current:
+                return self.allocation(conn, inactive, exclude, current)
+        cache = get_inventory_cache(self.uri)
+        running: Dict[int, str] = {}
+        stopped: Dict[int, str] = {}
+        for vm in cache.list_vms():
+            if vm["name"] == exclude:
+                continue
+            try:
+                pins = cache.domain_view("pins", vm["name"], _load_pins)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                continue
+            # Inactive domains have no ID
+            owners = running if vm["id"] != -1 else stopped
+            for cpu in pins:
+                owners[cpu] = vm["name"]
+        for name, entry in reserved.items():
+            if name != exclude:
+                for cpu in entry["cpus"]:
+                    running.setdefault(cpu, name)
+        if inactive:
+            for cpu, name in stopped.items():
+                running.setdefault(cpu, name)
+        return running
+
+    def _free_memory(self, conn: libvirt.virConnect, topology: HostTopology) -> Dict[int, int]:
+        # Free memory per cell in KiB; drivers without per-cell counters report the cell size.
+        free = {cell.id: cell.memory for cell in topology.cells}
+        try:
+            for cell in topology.cells:
+                free[cell.id] = conn.getCellsFreeMemory(cell.id, 1)[0] // 1024
+        except libvirt.libvirtError as e:
+            logger.debug(f"Per-cell free memory unavailable on {self.uri}: {e}")
+        return free
+
+    def place(self, conn: libvirt.virConnect, name: str, vcpus: int, memory: int) -> Optional[Placement]:
+        """
+        Reserve host CPUs for a new domain within a single NUMA cell.
+
+        The cell with the most free CPUs among those with room for every vCPU and for
+        ``memory`` KiB is chosen. Free CPUs are taken a whole core at a time where possible,
+        so vCPUs of different domains do not share a core's hyperthreads.
+
+        :return: The placement, to be applied to the domain XML and released once the
+            domain is running; or None if no cell has room, in which case the domain
+            should be created unpinned.
+        """
+        with self._reservations() as reserved:
+            return self._place(conn, name, vcpus, memory, reserved)
+
+    def _place(
+        self, conn: libvirt.virConnect, name: str, vcpus: int, memory: int, reserved: Dict[str, Dict[str, Any]]
+    ) -> Optional[Placement]:
+        topology = self.topology(conn)
+        taken = self.allocation(conn, exclude=name, reserved=reserved)
+        free_memory = self._free_memory(conn, topology)
+        best = None
+        for cell in topology.cells:
+            free = [cpu for cpu in cell.cpus if cpu not in taken]
+            if len(free) >= vcpus and free_memory.get(cell.id, 0) >= memory:
+                if best is None or len(free) > len(best[1]):
+                    best = (cell, free)
+        if best is None:
+            logger.info(f"No NUMA cell has {vcpus} free CPUs and {memory} KiB for {name}; leaving it unpinned")
+            return None
+        cell, free = best
+        # Cores with every thread free come first, then partly used ones
+        available = set(free)
+        free.sort(key=lambda cpu: (not cell.siblings[cpu] <= available, min(cell.siblings[cpu]), cpu))
+        placement = Placement(name, cell.id, free[:vcpus])
+        reserved[name] = {"cpus": placement.cpus, "pid": os.getpid(), "expires": None}
+        return placement
+
+    def place_defined(self, conn: libvirt.virConnect, domain: libvirt.virDomain) -> Optional[Placement]:
+        """
+        Give a defined domain that is about to start host CPUs of its own.
+
+        A domain keeps its pins when no running domain or pending placement uses any of
+        them. Otherwise, or when it has none, it is placed like a new domain and its
+        persistent definition is updated with the placement. Either way its CPUs stay
+        reserved until ``release``.
+
+        :return: The new placement; or None if the domain keeps its pins or no cell has room for it.
+        """
+        name = domain.name()
+        xml = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+        pins = domain_pins(xml)
+        with self._reservations() as reserved:
+            if pins and not pins & set(self.allocation(conn, inactive=False, exclude=name, reserved=reserved)):
+                reserved[name] = {"cpus": sorted(pins), "pid": os.getpid(), "expires": None}
+                return None
+            element = ET.fromstring(xml)
+            vcpus, memory = int(element.findtext("vcpu")), int(element.findtext("memory"))
+            placement = self._place(conn, name, vcpus, memory, reserved)
+            if placement is None:
+                return None
+            try:
+                conn.defineXML(ET.tostring(placement.apply(element), encoding="unicode"))
+            except libvirt.libvirtError:
+                del reserved[name]
+                raise
+        return placement
+
+    def release(self, name: str) -> None:
+        """
+        Let the reservation of a domain expire once it is running or its creation failed.
+        """
+        with self._reservations() as reserved:
+            if name in reserved:
+                reserved[name]["expires"] = time.time() + self.settle
+
+    def report(self, conn: libvirt.virConnect) -> Dict[str, Any]:
+        """
+        The host topology with the owner of every CPU and the free memory of every cell.
+        """
+        topology = self.topology(conn)
+        with self._reservations() as current:
+            owners = self.allocation(conn, reserved=current)
+            reserved = {name: sorted(entry["cpus"]) for name, entry in current.items() if entry["expires"] is None}
+        free_memory = self._free_memory(conn, topology)
+        cells = []
+        for cell in topology.cells:
+            cells.append(
+                {
+                    "id": cell.id,
+                    "memory": cell.memory,
+                    "free_memory": free_memory.get(cell.id),
+                    "cpus": [
+                        {"id": cpu, "siblings": sorted(cell.siblings[cpu]), "vm": owners.get(cpu)}
+                        for cpu in cell.cpus
+                    ],
+                    "free_cpus": sum(1 for cpu in cell.cpus if cpu not in owners),
+                }
+            )
+        return {"cells": cells, "reserved": reserved}
+
+
+def _load_pins(conn: libvirt.virConnect, name: str) -> Set[int]:
+    return domain_pins(conn.lookupByName(name).XMLDesc(0))
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+placement_engine = PlacementEngine()
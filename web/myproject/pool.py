@@ -0,0 +1,318 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import libvirt
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URI = os.getenv("LIBVIRT_URI", "qemu:///system")
+POOL_SIZE = int(os.getenv("LIBVIRT_POOL_SIZE", "4"))
+POOL_TIMEOUT = float(os.getenv("LIBVIRT_POOL_TIMEOUT", "10"))
+KEEPALIVE_INTERVAL = int(os.getenv("LIBVIRT_KEEPALIVE_INTERVAL", "5"))
+KEEPALIVE_COUNT = int(os.getenv("LIBVIRT_KEEPALIVE_COUNT", "3"))
+
+# Error codes that mean the connection itself is gone, not just the call.
+_DEAD_CONNECTION_ERRORS = {
+    libvirt.VIR_ERR_SYSTEM_ERROR,
+    libvirt.VIR_ERR_INVALID_CONN,
+    libvirt.VIR_ERR_NO_CONNECT,
+    libvirt.VIR_ERR_RPC,
+}
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread: Optional[threading.Thread] = None
+
+# Installed with ``set_instrumentation``.
+_instrumentation: Any = None
+
+
+def _run_event_loop() -> None:
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def start_event_loop() -> None:
+    """
+    Register the default libvirt event implementation and run it on a daemon thread.
+
+    Keepalives, close callbacks and domain events are only delivered while this loop
+    runs. Calling it more than once is a no-op.
+    """
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_thread = threading.Thread(target=_run_event_loop, name="libvirt-events", daemon=True)
+        _event_loop_thread.start()
+
+
+def is_connection_error(error: libvirt.libvirtError) -> bool:
+    """
+    Tell whether a libvirt error means the underlying connection is unusable.
+
+    :param error: The error raised by a libvirt call.
+    :return: True if the connection should be discarded.
+    """
+    return error.get_error_code() in _DEAD_CONNECTION_ERRORS
+
+
+def set_instrumentation(instrumentation: Any) -> None:
+    """
+    Route the connections of every pool through an instrumentation module such as ``tracing``.
+
+    The module provides ``span(name, **attributes)``, which times opening and borrowing
+    connections, and ``wrap(conn)``/``unwrap(conn)``, applied to connections as they are
+    handed out and given back.
+
+    :param instrumentation: The module, or None to remove it.
+    """
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+class PoolClosedError(RuntimeError):
+    """
+    Raised when borrowing from a pool that was closed.
+    """
+
+
+class ConnectionPool:
+    """
+    A bounded pool of long-lived libvirt connections to a single URI.
+
+    Connections are opened lazily up to ``size``, kept alive with libvirt keepalives and
+    transparently reopened when the daemon closes them or a call fails with a
+    connection-level error.
+    """
+
+    def __init__(
+        self,
+        uri: str = DEFAULT_URI,
+        size: int = POOL_SIZE,
+        timeout: float = POOL_TIMEOUT,
+        keepalive_interval: int = KEEPALIVE_INTERVAL,
+        keepalive_count: int = KEEPALIVE_COUNT,
+        name: str = "default",
+    ):
+        self.uri = uri
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+
+        self._cond = threading.Condition()
+        self._idle: List[libvirt.virConnect] = []
+        self._dead: set = set()
+        self._opened = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _on_close(self, conn: libvirt.virConnect, reason: int, opaque: Any) -> None:
+        logger.warning(f"libvirt connection to {self.uri} closed (reason {reason})")
+        with self._cond:
+            self._dead.add(id(conn))
+
+    def _open(self) -> libvirt.virConnect:
+        if _instrumentation is not None:
+            with _instrumentation.span("libvirt.open", uri=self.uri):
+                conn = libvirt.open(self.uri)
+        else:
+            conn = libvirt.open(self.uri)
+        try:
+            conn.registerCloseCallback(self._on_close, None)
+            if self.keepalive_interval > 0:
+                conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        except libvirt.libvirtError as e:
+            # Drivers such as test:/// do not support keepalives; the connection is still usable.
+            logger.debug(f"Keepalive not enabled for {self.uri}: {e}")
+        return conn
+
+    def _discard(self, conn: libvirt.virConnect) -> None:
+        self._dead.discard(id(conn))
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def _is_usable(self, conn: libvirt.virConnect) -> bool:
+        if id(conn) in self._dead:
+            return False
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def acquire(self, timeout: Optional[float] = None) -> libvirt.virConnect:
+        """
+        Borrow a connection, opening or reopening one if needed.
+
+        :param timeout: Seconds to wait for a free connection. Defaults to the pool timeout.
+        :return: A live libvirt connection that must be given back with ``release``.
+        :raises TimeoutError: If no connection became free in time.
+        :raises PoolClosedError: If the pool was closed.
+        :raises libvirt.libvirtError: If a new connection could not be opened.
+        """
+        if _instrumentation is None:
+            return self._acquire(timeout)
+        with _instrumentation.span("libvirt.pool.acquire", uri=self.uri):
+            return _instrumentation.wrap(self._acquire(timeout))
+
+    def _acquire(self, timeout: Optional[float]) -> libvirt.virConnect:
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            while not self._closed and not self._idle and self._opened >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise TimeoutError(f"No libvirt connection to {self.uri} free after {timeout}s")
+                self._cond.wait(remaining)
+            if self._closed:
+                raise PoolClosedError(f"The {self.name} pool of {self.uri} is closed")
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._opened += 1
+            waited = time.monotonic() - started
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        if conn is not None and self._is_usable(conn):
+            return conn
+
+        if conn is not None:
+            self._discard(conn)
+            with self._cond:
+                self._reconnects += 1
+        try:
+            return self._open()
+        except libvirt.libvirtError:
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn: Optional[libvirt.virConnect], discard: bool = False) -> None:
+        """
+        Give a borrowed connection back to the pool.
+
+        :param conn: The connection returned by ``acquire``. ``None`` is ignored.
+        :param discard: Close the connection instead of reusing it.
+        """
+        if conn is None:
+            return
+        if _instrumentation is not None:
+            conn = _instrumentation.unwrap(conn)
+        if discard or self._closed or not self._is_usable(conn):
+            self._discard(conn)
+            with self._cond:
+                self._opened -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """
+        Borrow a connection for the duration of a ``with`` block.
+
+        Connection-level libvirt errors raised inside the block drop the connection so the
+        next borrower gets a fresh one.
+        """
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except libvirt.libvirtError as e:
+            discard = is_connection_error(e)
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Return counters describing pool usage.
+
+        :return: A dictionary of pool size, usage and timing counters.
+        """
+        with self._cond:
+            return {
+                "name": self.name,
+                "uri": self.uri,
+                "size": self.size,
+                "open": self._opened,
+                "idle": len(self._idle),
+                "in_use": self._opened - len(self._idle),
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "wait_total_seconds": round(self._wait_total, 6),
+                "wait_avg_seconds": round(self._wait_total / self._checkouts, 6) if self._checkouts else 0.0,
+                "wait_max_seconds": round(self._wait_max, 6),
+            }
+
+    def close(self) -> None:
+        """
+        Close every idle connection and stop handing out new ones.
+
+        Borrowed connections are closed when they are released, and threads waiting for one
+        get ``PoolClosedError``.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+
+_pools: Dict[Tuple[str, str], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(uri: str = DEFAULT_URI, name: str = "default", size: int = POOL_SIZE) -> ConnectionPool:
+    """
+    Get the process-wide pool for a libvirt URI, creating it on first use.
+
+    Pools are created lazily so that each forked uWSGI worker gets its own connections.
+
+    :param uri: The libvirt connection URI.
+    :param name: Keeps separate pools for the same URI, such as ``"jobs"`` for background jobs
+        that hold a connection for minutes and must not starve request handlers.
+    :param size: The size of the pool if it is created by this call.
+    :return: The connection pool for the URI.
+    """
+    with _pools_lock:
+        pool = _pools.get((name, uri))
+        if pool is None:
+            start_event_loop()
+            pool = _pools[(name, uri)] = ConnectionPool(uri, size=size, name=name)
+        return pool
+
+
+def pool_metrics() -> List[Dict[str, Any]]:
+    """
+    Return the metrics of every pool created in this process.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.metrics() for pool in pools]
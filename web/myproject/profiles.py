@@ -0,0 +1,222 @@
+"""
+Domain XML generation from named tuning profiles.
+
+A profile bundles the machine type, CPU model and device tuning a class of guests should
+run with. ``domain_element`` validates the requested resources against the profile and
+builds the XML with ElementTree, so names and paths are always escaped.
+"""
+import os
+import re
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, Optional
+
+DEFAULT_PROFILE = os.getenv("DOMAIN_PROFILE", "default")
+VM_NETWORK = os.getenv("VM_NETWORK", "default")
+# Upper bounds accepted for a new VM.
+MAX_VCPUS = int(os.getenv("VM_MAX_VCPUS", "64"))
+MAX_MEMORY = int(os.getenv("VM_MAX_MEMORY", str(256 * 1024 * 1024)))  # KiB
+# virtio-net queues are sized to the vCPUs, but no larger than this.
+MAX_NET_QUEUES = int(os.getenv("VM_MAX_NET_QUEUES", "8"))
+# DIMM slots reserved for memory hot-plug on VMs created with a max_memory.
+MEMORY_SLOTS = int(os.getenv("VM_MEMORY_SLOTS", "16"))
+
+_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.+-]{0,63}$")
+_DISK_IO = (None, "native", "io_uring", "threads")
+_DISK_CACHE = (None, "none", "writeback", "writethrough", "directsync", "unsafe")
+
+
+class DomainProfile:
+    """
+    Machine type, CPU model and device tuning applied to the domains created with it.
+
+    :param machine: The QEMU machine type.
+    :param cpu_mode: The ``<cpu mode>``, e.g. ``host-passthrough``; None keeps the hypervisor default.
+    :param iothreads: Dedicated I/O threads; the disk is served by the first one. 0 uses the main loop.
+    :param disk_cache: The disk ``cache`` mode; None keeps the default.
+    :param disk_io: The disk ``io`` mode, ``native`` or ``io_uring``; None keeps the default.
+    :param multiqueue: Give virtio-net one queue per vCPU, up to ``MAX_NET_QUEUES``.
+    :param hugepages: Back guest memory with hugepages unless the request says otherwise.
+    """
+
+    __slots__ = (
+        "name",
+        "description",
+        "machine",
+        "cpu_mode",
+        "iothreads",
+        "disk_cache",
+        "disk_io",
+        "multiqueue",
+        "hugepages",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        machine: str = "q35",
+        cpu_mode: Optional[str] = None,
+        iothreads: int = 0,
+        disk_cache: Optional[str] = None,
+        disk_io: Optional[str] = None,
+        multiqueue: bool = False,
+        hugepages: bool = False,
+    ):
+        if disk_io not in _DISK_IO:
+            raise ValueError(f"Unknown disk io mode {disk_io!r}")
+        if disk_cache not in _DISK_CACHE:
+            raise ValueError(f"Unknown disk cache mode {disk_cache!r}")
+        if disk_io == "native" and disk_cache not in ("none", "directsync"):
+            # QEMU refuses io='native' on a disk that goes through the host page cache
+            raise ValueError("io='native' needs cache='none' or cache='directsync'")
+        self.name = name
+        self.description = description
+        self.machine = machine
+        self.cpu_mode = cpu_mode
+        self.iothreads = iothreads
+        self.disk_cache = disk_cache
+        self.disk_io = disk_io
+        self.multiqueue = multiqueue
+        self.hugepages = hugepages
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+PROFILES: Dict[str, DomainProfile] = {
+    profile.name: profile
+    for profile in (
+        DomainProfile(
+            "default",
+            "The original i440fx layout with hypervisor defaults, for guests that need it.",
+            machine="pc-i440fx-2.9",
+        ),
+        DomainProfile(
+            "throughput",
+            "Bulk I/O: an io_uring disk on its own iothread and multiqueue networking.",
+            cpu_mode="host-passthrough",
+            iothreads=1,
+            disk_cache="none",
+            disk_io="io_uring",
+            multiqueue=True,
+        ),
+        DomainProfile(
+            "latency",
+            "Predictable response times: native AIO on a dedicated iothread, hugepage-backed memory.",
+            cpu_mode="host-passthrough",
+            iothreads=1,
+            disk_cache="none",
+            disk_io="native",
+            multiqueue=True,
+            hugepages=True,
+        ),
+    )
+}
+
+
+def get_profile(name: Optional[str]) -> DomainProfile:
+    """
+    :param name: The profile name, or None for ``DEFAULT_PROFILE``.
+    :raises ValueError: If there is no such profile.
+    """
+    profile = PROFILES.get(name or DEFAULT_PROFILE)
+    if profile is None:
+        raise ValueError(f"Unknown profile {name!r}, expected one of {sorted(PROFILES)}")
+    return profile
+
+
+def validate_cpus(cpus: Any, key: str = "cpus", minimum: int = 1) -> None:
+    if isinstance(cpus, bool) or not isinstance(cpus, int) or not minimum <= cpus <= MAX_VCPUS:
+        raise ValueError(f"{key} must be an integer between {minimum} and {MAX_VCPUS}")
+
+
+def validate_memory(memory: Any, key: str = "memory", minimum: int = 1024) -> None:
+    if isinstance(memory, bool) or not isinstance(memory, int) or not minimum <= memory <= MAX_MEMORY:
+        raise ValueError(f"{key} must be an integer between {minimum} and {MAX_MEMORY} KiB")
+
+
+def validate_resources(name: Any, cpus: Any, memory: Any, max_cpus: Any = None, max_memory: Any = None) -> None:
+    """
+    Check the name, vCPU count and memory (KiB) of a new VM, and the ceilings they may be
+    hot-plugged up to.
+
+    :raises ValueError: Describing the first invalid value.
+    """
+    if not isinstance(name, str) or not _NAME.match(name):
+        raise ValueError("VM name must be 1-64 letters, digits or _.+- and start with a letter or digit")
+    validate_cpus(cpus)
+    validate_memory(memory)
+    if max_cpus is not None:
+        validate_cpus(max_cpus, "max_cpus", cpus)
+    if max_memory is not None:
+        validate_memory(max_memory, "max_memory", memory)
+
+
+def domain_element(
+    name: str,
+    cpus: int,
+    memory: int,
+    disk_path: str,
+    profile: DomainProfile,
+    hugepages: Optional[bool] = None,
+    max_cpus: Optional[int] = None,
+    max_memory: Optional[int] = None,
+) -> ET.Element:
+    """
+    Build the ``<domain>`` element of a new VM.
+
+    :param memory: Memory in KiB.
+    :param hugepages: Override the profile's hugepage backing.
+    :param max_cpus: vCPUs the running VM may be scaled up to; the rest start unplugged.
+    :param max_memory: KiB the running VM may be scaled up to with DIMM hot-plug. This
+        gives the guest a single NUMA cell, which memory hot-plug needs.
+    :raises ValueError: If the resources are invalid.
+    """
+    validate_resources(name, cpus, memory, max_cpus, max_memory)
+    domain = ET.Element("domain", type="kvm")
+    ET.SubElement(domain, "name").text = name
+    if max_memory is not None and max_memory > memory:
+        ET.SubElement(domain, "maxMemory", slots=str(MEMORY_SLOTS), unit="KiB").text = str(max_memory)
+    ET.SubElement(domain, "memory", unit="KiB").text = str(memory)
+    if max_cpus is not None and max_cpus > cpus:
+        ET.SubElement(domain, "vcpu", current=str(cpus)).text = str(max_cpus)
+    else:
+        ET.SubElement(domain, "vcpu").text = str(cpus)
+    if profile.hugepages if hugepages is None else hugepages:
+        ET.SubElement(ET.SubElement(domain, "memoryBacking"), "hugepages")
+    if profile.iothreads:
+        ET.SubElement(domain, "iothreads").text = str(profile.iothreads)
+
+    os_element = ET.SubElement(domain, "os")
+    ET.SubElement(os_element, "type", arch="x86_64", machine=profile.machine).text = "hvm"
+    if profile.machine.startswith("q35"):
+        features = ET.SubElement(domain, "features")
+        ET.SubElement(features, "acpi")
+        ET.SubElement(features, "apic")
+    cpu = ET.SubElement(domain, "cpu", mode=profile.cpu_mode) if profile.cpu_mode else None
+    if max_memory is not None and max_memory > memory:
+        if cpu is None:
+            cpu = ET.SubElement(domain, "cpu")
+        cell_cpus = f"0-{max(cpus, max_cpus or 0) - 1}"
+        ET.SubElement(ET.SubElement(cpu, "numa"), "cell", id="0", cpus=cell_cpus, memory=str(memory), unit="KiB")
+
+    devices = ET.SubElement(domain, "devices")
+    disk = ET.SubElement(devices, "disk", type="file", device="disk")
+    driver = ET.SubElement(disk, "driver", name="qemu", type="qcow2")
+    if profile.disk_cache:
+        driver.set("cache", profile.disk_cache)
+    if profile.disk_io:
+        driver.set("io", profile.disk_io)
+    if profile.iothreads:
+        driver.set("iothread", "1")
+    ET.SubElement(disk, "source", file=disk_path)
+    ET.SubElement(disk, "target", dev="vda", bus="virtio")
+
+    interface = ET.SubElement(devices, "interface", type="network")
+    ET.SubElement(interface, "source", network=VM_NETWORK)
+    ET.SubElement(interface, "model", type="virtio")
+    queues = min(cpus, MAX_NET_QUEUES) if profile.multiqueue else 1
+    if queues > 1:
+        ET.SubElement(interface, "driver", name="vhost", queues=str(queues))
+    return domain
+
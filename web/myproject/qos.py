@@ -0,0 +1,156 @@
+from typing import Any, Dict, List
+
+import libvirt
+
+from .domxml import parse_domain_xml
+
+# setBlockIoTune parameters: limits per second, their burst ceilings and burst lengths in seconds.
+BLOCK_LIMITS = tuple(f"{scope}_{unit}_sec" for unit in ("iops", "bytes") for scope in ("total", "read", "write"))
+BLOCK_FIELDS = (
+    BLOCK_LIMITS
+    + tuple(f"{limit}_max" for limit in BLOCK_LIMITS)
+    + tuple(f"{limit}_max_length" for limit in BLOCK_LIMITS)
+)
+# setInterfaceParameters parameters per direction: average and peak in KiB/s, burst in KiB.
+NET_FIELDS = ("average", "peak", "burst")
+NET_DIRECTIONS = ("inbound", "outbound")
+
+
+def _non_negative(value: Any, key: str) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(f"{key} must be a non-negative integer")
+    return value
+
+
+def validate_qos(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Check a QoS setting such as ``{"block": {"total_iops_sec": 500, "total_iops_sec_max": 2000},
+    "network": {"inbound": {"average": 10240}}}``.
+
+    Either part may be left out; limits that are not given are removed (0 means unlimited).
+
+    :return: The setting with only known keys.
+    :raises ValueError: Describing the first invalid value.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("QoS settings must be an object")
+    settings: Dict[str, Any] = {}
+    block = data.get("block")
+    if block is not None:
+        if not isinstance(block, dict) or set(block) - set(BLOCK_FIELDS):
+            raise ValueError(f"block may only set {', '.join(BLOCK_FIELDS)}")
+        block = {key: _non_negative(value, key) for key, value in block.items()}
+        for unit in ("iops", "bytes"):
+            if block.get(f"total_{unit}_sec") and (block.get(f"read_{unit}_sec") or block.get(f"write_{unit}_sec")):
+                raise ValueError(f"total_{unit}_sec cannot be combined with read_{unit}_sec or write_{unit}_sec")
+        for limit in BLOCK_LIMITS:
+            if (block.get(f"{limit}_max") or block.get(f"{limit}_max_length")) and not block.get(limit):
+                raise ValueError(f"A burst for {limit} needs {limit} itself")
+        settings["block"] = block
+    network = data.get("network")
+    if network is not None:
+        if not isinstance(network, dict) or set(network) - set(NET_DIRECTIONS):
+            raise ValueError(f"network may only set {' and '.join(NET_DIRECTIONS)}")
+        settings["network"] = {}
+        for direction, limits in network.items():
+            if not isinstance(limits, dict) or set(limits) - set(NET_FIELDS):
+                raise ValueError(f"network.{direction} may only set {', '.join(NET_FIELDS)}")
+            settings["network"][direction] = {
+                key: _non_negative(value, f"network.{direction}.{key}") for key, value in limits.items()
+            }
+    if not settings:
+        raise ValueError("Give block and/or network settings")
+    return settings
+
+
+def _apply_flags(domain: libvirt.virDomain) -> int:
+    # Running domains change now, persistent ones also keep the change across restarts.
+    flags = 0
+    if domain.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    if domain.isPersistent():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    return flags
+
+
+class QosError(Exception):
+    """
+    A limit was rejected after others had already been applied.
+
+    ``result`` is the ``apply_qos`` report of the devices changed so far, with the device
+    that failed and its error under ``failed``.
+    """
+
+    def __init__(self, message: str, result: Dict[str, Any]):
+        super().__init__(message)
+        self.result = result
+
+
+def apply_qos(conn: libvirt.virConnect, name: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Apply a validated QoS setting to every disk and network interface of a VM.
+
+    libvirt can only check a limit by applying it, so devices are changed one at a time
+    and a rejection stops at the device it happened on.
+
+    :return: The devices changed.
+    :raises libvirt.libvirtError: If libvirt rejects a limit before any device was changed.
+    :raises QosError: If libvirt rejects a limit after some devices were changed.
+    """
+    domain = conn.lookupByName(name)
+    flags = _apply_flags(domain)
+    description = parse_domain_xml(domain.XMLDesc(0))
+    disks: List[str] = []
+    interfaces: List[str] = []
+    live = bool(flags & libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    result: Dict[str, Any] = {"vm": name, "disks": disks, "interfaces": interfaces, "live": live}
+    device = None
+    try:
+        if "block" in settings:
+            params = {key: settings["block"].get(key, 0) for key in BLOCK_FIELDS}
+            # libvirt rejects burst lengths without a burst, so unset ones are left out entirely
+            params = {key: value for key, value in params.items() if value or not key.endswith("_max_length")}
+            for disk in description.disks:
+                if disk["target"]:
+                    device = disk["target"]
+                    domain.setBlockIoTune(device, params, flags)
+                    disks.append(device)
+        if "network" in settings:
+            params = {
+                f"{direction}.{key}": settings["network"].get(direction, {}).get(key, 0)
+                for direction in NET_DIRECTIONS
+                for key in NET_FIELDS
+            }
+            for nic in description.nics:
+                if nic["mac"]:
+                    device = nic["mac"]
+                    domain.setInterfaceParameters(device, params, flags)
+                    interfaces.append(device)
+    except libvirt.libvirtError as e:
+        if not disks and not interfaces:
+            raise
+        result["failed"] = {"device": device, "error": str(e)}
+        raise QosError(f"Could not limit {device}: {e}; {', '.join(disks + interfaces)} already changed", result) from e
+    return result
+
+
+def read_qos(conn: libvirt.virConnect, name: str) -> Dict[str, Any]:
+    """
+    Read the limits currently in effect on each disk and network interface of a VM.
+    """
+    domain = conn.lookupByName(name)
+    description = parse_domain_xml(domain.XMLDesc(0))
+    disks = {}
+    for disk in description.disks:
+        if disk["target"]:
+            tune = domain.blockIoTune(disk["target"], libvirt.VIR_DOMAIN_AFFECT_CURRENT)
+            disks[disk["target"]] = {key: tune.get(key, 0) for key in BLOCK_FIELDS}
+    interfaces = {}
+    for nic in description.nics:
+        if nic["mac"]:
+            parameters = domain.interfaceParameters(nic["mac"], libvirt.VIR_DOMAIN_AFFECT_CURRENT)
+            interfaces[nic["mac"]] = {
+                direction: {key: parameters.get(f"{direction}.{key}", 0) for key in NET_FIELDS}
+                for direction in NET_DIRECTIONS
+            }
+    return {"vm": name, "disks": disks, "interfaces": interfaces}
@@ -0,0 +1,161 @@
+"""
+Live vCPU and memory scaling of existing VMs.
+
+A running VM is changed in place as far as it allows: vCPUs are hot-plugged up to its
+maximum, memory is ballooned up to its maximum and beyond that added as DIMMs when the VM
+has free memory slots. Whatever cannot be done live is written to the configuration of a
+persistent VM and reported as needing a restart.
+"""
+import os
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, Optional
+
+import libvirt
+
+# DIMMs are sized in multiples of this many KiB, the hot-plug granularity of x86 guests.
+DIMM_ALIGNMENT = int(os.getenv("VM_DIMM_ALIGNMENT", str(128 * 1024)))
+
+
+def _flags(live: bool, persistent: bool) -> int:
+    flags = libvirt.VIR_DOMAIN_AFFECT_LIVE if live else 0
+    if persistent:
+        flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    return flags
+
+
+def _change(requested: int, method: str, live: Optional[int], config: Optional[int], restart: bool) -> Dict[str, Any]:
+    return {"requested": requested, "method": method, "live": live, "config": config, "restart_required": restart}
+
+
+def resize_vcpus(domain: libvirt.virDomain, cpus: int) -> Dict[str, Any]:
+    """
+    Set the vCPU count of a VM.
+
+    :return: How the change was made, the live and configured counts afterwards, and
+        whether a restart is needed for the VM to run with ``cpus``.
+    :raises ValueError: If a running transient VM would need more than its maximum.
+    :raises libvirt.libvirtError: If libvirt or the guest refuses the change.
+    """
+    persistent = bool(domain.isPersistent())
+    if not domain.isActive():
+        if cpus > domain.vcpusFlags(libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_VCPU_MAXIMUM):
+            domain.setVcpusFlags(cpus, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+        domain.setVcpusFlags(cpus, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        return _change(cpus, "config", None, cpus, False)
+
+    maximum = domain.vcpusFlags(libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+    if cpus <= maximum:
+        domain.setVcpusFlags(cpus, _flags(True, persistent))
+        return _change(cpus, "hotplug", cpus, cpus if persistent else None, False)
+    if not persistent:
+        raise ValueError(f"{domain.name()} can run at most {maximum} vCPUs and is transient, so it cannot be raised")
+    # Plug in what the running guest allows now and raise the maximum for the next start
+    domain.setVcpusFlags(maximum, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    domain.setVcpusFlags(cpus, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+    domain.setVcpusFlags(cpus, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+    return _change(cpus, "config", maximum, cpus, True)
+
+
+def dimm_room(xml: str, maximum: int) -> int:
+    """
+    KiB that can still be hot-plugged as DIMMs, given the current maximum memory in KiB.
+
+    Domains without ``<maxMemory>`` or without a free slot have no room.
+    """
+    root = ET.fromstring(xml)
+    max_memory = root.find("maxMemory")
+    if max_memory is None:
+        return 0
+    dimms = len(root.findall("devices/memory"))
+    if dimms >= int(max_memory.get("slots", "0")):
+        return 0
+    return max(0, int(max_memory.text) - maximum)
+
+
+def dimm_xml(size: int) -> str:
+    """
+    Describe a DIMM of ``size`` KiB on guest NUMA cell 0.
+    """
+    memory = ET.Element("memory", model="dimm")
+    target = ET.SubElement(memory, "target")
+    ET.SubElement(target, "size", unit="KiB").text = str(size)
+    ET.SubElement(target, "node").text = "0"
+    return ET.tostring(memory, encoding="unicode")
+
+
+def resize_memory(domain: libvirt.virDomain, memory: int) -> Dict[str, Any]:
+    """
+    Set the memory of a VM, in KiB.
+
+    Up to the VM's maximum memory the balloon is moved. Above it a DIMM rounded up to
+    ``DIMM_ALIGNMENT`` is hot-plugged when the VM has room, and the balloon trims the
+    rounding off again.
+
+    :return: How the change was made, the live and configured sizes afterwards, and
+        whether a restart is needed for the VM to run with ``memory``.
+    :raises ValueError: If a running transient VM would need more than it can hot-plug.
+    :raises libvirt.libvirtError: If libvirt or the guest refuses the change.
+    """
+    persistent = bool(domain.isPersistent())
+    if not domain.isActive():
+        if memory > domain.maxMemory():
+            domain.setMemoryFlags(memory, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_MEM_MAXIMUM)
+        domain.setMemoryFlags(memory, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        return _change(memory, "config", None, memory, False)
+
+    maximum = domain.maxMemory()
+    if memory <= maximum:
+        domain.setMemoryFlags(memory, _flags(True, persistent))
+        return _change(memory, "balloon", memory, memory if persistent else None, False)
+
+    size = -(-(memory - maximum) // DIMM_ALIGNMENT) * DIMM_ALIGNMENT
+    if size <= dimm_room(domain.XMLDesc(0), maximum):
+        domain.attachDeviceFlags(dimm_xml(size), _flags(True, persistent))
+        domain.setMemoryFlags(memory, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+        return _change(memory, "dimm", memory, maximum + size if persistent else None, False)
+    if not persistent:
+        raise ValueError(f"{domain.name()} can run with at most {maximum} KiB and is transient, so it cannot be raised")
+    domain.setMemoryFlags(maximum, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    domain.setMemoryFlags(memory, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_MEM_MAXIMUM)
+    domain.setMemoryFlags(memory, libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+    return _change(memory, "config", maximum, memory, True)
+
+
+class ResizeError(Exception):
+    """
+    The memory change failed after the vCPU change was made.
+
+    ``result`` is the ``resize`` report with the vCPU outcome and the memory error under ``failed``.
+    """
+
+    def __init__(self, message: str, result: Dict[str, Any]):
+        super().__init__(message)
+        self.result = result
+
+
+def resize(
+    conn: libvirt.virConnect, name: str, cpus: Optional[int] = None, memory: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Scale a VM's vCPUs and/or memory, live where possible.
+
+    :param memory: Memory in KiB.
+    :return: The outcome of each change and whether any of them needs a restart.
+    :raises ValueError, libvirt.libvirtError: If the first change fails, so nothing was changed.
+    :raises ResizeError: If the memory change fails after the vCPUs were changed.
+    """
+    domain = conn.lookupByName(name)
+    result: Dict[str, Any] = {"vm": name}
+    if cpus is not None:
+        result["cpus"] = resize_vcpus(domain, cpus)
+    if memory is not None:
+        try:
+            result["memory"] = resize_memory(domain, memory)
+        except (ValueError, libvirt.libvirtError) as e:
+            if "cpus" not in result:
+                raise
+            result["failed"] = {"change": "memory", "requested": memory, "error": str(e)}
+            result["restart_required"] = result["cpus"]["restart_required"]
+            raise ResizeError(f"vCPUs were changed, but memory could not be: {e}", result) from e
+    result["restart_required"] = any(result[key]["restart_required"] for key in ("cpus", "memory") if key in result)
+    return result
@@ -0,0 +1,218 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Set
+
+import libvirt
+
+from .batch import run_batch
+from .snapshots import SnapshotInfo, list_snapshot_infos, snapshot_info_cache
+from .vmcache import get_inventory_cache
+
+logger = logging.getLogger(__name__)
+
+# VMs pruned at once by a bulk prune. Snapshots of one VM are always deleted one at a time,
+# since libvirt serializes snapshot jobs per domain anyway.
+RETENTION_CONCURRENCY = int(os.getenv("RETENTION_CONCURRENCY", "4"))
+
+_RULES = ("keep_last", "keep_daily", "keep_weekly", "max_age_days")
+
+
+class RetentionPolicy:
+    """
+    Which snapshots of a VM to keep.
+
+    Snapshots kept by any of ``keep_last`` (the newest N), ``keep_daily`` (the newest of each
+    of the last N days that have one) and ``keep_weekly`` (likewise per ISO week) survive;
+    if none of these is set every snapshot survives. ``max_age_days`` then drops survivors
+    older than that. Only snapshots whose name starts with ``prefix`` are considered, and the
+    current snapshot is never deleted.
+    """
+
+    __slots__ = ("prefix",) + _RULES
+
+    def __init__(
+        self,
+        keep_last: Optional[int] = None,
+        keep_daily: Optional[int] = None,
+        keep_weekly: Optional[int] = None,
+        max_age_days: Optional[int] = None,
+        prefix: str = "",
+    ):
+        self.keep_last = keep_last
+        self.keep_daily = keep_daily
+        self.keep_weekly = keep_weekly
+        self.max_age_days = max_age_days
+        self.prefix = prefix
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RetentionPolicy":
+        """
+        Build a policy from a request body or a stored row.
+
+        :raises ValueError: If a rule is not a positive integer or no rule is set.
+        """
+        rules = {}
+        for key in _RULES:
+            value = data.get(key)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+                raise ValueError(f"{key} must be a positive integer")
+            rules[key] = value
+        if all(value is None for value in rules.values()):
+            raise ValueError(f"At least one of {', '.join(_RULES)} is required")
+        prefix = data.get("prefix") or ""
+        if not isinstance(prefix, str):
+            raise ValueError("prefix must be a string")
+        return cls(prefix=prefix, **rules)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def select(self, snapshots: List[SnapshotInfo], now: Optional[datetime] = None) -> List[SnapshotInfo]:
+        """
+        Compute the snapshots this policy deletes.
+
+        :param snapshots: Every snapshot of the VM.
+        :param now: The time ``max_age_days`` counts back from. Defaults to now.
+        :return: The snapshots to delete, newest first.
+        """
+        candidates = [snapshot for snapshot in snapshots if snapshot.name.startswith(self.prefix)]
+        candidates.sort(key=lambda snapshot: snapshot.created_at or datetime.min, reverse=True)
+
+        if self.keep_last is None and self.keep_daily is None and self.keep_weekly is None:
+            keep = {snapshot.name for snapshot in candidates}
+        else:
+            keep = {snapshot.name for snapshot in candidates[: self.keep_last or 0]}
+            keep |= _newest_per(candidates, lambda moment: moment.date(), self.keep_daily)
+            keep |= _newest_per(candidates, lambda moment: moment.isocalendar()[:2], self.keep_weekly)
+        if self.max_age_days is not None:
+            cutoff = (now or datetime.now()) - timedelta(days=self.max_age_days)
+            keep -= {snapshot.name for snapshot in candidates if snapshot.created_at and snapshot.created_at < cutoff}
+        return [snapshot for snapshot in candidates if snapshot.name not in keep and not snapshot.current]
+
+
+def _newest_per(
+    snapshots: List[SnapshotInfo], bucket: Callable[[datetime], Hashable], count: Optional[int]
+) -> Set[str]:
+    # ``snapshots`` is sorted newest first, so the first one seen in a bucket is its newest.
+    kept: Dict[Hashable, str] = {}
+    for snapshot in snapshots:
+        if not count or len(kept) >= count:
+            break
+        if snapshot.created_at is None:
+            continue
+        kept.setdefault(bucket(snapshot.created_at), snapshot.name)
+    return set(kept.values())
+
+
+def _deletion_order(snapshots: List[SnapshotInfo], doomed: List[SnapshotInfo]) -> List[SnapshotInfo]:
+    # Delete children before their parents so each deletion only merges into a snapshot
+    # that is still there, and the tree stays consistent if a deletion fails halfway.
+    parents = {snapshot.name: snapshot.parent for snapshot in snapshots}
+
+    def depth(name: Optional[str]) -> int:
+        levels = 0
+        while name is not None and levels <= len(parents):
+            name = parents.get(name)
+            levels += 1
+        return levels
+
+    return sorted(doomed, key=lambda snapshot: depth(snapshot.name), reverse=True)
+
+
+class RetentionEngine:
+    """
+    Applies retention policies and keeps totals of what they deleted.
+    """
+
+    def __init__(self, concurrency: int = RETENTION_CONCURRENCY):
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._metrics = {
+            "runs": 0,
+            "dry_runs": 0,
+            "snapshots_deleted": 0,
+            "delete_errors": 0,
+            "last_run_at": None,
+        }
+
+    def prune(
+        self,
+        conn: libvirt.virConnect,
+        name: str,
+        policy: RetentionPolicy,
+        dry_run: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Delete the snapshots of a VM that its policy does not keep.
+
+        External snapshots are reported as skipped rather than deleted. Only snapshot counts are
+        reported: internal snapshots live inside the qcow2 image, which does not shrink on the
+        host when they are deleted, so there is no byte figure to give.
+
+        :param conn: The libvirt connection.
+        :param name: The VM.
+        :param policy: The retention policy.
+        :param dry_run: Only report what would be deleted.
+        :return: The snapshots kept, deleted (or to delete), skipped and failed.
+        """
+        domain = conn.lookupByName(name)
+        snapshots = list_snapshot_infos(domain)
+        doomed = policy.select(snapshots)
+        deletable = [snapshot for snapshot in doomed if not snapshot.external]
+        result: Dict[str, Any] = {
+            "vm": name,
+            "dry_run": dry_run,
+            "policy": policy.as_dict(),
+            "kept": len(snapshots) - len(doomed),
+            "skipped": [snapshot.name for snapshot in doomed if snapshot.external],
+        }
+        if dry_run:
+            result["delete"] = [snapshot.name for snapshot in deletable]
+            self._record(dry_run=True)
+            return result
+
+        deleted, errors = [], {}
+        for snapshot in _deletion_order(snapshots, deletable):
+            try:
+                domain.snapshotLookupByName(snapshot.name, 0).delete(0)
+                snapshot_info_cache.discard(domain.UUIDString())
+                deleted.append(snapshot.name)
+            except libvirt.libvirtError as e:
+                logger.warning(f"Could not delete snapshot {snapshot.name} of {name}: {e}")
+                errors[snapshot.name] = str(e)
+        if deleted:
+            get_inventory_cache().invalidate(name)
+
+        result.update(deleted=deleted, errors=errors)
+        self._record(deleted=len(deleted), errors=len(errors))
+        return result
+
+    def prune_many(self, policies: Dict[str, RetentionPolicy], dry_run: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Prune many VMs as background jobs, ``concurrency`` VMs at a time.
+
+        :return: An iterator of ``run_batch`` results whose ``result`` is the ``prune`` report.
+        """
+        return run_batch(
+            list(policies),
+            "prune_snapshots",
+            lambda conn, name: self.prune(conn, name, policies[name], dry_run),
+            parallelism=self.concurrency,
+        )
+
+    def _record(self, dry_run: bool = False, deleted: int = 0, errors: int = 0) -> None:
+        with self._lock:
+            self._metrics["dry_runs" if dry_run else "runs"] += 1
+            self._metrics["snapshots_deleted"] += deleted
+            self._metrics["delete_errors"] += errors
+            self._metrics["last_run_at"] = time.time()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._metrics)
+
+
+retention_engine = RetentionEngine()
@@ -1,10 +1,12 @@
+import json
+import math
 import os
+import time
 import xml.etree.ElementTree as ET
 
 import libvirt
-from crontab import CronTab
 from flask import Flask
-from flask import jsonify, request, send_from_directory
+from flask import Response, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 from flask_socketio import SocketIO
 
@@ -12,24 +14,46 @@ from dotenv import load_dotenv
 import os
 import mysql.connector
 from mysql.connector import Error
-from . import app, db
-from .models import User
+from . import app, db, socketio, tracing
+from .batch import batch_parallelism, run_batch, select_domains
+from .broadcast import HOST_ID, host_room, vm_room
+from .changelog import change_log
+from .domxml import description_cache, parse_domain_xml
+from .exporter import metrics_exporter
+from .httpcache import cached_json_response
+from .inventory import vm_summary
+from .jobs import JOB_WORKERS, job_queue
+from .leader import leader_lease
+from .models import QosClass, SnapshotRetention, SnapshotSchedule, User, VMTemplate
+from .pool import get_pool, is_connection_error, pool_metrics, set_instrumentation
+from .placement import NUMA_PLACEMENT, placement_engine
+from .profiles import PROFILES, domain_element, get_profile, validate_cpus, validate_memory, validate_resources
+from .qos import apply_qos, read_qos, validate_qos
+from .resources import resize
+from .retention import RetentionPolicy, retention_engine
+from .snapshots import list_snapshot_infos, snapshot_disk_size, snapshot_info_cache
+from .scheduler import SNAPSHOT_SCHEDULER, SnapshotScheduler, validate_schedule
+from .templates import (
+    TEMPLATE_MAX_INSTANCES,
+    TEMPLATE_STORAGE_POOL,
+    delete_overlay,
+    free_names,
+    inspect_image,
+    instantiate,
+    instantiate_many,
+)
+from .telemetry import TELEMETRY_HISTORY, TELEMETRY_INTERVAL, get_telemetry_sampler
+from .timeseries import TIERS, get_timeseries_store
+from .vmcache import get_inventory_cache
+
+set_instrumentation(tracing)
+get_inventory_cache().add_listener(change_log.record)
+leader_lease.on_acquire(lambda: change_log.publish(get_inventory_cache().list_vms))
 
 
 def extract_os_from_metadata(xml_desc):
     try:
-        # Parse the XML
-        root = ET.fromstring(xml_desc)
-
-        # Find the OS ID in the metadata
-        namespace = {"libosinfo": "http://libosinfo.org/xmlns/libvirt/domain/1.0"}
-        os_info = root.find(".//libosinfo:os", namespace)
-
-        if os_info is not None:
-            os_id = os_info.get("id", "Unknown OS")
-            return os_id
-        else:
-            return "Unknown OS"
+        return parse_domain_xml(xml_desc).os_id
     except ET.ParseError as e:
         print(f"XML Parse Error: {e}")
         return "Unknown OS"
@@ -46,13 +70,83 @@ def serve_static(path):
 
 
 def get_libvirt_connection():
+    pool = get_pool()
     try:
-        return libvirt.open("qemu:///system")
-    except libvirt.libvirtError as e:
-        print(f"Failed to open connection to qemu:///system: {e}")
+        return pool.acquire()
+    except (libvirt.libvirtError, TimeoutError) as e:
+        print(f"Failed to get connection to {pool.uri}: {e}")
         return None
 
 
+def release_libvirt_connection(conn, discard=False):
+    """
+    Give a connection back to the pool, closing it instead if ``discard`` is set, as it
+    should be after a libvirt error for which ``is_connection_error`` holds.
+    """
+    get_pool().release(conn, discard=discard)
+
+
+@app.before_request
+def start_background_services():
+    # Also covers servers without a uWSGI postfork hook; only one process becomes the leader.
+    leader_lease.try_acquire()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    tracing.start_trace(f"{request.method} {route}", path=request.path)
+
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics_exporter.requests.observe(route, request.method, response.status_code, time.perf_counter() - started)
+    trace = tracing.current_trace()
+    if trace is not None:
+        trace.root.attributes["status"] = response.status_code
+        tracing.end_trace()
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@app.teardown_request
+def end_request_trace(error):
+    # Requests that never reached after_request still log and export their trace.
+    tracing.end_trace()
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics_exporter.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/api/host/topology", methods=["GET"])
+def host_topology():
+    """
+    The host's NUMA cells with the VM pinned to each CPU and the free memory of each cell.
+    """
+    conn = get_libvirt_connection()
+    if not conn:
+        return jsonify({"error": "Could not connect to libvirt"}), 500
+    discard = False
+    try:
+        return jsonify({"placement": NUMA_PLACEMENT, **placement_engine.report(conn)})
+    except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        release_libvirt_connection(conn, discard)
+
+
+@app.route("/api/libvirt/pool", methods=["GET"])
+def libvirt_pool_metrics():
+    return jsonify({"pools": pool_metrics()})
+
+
 @app.route("/api/login", methods=["POST"])
 def login():
     data = request.json
@@ -72,193 +166,455 @@ def logout():
     return jsonify({"message": "Logout successful"}), 200
 
 
+def wants_refresh():
+    """
+    Tell whether the request asked to bypass the inventory cache with ``?refresh=1``.
+    """
+    return request.args.get("refresh", "").lower() in ("1", "true", "yes")
+
+
 @app.route("/api/vms", methods=["GET"])
 def list_vms():
-    conn = get_libvirt_connection()
-    if not conn:
+    cache = get_inventory_cache()
+    # Read before loading, so a change made while loading renders the body again next time
+    generation = cache.generation
+    try:
+        vms = cache.list_vms(refresh=wants_refresh())
+    except TimeoutError:
         return jsonify({"error": "Could not connect to libvirt"}), 500
+    except libvirt.libvirtError as e:
+        return jsonify({"error": str(e)}), 500
 
+    if not vms:
+        return jsonify({"message": "No VMs found"}), 404
+    return cached_json_response("vms", generation, lambda: {"vms": vms})
+
+
+@app.route("/api/vms/changes", methods=["GET"])
+def vm_changes():
+    """
+    VMs added, changed or removed since ``cursor``.
+
+    Without a cursor, or with one the log cannot continue from, the whole inventory is
+    returned as ``changed`` with ``reset`` set, and the client should replace its copy.
+    Either way the response carries the cursor to send next time. Every worker on a host
+    serves the log the leader publishes, so polls need no sticky routing between workers.
+    Each host keeps its own log though: behind a balancer over several hosts, route a
+    client's polls to one host, or it gets a reset whenever it lands on another. The
+    cursor is null until a leader has published a log.
+    """
+    cache = get_inventory_cache()
+    # The cursor is taken first, so changes made while listing are delivered again rather than lost
+    cursor = change_log.cursor
+    since = request.args.get("since")
     try:
-        domains = conn.listAllDomains()
-        dom = conn.listAllDomains(2)
-        dom.append(domains)
-        if not domains:
-            return jsonify({"message": "No VMs found"}), 404
-
-        vms = []
-        for domain in domains:
-            # xml_desc = domain.XMLDesc()
-            # root = ET.fromstring(xml_desc)
-
-            # # Extract VM OS from the metadata
-            # vm_os = extract_os_from_metadata(xml_desc)
-            # disks = root.findall("devices/disk")
-            disk_info = []
-            cdrom_info = []
-
-            # for disk in disks:
-            #     disk_target = disk.find("target").get("dev")
-            #     source = disk.find("source")
-            #     if source is not None:
-            #         disk_location = source.get("file")
-            #     else:
-            #         disk_location = None
-
-            #     # Determine if it's a disk or a CD-ROM
-            #     if disk.get("device") == "cdrom":
-            #         cdrom_info.append(
-            #             {
-            #                 "target": disk_target,
-            #                 "location": disk_location,
-            #             }
-            #         )
-            #     else:
-            #         disk_info.append({"location": disk_location, "target": disk_target})
-
-            # sizes = domain.blockInfo(disk_target)
-            vm_info = {
-                "name": domain.name(),
-                "id": domain.ID(),
-                "state": domain.state()[0],
-                "uuid": domain.UUIDString(),
-                # "vm_os": vm_os,
-                "max_memory": domain.maxMemory(),
-                "memory": domain.info()[2],  # Memory in use
-                "vcpus": domain.info()[3],  # Number of virtual CPUs
-                "autostart": domain.autostart(),
-                # "disk_capacity": sizes[0],
-                # "disks": disk_info,
-                # "cdroms": cdrom_info,
-            }
-            vms.append(vm_info)
-
-        # Return the collected VMs outside the loop
-        return jsonify({"vms": vms})
+        # Also keeps the cache, and so the log, connected and current
+        vms = cache.list_vms(refresh=wants_refresh())
+    except TimeoutError:
+        return jsonify({"error": "Could not connect to libvirt"}), 500
     except libvirt.libvirtError as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
-            
 
+    changes = change_log.since(since) if since else None
+    if changes is None:
+        return jsonify({"cursor": cursor, "reset": True, "changed": vms, "removed": []})
+    changed, cursor = changes
+    return jsonify(
+        {
+            "cursor": cursor,
+            "reset": False,
+            "changed": [vm for vm in changed.values() if vm is not None],
+            "removed": [name for name, vm in changed.items() if vm is None],
+        }
+    )
+
+
+def load_vm_details(conn, name):
+    domain = conn.lookupByName(name)
+    # The XML is only fetched and parsed again when its configuration generation changed
+    description = description_cache.get(domain, get_inventory_cache().config_generation(name))
+    vm_details = vm_summary(domain)
+    vm_details.update(description.as_dict())
+    return vm_details
 
 
 @app.route("/api/vms/<name>/", methods=["GET"])
 def details_vm(name):
-    conn = get_libvirt_connection()
-    if not conn:
-        return jsonify({"error": "Could not connect to libvirt"}), 500
-
+    cache = get_inventory_cache()
     try:
-        domain = conn.lookupByName(name)
-        xml_desc = domain.XMLDesc()
-        root = ET.fromstring(xml_desc)
-        os_type = domain.OSType()
-        # Extract VM OS from the metadata
-        vm_os = extract_os_from_metadata(xml_desc)
-        # Parse disk information
-        disks = root.findall("devices/disk")
-        disk_info = []
-        cdrom_info = []
-        print(os_type)
-        for disk in disks:
-            disk_target = disk.find("target").get("dev")
-            source = disk.find("source")
-            if source is not None:
-                disk_location = source.get("file")
-            else:
-                disk_location = None
-
-            # Determine if it's a disk or a CD-ROM
-            if disk.get("device") == "cdrom":
-                cdrom_info.append(
-                    {
-                        "target": disk_target,
-                        "location": disk_location,
-                    }
-                )
-            else:
-                disk_info.append({"location": disk_location, "target": disk_target})
-
-        vm_details = {
-            "name": domain.name(),
-            "id": domain.ID(),
-            "state": domain.state()[0],
-            "uuid": domain.UUIDString(),
-            "vm_os": vm_os,
-            "max_memory": domain.maxMemory(),
-            "memory": domain.info()[2],  # Memory in use
-            "vcpus": domain.info()[3],  # Number of virtual CPUs
-            "autostart": domain.autostart(),
-            "disks": disk_info,
-            "cdroms": cdrom_info,
-        }
-
-        return jsonify(vm_details), 200
+        # Keyed on the view's own version: it is also reloaded after max_age without any event
+        version, vm_details = cache.versioned_domain_view("details", name, load_vm_details, refresh=wants_refresh())
+        return cached_json_response(("details", name), version, lambda: vm_details)
+    except TimeoutError:
+        return jsonify({"error": "Could not connect to libvirt"}), 500
     except libvirt.libvirtError as e:
         return jsonify({"error": f"VM not found: {str(e)}"}), 404
-    finally:
-        if conn is not None:
-            conn.close()
 
 
-@app.route("/api/vms/<name>/", methods=["DELETE"])
-def delete_vm(name):
-    conn = get_libvirt_connection()
-    if not conn:
-        return jsonify({"error": "Could not connect to libvirt"}), 500
+def emit_vm_metrics(latest):
+    socketio.emit("vm_metrics", {"host": HOST_ID, "vms": latest}, to=host_room())
+    for name, sample in latest.items():
+        socketio.emit("vm_metrics", {"host": HOST_ID, "vms": {name: sample}}, to=vm_room(name))
+
+
+get_telemetry_sampler().add_listener(emit_vm_metrics)
+get_telemetry_sampler().add_listener(get_timeseries_store().record_samples)
+leader_lease.on_acquire(get_telemetry_sampler().start)
+
 
+def history_samples(name, window):
+    """
+    Recent samples of a VM from the finest tier of the time-series store, for the processes
+    that do not run the sampler themselves.
+    """
+    now = time.time()
+    start = now - (window or TELEMETRY_INTERVAL * TELEMETRY_HISTORY)
+    history = get_timeseries_store().query(name, start, now, TIERS[0].name)
+    if not history["times"]:
+        return None
+    return [
+        dict({field: values[index] for field, values in history["fields"].items()}, time=timestamp)
+        for index, timestamp in enumerate(history["times"])
+    ]
+
+
+@app.route("/api/vms/<name>/metrics", methods=["GET"])
+def vm_metrics(name):
+    """
+    Recent CPU, memory, block and network rates of a running VM.
+
+    ``window`` limits the samples to the last that many seconds; by default every kept
+    sample is returned. Only the process running the sampler has every sample; the others
+    answer from the 10 second records of the time-series store.
+    """
+    window = request.args.get("window")
     try:
-        domain = conn.lookupByName(name)
+        window = float(window) if window is not None else None
+    except ValueError:
+        return jsonify({"error": "window must be a number of seconds"}), 400
+
+    if leader_lease.held:
+        samples, interval = get_telemetry_sampler().samples(name, window), TELEMETRY_INTERVAL
+    else:
+        samples, interval = history_samples(name, window), TIERS[0].step
+    if samples is None:
+        return jsonify({"error": f"No metrics for {name}, it is not running or not sampled yet"}), 404
+    return jsonify({"name": name, "interval": interval, "samples": samples})
+
+
+@app.route("/api/vms/<name>/history", methods=["GET"])
+def vm_history(name):
+    """
+    Historical CPU, memory, block and network rates of a VM, one column per field.
+
+    ``start`` and ``end`` are seconds since the epoch and default to the last hour. The
+    resolution is picked from the range unless ``tier`` (``10s``, ``1m`` or ``1h``) is
+    given, and ``fields`` takes a comma-separated subset of the fields.
+    """
+    now = time.time()
+    try:
+        end = float(request.args.get("end", now))
+        start = float(request.args.get("start", end - 3600))
+    except ValueError:
+        return jsonify({"error": "start and end must be seconds since the epoch"}), 400
+    if not (math.isfinite(start) and math.isfinite(end)):
+        return jsonify({"error": "start and end must be finite"}), 400
+    if start > end:
+        return jsonify({"error": "start must not be after end"}), 400
+    fields = [field for field in request.args.get("fields", "").split(",") if field] or None
+
+    try:
+        history = get_timeseries_store().query(name, start, end, tier=request.args.get("tier"), fields=fields)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(dict(history, name=name, start=start, end=end))
+
+
+@app.route("/api/history", methods=["GET"])
+def history_stats():
+    return jsonify(get_timeseries_store().stats())
+
+
+def submit_job(name, action, func, *args):
+    """
+    Run ``func(conn, name, *args)`` as a background job on a pooled connection.
+
+    Jobs borrow from their own pool with a connection per job worker, so long snapshots
+    never leave request handlers, telemetry or the exporter without connections.
+
+    Returns a ``202 Accepted`` response pointing at ``/api/jobs/<id>``.
+    """
+
+    def run():
+        with get_pool(name="jobs", size=JOB_WORKERS).connection() as conn:
+            return func(conn, name, *args)
+
+    job = job_queue.submit(name, action, run)
+    location = f"/api/jobs/{job.id}"
+    return jsonify({"job_id": job.id, "status": job.status, "location": location}), 202, {"Location": location}
+
+
+def emit_job_finished(job):
+    socketio.emit("job_finished", job.as_dict(), to=[host_room(), vm_room(job.vm)])
+
+
+job_queue.add_listener(emit_job_finished)
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job.as_dict())
+
+
+def remove_vm(conn, name):
+    domain = conn.lookupByName(name)
+    xml = domain.XMLDesc(0)
+    # VMs created before they were defined persistently are transient, and gone once destroyed
+    persistent = domain.isPersistent()
+    if domain.isActive():
         domain.destroy()
+    if persistent:
         domain.undefine()
-        return jsonify({"message": f"VM {name} deleted successfully"}), 200
+    result = {"message": f"VM {name} deleted successfully"}
+    try:
+        disk = delete_overlay(conn, name, xml)
     except libvirt.libvirtError as e:
-        return jsonify({"error": str(e)}), 500
+        result["warning"] = f"Could not delete the overlay disk: {e}"
+    else:
+        if disk is not None:
+            result["deleted_disk"] = disk
+    return result
+
+
+@app.route("/api/vms/<name>/", methods=["DELETE"])
+def delete_vm(name):
+    return submit_job(name, "delete_vm", remove_vm)
+
+
+def start_new_vm(conn, name, cpus, memory, options=None, disk_path=None):
+    """
+    Define a VM and boot it.
+
+    The domain is persistent, so a guest shutdown leaves it, and any template overlay, in
+    place until ``DELETE /api/vms/<name>/`` removes both. It is undefined again if it does not
+    boot.
+    """
+    options = options or {}
+    profile = get_profile(options.get("profile"))
+    disk_path = disk_path or f"/var/lib/libvirt/images/{name}.qcow2"
+    max_cpus, max_memory = options.get("max_cpus"), options.get("max_memory")
+    domain = domain_element(name, cpus, memory, disk_path, profile, options.get("hugepages"), max_cpus, max_memory)
+    # Pin every vCPU the VM may be scaled up to, so hot-plugged ones stay on the chosen cell
+    vcpus = max(cpus, max_cpus or 0)
+    placement = placement_engine.place(conn, name, vcpus, memory) if NUMA_PLACEMENT else None
+    try:
+        if placement is not None:
+            placement.apply(domain)
+        defined = conn.defineXML(ET.tostring(domain, encoding="unicode"))
+        try:
+            defined.create()
+        except libvirt.libvirtError:
+            defined.undefine()
+            raise
     finally:
-        conn.close()
+        if placement is not None:
+            placement_engine.release(name)
+    result = {"message": f"VM {name} created successfully", "profile": profile.name}
+    if placement is not None:
+        result["placement"] = placement.as_dict()
+    return result
+
+
+def read_domain_options(data, name, cpus, memory):
+    """
+    Validate the resources, ``profile``, ``hugepages`` override and the ``max_cpus`` and
+    ``max_memory`` hot-plug ceilings of a create request.
+
+    :return: The options to pass to ``start_new_vm``.
+    :raises ValueError: If any of them is invalid.
+    """
+    profile = get_profile(data.get("profile"))
+    hugepages = data.get("hugepages")
+    if hugepages is not None and not isinstance(hugepages, bool):
+        raise ValueError("hugepages must be true or false")
+    validate_resources(name, cpus, memory, data.get("max_cpus"), data.get("max_memory"))
+    return {
+        "profile": profile.name,
+        "hugepages": hugepages,
+        "max_cpus": data.get("max_cpus"),
+        "max_memory": data.get("max_memory"),
+    }
 
 
 @app.route("/api/vms", methods=["POST"])
 def create_vm():
-    conn = get_libvirt_connection()
-    if not conn:
-        return jsonify({"error": "Could not connect to libvirt"}), 500
-
-    vm_data = request.json
+    """
+    Create a VM, from a ``template`` if the body names one.
+
+    ``profile`` picks the machine and device tuning, see ``GET /api/profiles``, and
+    ``hugepages`` overrides the profile's memory backing. ``max_cpus`` and ``max_memory``
+    set how far ``PATCH /api/vms/<name>/resources`` can scale the running VM.
+    """
+    vm_data = request.json or {}
     name = vm_data.get("name")
     cpus = vm_data.get("cpus")
     memory = vm_data.get("memory")  # Expecting memory in KiB
+    if not name:
+        return jsonify({"error": "VM name is required"}), 400
+
+    template = None
+    if vm_data.get("template"):
+        template = VMTemplate.query.filter_by(name=vm_data["template"]).first()
+        if template is None:
+            return jsonify({"error": f"Template {vm_data['template']} not found"}), 404
+        template = template.as_dict()
+        cpus, memory = cpus or template["cpus"], memory or template["memory"]
+    cpus, memory = cpus or 1, memory or 1048576
+    try:
+        options = read_domain_options(vm_data, name, cpus, memory)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if template is not None:
+        return submit_job(name, "create_vm", instantiate, template, start_new_vm, cpus, memory, options)
+    return submit_job(name, "create_vm", start_new_vm, cpus, memory, options)
+
+
+@app.route("/api/profiles", methods=["GET"])
+def list_profiles():
+    profiles = [profile.as_dict() for profile in PROFILES.values()]
+    return jsonify({"default": get_profile(None).name, "profiles": profiles})
+
+
+@app.route("/api/templates", methods=["GET"])
+def list_templates():
+    return jsonify({"templates": [template.as_dict() for template in VMTemplate.query.order_by(VMTemplate.name)]})
+
+
+@app.route("/api/templates", methods=["POST"])
+def register_template():
+    """
+    Register a golden image as a template.
+
+    The body gives the template ``name`` and the ``path`` of an image in a libvirt storage
+    pool, plus optional default ``cpus`` and ``memory`` (KiB) and the ``storage_pool`` the
+    overlays of its VMs are created in. The image must not be written to afterwards.
+    """
+    data = request.json or {}
+    name = data.get("name")
+    path = data.get("path")
+    if not name or not path:
+        return jsonify({"error": "Template name and image path are required"}), 400
+    if VMTemplate.query.filter_by(name=name).first() is not None:
+        return jsonify({"error": f"Template {name} already exists"}), 409
+    for key in ("cpus", "memory"):
+        value = data.get(key)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+            return jsonify({"error": f"{key} must be a positive integer"}), 400
 
+    conn = get_libvirt_connection()
+    if not conn:
+        return jsonify({"error": "Could not connect to libvirt"}), 500
+    discard = False
     try:
-        # Define a new domain (example XML)
-        vm_xml = f"""
-        <domain type='kvm'>
-          <name>{name}</name>
-          <memory>{memory}</memory>
-          <vcpu>{cpus}</vcpu>
-          <os>
-            <type arch='x86_64' machine='pc-i440fx-2.9'>hvm</type>
-          </os>
-          <devices>
-            <disk type='file' device='disk'>
-              <driver name='qemu' type='qcow2'/>
-              <source file='/var/lib/libvirt/images/{name}.qcow2'/>
-              <target dev='vda' bus='virtio'/>
-            </disk>
-            <interface type='network'>
-              <source network='default'/>
-              <model type='virtio'/>
-            </interface>
-          </devices>
-        </domain>
-        """
-        conn.createXML(vm_xml, 0)
-        return jsonify({"message": f"VM {name} created successfully"}), 201
+        image = inspect_image(conn, path)
+        storage_pool = data.get("storage_pool") or TEMPLATE_STORAGE_POOL
+        conn.storagePoolLookupByName(storage_pool)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except libvirt.libvirtError as e:
-        return jsonify({"error": str(e)}), 500
+        discard = is_connection_error(e)
+        return jsonify({"error": str(e)}), 404
     finally:
-        conn.close()
+        release_libvirt_connection(conn, discard)
+
+    template = VMTemplate(
+        name=name,
+        image_path=image["path"],
+        image_format=image["format"],
+        capacity=image["capacity"],
+        storage_pool=storage_pool,
+        cpus=data.get("cpus") or 1,
+        memory=data.get("memory") or 1048576,
+    )
+    db.session.add(template)
+    db.session.commit()
+    return jsonify(template.as_dict()), 201
+
+
+@app.route("/api/templates/<template_name>", methods=["GET"])
+def get_template(template_name):
+    template = VMTemplate.query.filter_by(name=template_name).first()
+    if template is None:
+        return jsonify({"error": f"Template {template_name} not found"}), 404
+    return jsonify(template.as_dict())
+
+
+@app.route("/api/templates/<template_name>", methods=["DELETE"])
+def delete_template(template_name):
+    # Only the registration goes; the image stays, since existing VMs are backed by it.
+    template = VMTemplate.query.filter_by(name=template_name).first()
+    if template is None:
+        return jsonify({"error": f"Template {template_name} not found"}), 404
+    db.session.delete(template)
+    db.session.commit()
+    return jsonify({"message": "Template deleted"})
+
+
+@app.route("/api/templates/<template_name>/instantiate", methods=["POST"])
+def instantiate_template(template_name):
+    """
+    Create ``?count=N`` VMs from a template and stream a JSON line per VM as each is created.
+
+    VMs are named ``<prefix>-<n>`` with the lowest free numbers, where ``prefix`` defaults
+    to the template name. A single VM may instead be given an exact ``name``. ``cpus``,
+    ``memory`` and ``parallelism`` in the body override the defaults, and ``profile``,
+    ``hugepages``, ``max_cpus`` and ``max_memory`` work as for ``POST /api/vms``.
+    """
+    template = VMTemplate.query.filter_by(name=template_name).first()
+    if template is None:
+        return jsonify({"error": f"Template {template_name} not found"}), 404
+    template = template.as_dict()
+    data = request.json or {}
+    try:
+        count = int(request.args.get("count", "1"))
+        parallelism = batch_parallelism(data.get("parallelism"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "count and parallelism must be integers"}), 400
+    if not 1 <= count <= TEMPLATE_MAX_INSTANCES:
+        return jsonify({"error": f"count must be between 1 and {TEMPLATE_MAX_INSTANCES}"}), 400
+    if data.get("name") and count != 1:
+        return jsonify({"error": "An exact name can only be given for a single VM"}), 400
+    cpus = data.get("cpus") or template["cpus"]
+    memory = data.get("memory") or template["memory"]
+    try:
+        # Generated names only differ in their number, so checking one covers them all
+        sample_name = data.get("name") or f"{data.get('prefix') or template_name}-{count}"
+        options = read_domain_options(data, sample_name, cpus, memory)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if data.get("name"):
+        names = [data["name"]]
+    else:
+        conn = get_libvirt_connection()
+        if not conn:
+            return jsonify({"error": "Could not connect to libvirt"}), 500
+        try:
+            names = free_names(conn, template, data.get("prefix") or template_name, count)
+        except libvirt.libvirtError as e:
+            release_libvirt_connection(conn, is_connection_error(e))
+            return jsonify({"error": str(e)}), 500
+        release_libvirt_connection(conn)
+
+    def stream():
+        for result in instantiate_many(names, template, start_new_vm, cpus, memory, options, parallelism=parallelism):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson", headers={"X-Batch-Size": str(len(names))})
 
 
 # Serve the UI
@@ -267,25 +623,91 @@ def serve_ui():
     return send_from_directory(app.static_folder, "index.html")
 
 
-@app.route("/api/vms/<name>/snapshots", methods=["GET"])
-def list_snapshots(name):
-    conn = get_libvirt_connection()
+SNAPSHOT_SORT_KEYS = ("created_at", "name", "state")
+SNAPSHOT_PAGE_SIZE = 100
+SNAPSHOT_MAX_PAGE_SIZE = 1000
+
+
+def load_snapshots(conn, name):
+    domain = conn.lookupByName(name)
+    infos = list_snapshot_infos(domain)
+    children = {}
+    for info in infos:
+        children[info.parent] = children.get(info.parent, 0) + 1
     snapshots = []
-    if not conn:
-        return jsonify({"error": "Could not connect to libvirt"}), 500
+    for info in infos:
+        snapshot = info.as_dict()
+        snapshot["children"] = children.get(info.name, 0)
+        snapshot["disk_files"] = info.disk_files
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def add_snapshot_sizes(snapshots):
+    """
+    Fill in ``disk_size`` for a page of snapshots. Only external snapshots have one, so a
+    connection is only borrowed when the page holds any.
+    """
+    external = [snapshot for snapshot in snapshots if snapshot["disk_files"]]
+    page = [dict(snapshot, disk_size=None) for snapshot in snapshots]
+    if not external:
+        return page
+    with get_pool().connection() as conn:
+        for snapshot in page:
+            if snapshot["disk_files"]:
+                snapshot["disk_size"] = snapshot_disk_size(conn, snapshot["disk_files"])
+    return page
 
+
+@app.route("/api/vms/<name>/snapshots", methods=["GET"])
+def list_snapshots(name):
+    """
+    List the snapshots of a VM with their creation time, state, parent, current flag and size.
+
+    Accepts ``sort`` (``created_at``, ``name`` or ``state``), ``order`` (``asc`` or
+    ``desc``, newest first by default), ``offset`` and ``limit``.
+    """
+    sort = request.args.get("sort", "created_at")
+    order = request.args.get("order", "desc")
+    if sort not in SNAPSHOT_SORT_KEYS or order not in ("asc", "desc"):
+        return jsonify({"error": f"sort must be one of {list(SNAPSHOT_SORT_KEYS)} and order asc or desc"}), 400
     try:
-        domain = conn.lookupByName(name)
-        snapshot = domain.snapshotListNames()
-        for name in snapshot:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = min(SNAPSHOT_MAX_PAGE_SIZE, max(1, int(request.args.get("limit", SNAPSHOT_PAGE_SIZE))))
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
 
-            shots = {"name": name}
-            snapshots.append(shots)
-        return jsonify({"snapshots": snapshots})
+    try:
+        snapshots = get_inventory_cache().domain_view("snapshots", name, load_snapshots, refresh=wants_refresh())
+        ordered = sorted(snapshots, key=lambda snapshot: snapshot[sort] or "", reverse=order == "desc")
+        page = add_snapshot_sizes(ordered[offset : offset + limit])
+    except TimeoutError:
+        return jsonify({"error": "Could not connect to libvirt"}), 500
     except libvirt.libvirtError as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+    return jsonify(
+        {
+            "snapshots": page,
+            "total": len(snapshots),
+            "offset": offset,
+            "limit": limit,
+            "current": next((snapshot["name"] for snapshot in snapshots if snapshot["current"]), None),
+        }
+    )
+
+
+def snapshot_vm(conn, name, snapshot_name):
+    domain = conn.lookupByName(name)
+    xml = f"""
+    <domainsnapshot>
+        <name>{snapshot_name}</name>
+        <description>Snapshot of {name}</description>
+    </domainsnapshot>
+    """
+    domain.snapshotCreateXML(xml, 0)
+    snapshot_info_cache.discard(domain.UUIDString())
+    get_inventory_cache().invalidate(name)
+    return {"message": "Snapshot created successfully"}
 
 
 @app.route("/api/vms/<name>/snapshots", methods=["POST"])
@@ -294,96 +716,390 @@ def create_snapshot(name):
     if not snapshot_name:
         return jsonify({"error": "Snapshot name is required"}), 400
 
-    conn = get_libvirt_connection()
-    if not conn:
-        return jsonify({"error": "Could not connect to libvirt"}), 500
+    return submit_job(name, "create_snapshot", snapshot_vm, snapshot_name)
 
-    try:
-        domain = conn.lookupByName(name)
-        xml = f"""
-        <domainsnapshot>
-            <name>{snapshot_name}</name>
-            <description>Snapshot of {name}</description>
-        </domainsnapshot>
-        """
-        domain.snapshotCreateXML(xml, 0)
-        return jsonify({"message": "Snapshot created successfully"}), 201
-    except libvirt.libvirtError as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+
+def revert_vm(conn, name, snapshot_name):
+    domain = conn.lookupByName(name)
+    snapshot = domain.snapshotLookupByName(snapshot_name)
+    domain.revertToSnapshot(snapshot, 0)
+    get_inventory_cache().invalidate(name)
+    return {"message": "Snapshot restored successfully"}
 
 
 @app.route("/api/vms/<name>/snapshots/<snapshot_name>/restore", methods=["POST"])
 def restore_snapshot(name, snapshot_name):
+    return submit_job(name, "restore_snapshot", revert_vm, snapshot_name)
+
+
+@app.route("/api/vms/<name>/snapshots/<snapshot_name>", methods=["DELETE"])
+def delete_snapshot(name, snapshot_name):
     conn = get_libvirt_connection()
     if not conn:
         return jsonify({"error": "Could not connect to libvirt"}), 500
 
+    discard = False
     try:
         domain = conn.lookupByName(name)
         snapshot = domain.snapshotLookupByName(snapshot_name)
-        domain.revertToSnapshot(snapshot, 0)
-        return jsonify({"message": "Snapshot restored successfully"})
+        snapshot.delete(0)
+        snapshot_info_cache.discard(domain.UUIDString())
+        get_inventory_cache().invalidate(name)
+        return jsonify({"message": "Snapshot deleted successfully"})
     except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
         return jsonify({"error": str(e)}), 500
     finally:
-        conn.close()
+        release_libvirt_connection(conn, discard)
 
 
-@app.route("/api/vms/<name>/snapshots/<snapshot_name>", methods=["DELETE"])
-def delete_snapshot(name, snapshot_name):
+def resize_vm(conn, name, cpus, memory):
+    try:
+        return resize(conn, name, cpus, memory)
+    finally:
+        get_inventory_cache().invalidate(name)
+
+
+@app.route("/api/vms/<name>/resources", methods=["PATCH"])
+def patch_resources(name):
+    """
+    Scale the vCPUs and/or memory (KiB) of a VM, live where the VM allows it, as a job.
+
+    Each change in the job result says how it was made and whether the VM has to be
+    restarted to run with it; ``restart_required`` is set if any of them does. If the
+    memory change fails after the vCPUs were changed, the failed job's result still
+    reports the vCPU change, with the memory error under ``failed``.
+    """
+    data = request.json or {}
+    cpus = data.get("cpus")
+    memory = data.get("memory")
+    if cpus is None and memory is None:
+        return jsonify({"error": "Give cpus and/or memory"}), 400
+    try:
+        if cpus is not None:
+            validate_cpus(cpus)
+        if memory is not None:
+            validate_memory(memory)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return submit_job(name, "resize", resize_vm, cpus, memory)
+
+
+@app.route("/api/vms/<name>/qos", methods=["GET"])
+def get_qos(name):
     conn = get_libvirt_connection()
     if not conn:
         return jsonify({"error": "Could not connect to libvirt"}), 500
+    discard = False
+    try:
+        return jsonify(read_qos(conn, name))
+    except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
+        return jsonify({"error": str(e)}), 404 if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN else 500
+    finally:
+        release_libvirt_connection(conn, discard)
+
+
+def load_qos_settings(data):
+    """
+    The settings of a QoS request body, either of the named ``class`` or given inline.
+
+    :raises LookupError: If the class does not exist.
+    :raises ValueError: If the inline settings are invalid.
+    """
+    if data.get("class"):
+        qos_class = QosClass.query.filter_by(name=data["class"]).first()
+        if qos_class is None:
+            raise LookupError(f"QoS class {data['class']} not found")
+        return json.loads(qos_class.settings)
+    return validate_qos(data)
+
+
+@app.route("/api/vms/<name>/qos", methods=["PUT"])
+def set_qos(name):
+    """
+    Limit the disk and network I/O of a VM, as a job.
+
+    The body is either ``{"class": "<name>"}`` or the settings themselves, see
+    ``qos.validate_qos``. Limits apply to every disk and interface, to the running guest
+    and, for persistent VMs, to its configuration. If libvirt rejects a limit after some
+    devices were changed, the failed job's result lists those and the device that failed.
+    """
+    try:
+        settings = load_qos_settings(request.json or {})
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return submit_job(name, "apply_qos", apply_qos, settings)
+
+
+@app.route("/api/qos/classes", methods=["GET"])
+def list_qos_classes():
+    return jsonify({"classes": [qos_class.as_dict() for qos_class in QosClass.query.order_by(QosClass.name)]})
+
 
+@app.route("/api/qos/classes/<class_name>", methods=["GET"])
+def get_qos_class(class_name):
+    qos_class = QosClass.query.filter_by(name=class_name).first()
+    if qos_class is None:
+        return jsonify({"error": f"QoS class {class_name} not found"}), 404
+    return jsonify(qos_class.as_dict())
+
+
+@app.route("/api/qos/classes/<class_name>", methods=["PUT"])
+def set_qos_class(class_name):
+    # Changing a class does not touch VMs it was applied to; assign it again to update them.
     try:
-        domain = conn.lookupByName(name)
-        snapshot = domain.snapshotLookupByName(snapshot_name)
-        snapshot.delete(0)
-        return jsonify({"message": "Snapshot deleted successfully"})
+        settings = validate_qos(request.json or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    qos_class = QosClass.query.filter_by(name=class_name).first()
+    if qos_class is None:
+        qos_class = QosClass(name=class_name)
+        db.session.add(qos_class)
+    qos_class.settings = json.dumps(settings)
+    db.session.commit()
+    return jsonify(qos_class.as_dict())
+
+
+@app.route("/api/qos/classes/<class_name>", methods=["DELETE"])
+def delete_qos_class(class_name):
+    qos_class = QosClass.query.filter_by(name=class_name).first()
+    if qos_class is None:
+        return jsonify({"error": f"QoS class {class_name} not found"}), 404
+    db.session.delete(qos_class)
+    db.session.commit()
+    return jsonify({"message": "QoS class deleted"})
+
+
+@app.route("/api/qos/classes/<class_name>/assign", methods=["POST"])
+def assign_qos_class(class_name):
+    """
+    Apply a QoS class to many VMs, one job per VM, and stream a JSON line per VM as each
+    finishes.
+
+    VMs are named as for ``POST /api/vms/batch``, by ``"names"`` or a label ``"selector"``.
+    """
+    qos_class = QosClass.query.filter_by(name=class_name).first()
+    if qos_class is None:
+        return jsonify({"error": f"QoS class {class_name} not found"}), 404
+    settings = json.loads(qos_class.settings)
+    data = request.json or {}
+    names = data.get("names")
+    selector = data.get("selector")
+    if bool(names) == bool(selector):
+        return jsonify({"error": "Give either a list of names or a label selector"}), 400
+    if names and not (isinstance(names, list) and all(isinstance(name, str) for name in names)):
+        return jsonify({"error": "names must be a list of VM names"}), 400
+    try:
+        parallelism = batch_parallelism(data.get("parallelism"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "parallelism must be an integer"}), 400
+
+    if selector:
+        conn = get_libvirt_connection()
+        if not conn:
+            return jsonify({"error": "Could not connect to libvirt"}), 500
+        try:
+            names = select_domains(conn, selector)
+        except ValueError as e:
+            release_libvirt_connection(conn)
+            return jsonify({"error": str(e)}), 400
+        except (libvirt.libvirtError, ET.ParseError) as e:
+            release_libvirt_connection(conn, isinstance(e, libvirt.libvirtError) and is_connection_error(e))
+            return jsonify({"error": str(e)}), 500
+        release_libvirt_connection(conn)
+
+    def stream():
+        for result in run_batch(names, "apply_qos", apply_qos, settings, parallelism=parallelism):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson", headers={"X-Batch-Size": str(len(set(names)))})
+
+
+@app.route("/api/vms/<name>/retention", methods=["GET"])
+def get_retention(name):
+    retention = SnapshotRetention.query.filter_by(vm_name=name).first()
+    if retention is None:
+        return jsonify({"error": f"No retention policy for {name}"}), 404
+    return jsonify(retention.as_dict())
+
+
+@app.route("/api/vms/<name>/retention", methods=["PUT"])
+def set_retention(name):
+    try:
+        policy = RetentionPolicy.from_dict(request.json or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    retention = SnapshotRetention.query.filter_by(vm_name=name).first()
+    if retention is None:
+        retention = SnapshotRetention(vm_name=name)
+        db.session.add(retention)
+    for key, value in policy.as_dict().items():
+        setattr(retention, key, value)
+    db.session.commit()
+    return jsonify(retention.as_dict())
+
+
+@app.route("/api/vms/<name>/retention", methods=["DELETE"])
+def delete_retention(name):
+    retention = SnapshotRetention.query.filter_by(vm_name=name).first()
+    if retention is None:
+        return jsonify({"error": f"No retention policy for {name}"}), 404
+    db.session.delete(retention)
+    db.session.commit()
+    return jsonify({"message": "Retention policy deleted"})
+
+
+def prune_vm_snapshots(conn, name, policy, dry_run=False):
+    return retention_engine.prune(conn, name, policy, dry_run)
+
+
+@app.route("/api/vms/<name>/snapshots/prune", methods=["POST"])
+def prune_snapshots(name):
+    """
+    Apply a retention policy to one VM.
+
+    The policy is taken from the body if it sets any rule, otherwise the VM's stored policy
+    is used. ``"dry_run": true`` answers at once with the snapshots that would be deleted;
+    a real prune runs as a background job.
+    """
+    data = request.json or {}
+    try:
+        if any(data.get(key) is not None for key in ("keep_last", "keep_daily", "keep_weekly", "max_age_days")):
+            policy = RetentionPolicy.from_dict(data)
+        else:
+            retention = SnapshotRetention.query.filter_by(vm_name=name).first()
+            if retention is None:
+                return jsonify({"error": f"No retention policy for {name}"}), 404
+            policy = RetentionPolicy.from_dict(retention.as_dict())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not data.get("dry_run"):
+        return submit_job(name, "prune_snapshots", prune_vm_snapshots, policy)
+
+    try:
+        with get_pool().connection() as conn:
+            return jsonify(prune_vm_snapshots(conn, name, policy, dry_run=True))
+    except TimeoutError:
+        return jsonify({"error": "Could not connect to libvirt"}), 500
     except libvirt.libvirtError as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+
+
+@app.route("/api/snapshots/prune", methods=["POST"])
+def prune_all_snapshots():
+    """
+    Apply the stored retention policy of every VM, or of the VMs listed in ``"vms"``, and
+    stream a JSON line per VM as each finishes. Each VM is pruned as a job, so it never
+    overlaps a snapshot or another prune of the same VM. ``"dry_run": true`` deletes nothing.
+    """
+    data = request.json or {}
+    query = SnapshotRetention.query
+    if data.get("vms"):
+        query = query.filter(SnapshotRetention.vm_name.in_(data["vms"]))
+    policies = {}
+    for retention in query.all():
+        try:
+            policies[retention.vm_name] = RetentionPolicy.from_dict(retention.as_dict())
+        except ValueError as e:
+            return jsonify({"error": f"Invalid retention policy for {retention.vm_name}: {e}"}), 500
+
+    def stream():
+        for result in retention_engine.prune_many(policies, dry_run=bool(data.get("dry_run"))):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson", headers={"X-Batch-Size": str(len(policies))})
+
+
+@app.route("/api/snapshots/retention/metrics", methods=["GET"])
+def retention_metrics():
+    return jsonify(retention_engine.metrics())
+
+
+snapshot_scheduler = SnapshotScheduler(app, snapshot_vm)
+if SNAPSHOT_SCHEDULER:
+    leader_lease.on_acquire(snapshot_scheduler.start)
+
+
+@app.route("/api/scheduler", methods=["GET"])
+def list_schedules():
+    vm_name = request.args.get("vm_name")
+    query = SnapshotSchedule.query
+    if vm_name:
+        query = query.filter_by(vm_name=vm_name)
+    return jsonify({"schedules": [schedule.as_dict() for schedule in query.order_by(SnapshotSchedule.id).all()]})
 
 
 @app.route("/api/scheduler", methods=["POST"])
 def schedule_snapshot():
-    data = request.json
-    day = data.get("day", "*")  # Default to every day if not specified
-    interval = data.get("interval", "*/1")  # Default to every minute if not specified
-    vm_name = data.get("vm_name")
-    snapshot_name = data.get("snapshot_name")
-
-    cron = CronTab(user=True)  # Create a cron job for the current user
-    job = cron.new(command=f"python3 /path/to/snapshot.py {vm_name} {snapshot_name}")
-    job.setall(f"{interval} {day} * * *")
-    cron.write()
+    try:
+        fields = validate_schedule(request.json or {})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
+    schedule = SnapshotSchedule(**fields)
+    db.session.add(schedule)
+    db.session.commit()
     return (
-        jsonify({"status": "success", "message": "Scheduled snapshot successfully"}),
-        200,
+        jsonify({"status": "success", "message": "Scheduled snapshot successfully", "schedule": schedule.as_dict()}),
+        201,
     )
 
 
+@app.route("/api/scheduler/<int:schedule_id>", methods=["GET"])
+def get_schedule(schedule_id):
+    schedule = SnapshotSchedule.query.get(schedule_id)
+    if schedule is None:
+        return jsonify({"status": "error", "message": f"Schedule {schedule_id} not found"}), 404
+    return jsonify(schedule.as_dict())
+
+
+@app.route("/api/scheduler/<int:schedule_id>", methods=["PUT", "PATCH"])
+def update_schedule(schedule_id):
+    schedule = SnapshotSchedule.query.get(schedule_id)
+    if schedule is None:
+        return jsonify({"status": "error", "message": f"Schedule {schedule_id} not found"}), 404
+    try:
+        fields = validate_schedule(request.json or {}, partial=request.method == "PATCH")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    for key, value in fields.items():
+        setattr(schedule, key, value)
+    db.session.commit()
+    return jsonify(schedule.as_dict())
+
+
+@app.route("/api/scheduler/<int:schedule_id>", methods=["DELETE"])
+def delete_schedule(schedule_id):
+    schedule = SnapshotSchedule.query.get(schedule_id)
+    if schedule is None:
+        return jsonify({"status": "error", "message": f"Schedule {schedule_id} not found"}), 404
+    db.session.delete(schedule)
+    db.session.commit()
+    return jsonify({"status": "success", "message": "Schedule deleted"})
+
+
 @app.route("/api/vms/<name>/control/start", methods=["POST"])
 def start_vm(name):
     conn = get_libvirt_connection()
     if not conn:
         return jsonify({"error": "Could not connect to libvirt"}), 500
 
+    discard = False
     try:
-        domain = conn.lookupByName(name)
-        domain.create()  # Start the VM
-        
-        
-        socketio.emit('vm_status_updated', {"id": domain.ID(),"status": "start"})
-        return jsonify({"message": "Domain started"})
+        result = start_domain(conn, name)  # Start the VM
+        socketio.emit('vm_status_updated', {"id": result["id"],"status": "start"})
+        return jsonify(result)
     except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
         return jsonify({"error": str(e)}), 500
     finally:
-        conn.close()
+        release_libvirt_connection(conn, discard)
 
 
 @app.route("/api/vms/<name>/control/resume", methods=["POST"])
@@ -392,15 +1108,17 @@ def resume_vm(name):
     if not conn:
         return jsonify({"error": "Could not connect to libvirt"}), 500
 
+    discard = False
     try:
         domain = conn.lookupByName(name)
         domain.resume()  # Resume the VM
         socketio.emit('handle_vm', {"message": "Domain resumed"})
         return jsonify({"message": "Domain resumed"})
     except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
         return jsonify({"error": str(e)}), 500
     finally:
-        conn.close()
+        release_libvirt_connection(conn, discard)
 
 
 @app.route("/api/vms/<name>/control/reboot", methods=["POST"])
@@ -409,31 +1127,28 @@ def reboot_vm(name):
     if not conn:
         return jsonify({"error": "Could not connect to libvirt"}), 500
 
+    discard = False
     try:
         domain = conn.lookupByName(name)
         domain.reboot()  # Reboot the VM
         socketio.emit('handle_vm', {"message": "Domain rebooted"})
         return jsonify({"message": "Domain rebooted"})
     except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
         return jsonify({"error": str(e)}), 500
     finally:
-        conn.close()
+        release_libvirt_connection(conn, discard)
+
+
+def shutdown_domain(conn, name):
+    domain = conn.lookupByName(name)
+    domain.shutdown()  # Shutdown the VM
+    return {"message": "Domain shut down"}
 
 
 @app.route("/api/vms/<name>/control/shutdown", methods=["POST"])
 def shutdown_vm(name):
-    conn = get_libvirt_connection()
-    if not conn:
-        return jsonify({"error": "Could not connect to libvirt"}), 500
-
-    try:
-        domain = conn.lookupByName(name)
-        domain.shutdown()  # Shutdown the VM
-        return jsonify({"message": "Domain shut down"})
-    except libvirt.libvirtError as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+    return submit_job(name, "shutdown_vm", shutdown_domain)
 
 @app.route("/api/vms/<name>/control/poweroff", methods=["POST"])
 def power_vm(name):
@@ -441,6 +1156,7 @@ def power_vm(name):
     if not conn:
         return jsonify({"error": "Could not connect to libvirt"}), 500
 
+    discard = False
     try:
         domain = conn.lookupByName(name)
         socketio.emit('vm_status_updated', {"id": domain.ID(),"status": "poweroff"}, )
@@ -448,6 +1164,100 @@ def power_vm(name):
         
         return jsonify({"message": "Domain powered down"})
     except libvirt.libvirtError as e:
+        discard = is_connection_error(e)
         return jsonify({"error": str(e)}), 500
     finally:
-        conn.close()
+        release_libvirt_connection(conn, discard)
+
+
+def start_domain(conn, name):
+    domain = conn.lookupByName(name)
+    # A stopped VM whose CPUs were taken meanwhile, or that never had any, is placed again
+    placement = placement_engine.place_defined(conn, domain) if NUMA_PLACEMENT else None
+    try:
+        domain.create()
+    finally:
+        if NUMA_PLACEMENT:
+            placement_engine.release(name)
+    # The handle learns the new ID from create(), so reading it costs no RPC
+    result = {"message": "Domain started", "id": domain.ID()}
+    if placement is not None:
+        result["placement"] = placement.as_dict()
+    return result
+
+
+def resume_domain(conn, name):
+    conn.lookupByName(name).resume()
+    return {"message": "Domain resumed"}
+
+
+def reboot_domain(conn, name):
+    conn.lookupByName(name).reboot()
+    return {"message": "Domain rebooted"}
+
+
+def poweroff_domain(conn, name):
+    conn.lookupByName(name).destroy()
+    return {"message": "Domain powered down"}
+
+
+BATCH_ACTIONS = {
+    "start": start_domain,
+    "resume": resume_domain,
+    "reboot": reboot_domain,
+    "shutdown": shutdown_domain,
+    "poweroff": poweroff_domain,
+    "snapshot": snapshot_vm,
+}
+
+
+@app.route("/api/vms/batch", methods=["POST"])
+def batch_vms():
+    """
+    Run one action on many VMs and stream a JSON line per VM as each finishes.
+
+    The body names the VMs either as ``"names": [...]`` or as a label ``"selector"`` such as
+    ``"tenant=acme"``, plus the ``"action"`` and an optional ``"parallelism"``. The
+    ``snapshot`` action also needs a ``"snapshot_name"``.
+    """
+    data = request.json or {}
+    action = data.get("action")
+    if action not in BATCH_ACTIONS:
+        return jsonify({"error": f"Unknown action {action!r}, expected one of {sorted(BATCH_ACTIONS)}"}), 400
+    names = data.get("names")
+    selector = data.get("selector")
+    if bool(names) == bool(selector):
+        return jsonify({"error": "Give either a list of names or a label selector"}), 400
+    if names and not (isinstance(names, list) and all(isinstance(name, str) for name in names)):
+        return jsonify({"error": "names must be a list of VM names"}), 400
+
+    args = ()
+    if action == "snapshot":
+        snapshot_name = data.get("snapshot_name")
+        if not snapshot_name:
+            return jsonify({"error": "Snapshot name is required"}), 400
+        args = (snapshot_name,)
+    try:
+        parallelism = batch_parallelism(data.get("parallelism"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "parallelism must be an integer"}), 400
+
+    if selector:
+        conn = get_libvirt_connection()
+        if not conn:
+            return jsonify({"error": "Could not connect to libvirt"}), 500
+        try:
+            names = select_domains(conn, selector)
+        except ValueError as e:
+            release_libvirt_connection(conn)
+            return jsonify({"error": str(e)}), 400
+        except (libvirt.libvirtError, ET.ParseError) as e:
+            release_libvirt_connection(conn, isinstance(e, libvirt.libvirtError) and is_connection_error(e))
+            return jsonify({"error": str(e)}), 500
+        release_libvirt_connection(conn)
+
+    def stream():
+        for result in run_batch(names, action, BATCH_ACTIONS[action], *args, parallelism=parallelism):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson", headers={"X-Batch-Size": str(len(set(names)))})
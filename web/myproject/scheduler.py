@@ -0,0 +1,307 @@
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import libvirt
+
+from . import db
+from .jobs import JOB_WORKERS, job_queue
+from .models import SnapshotSchedule
+from .pool import get_pool
+from .retention import RetentionPolicy, retention_engine
+
+logger = logging.getLogger(__name__)
+
+# Run the scheduler on this host. Only the process holding the leader lease (see leader.py)
+# runs it, so several workers never take the same snapshots.
+SNAPSHOT_SCHEDULER = os.getenv("SNAPSHOT_SCHEDULER", "1").lower() in ("1", "true", "yes")
+# Upper bound for the per-schedule jitter, in seconds.
+SNAPSHOT_MAX_JITTER = int(os.getenv("SNAPSHOT_MAX_JITTER", "3600"))
+# Jitter of schedules that do not set one, as a fraction of their shortest interval.
+SNAPSHOT_JITTER_FRACTION = float(os.getenv("SNAPSHOT_JITTER_FRACTION", "0.5"))
+# Minutes of ticks replayed after the scheduler fell behind (e.g. a long pause); older ones are skipped.
+SNAPSHOT_CATCH_UP = int(os.getenv("SNAPSHOT_CATCH_UP", "5"))
+
+SNAPSHOT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+# (low, high) of minute, hour, day of month, month and day of week; 7 is also Sunday.
+_CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> Set[int]:
+    values = set()
+    for part in field.split(","):
+        base, _, step = part.partition("/")
+        step_size = int(step) if step else 1
+        if base == "*":
+            start, end = low, high
+        elif "-" in base:
+            start, end = (int(bound) for bound in base.split("-", 1))
+        else:
+            start = int(base)
+            end = high if step else start
+        if step_size < 1 or not low <= start <= end <= high:
+            raise ValueError(f"Invalid cron field {field!r}")
+        values.update(range(start, end + 1, step_size))
+    return values
+
+
+class CronExpression:
+    """
+    A five-field cron expression: minute, hour, day of month, month and day of week.
+
+    Fields accept ``*``, numbers, ranges, lists and ``/step``. As in cron, when both the day
+    of month and the day of week are restricted a time matches if either one does.
+    """
+
+    __slots__ = ("expression", "minutes", "hours", "days", "months", "weekdays", "_any_day", "_any_weekday")
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expected 5 cron fields, got {len(fields)} in {expression!r}")
+        self.expression = expression
+        try:
+            self.minutes, self.hours, self.days, self.months, weekdays = (
+                _parse_cron_field(field, low, high) for field, (low, high) in zip(fields, _CRON_RANGES)
+            )
+        except ValueError as e:
+            raise ValueError(f"Invalid cron expression {expression!r}: {e}") from e
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def matches(self, moment: datetime) -> bool:
+        if moment.minute not in self.minutes or moment.hour not in self.hours or moment.month not in self.months:
+            return False
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def min_interval(self) -> int:
+        """
+        The shortest gap, in minutes, between two matching times of day. Restricted days
+        only make the gaps longer.
+        """
+        times = sorted(hour * 60 + minute for hour in self.hours for minute in self.minutes)
+        return min(later - earlier for earlier, later in zip(times, times[1:] + [times[0] + 24 * 60]))
+
+
+@lru_cache(maxsize=1024)
+def parse_cron(expression: str) -> CronExpression:
+    return CronExpression(expression)
+
+
+def _optional_int(data: Dict[str, Any], key: str, minimum: int) -> Optional[int]:
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise ValueError(f"{key} must be an integer of at least {minimum}")
+    return value
+
+
+def validate_schedule(data: Dict[str, Any], partial: bool = False) -> Dict[str, Any]:
+    """
+    Check the fields of a create or update request for a snapshot schedule.
+
+    A schedule is given as a five-field ``cron`` expression, or with the older ``interval``
+    (minute) and ``day`` (hour) fields that the crontab based scheduler took.
+
+    :param data: The request body.
+    :param partial: Only validate the fields present, for updates.
+    :return: The model fields to set.
+    :raises ValueError: If a field is missing or invalid.
+    """
+    fields: Dict[str, Any] = {}
+    vm_name = data.get("vm_name")
+    prefix = data.get("snapshot_prefix", data.get("snapshot_name"))
+    cron = data.get("cron")
+    if cron is None and ("interval" in data or "day" in data or not partial):
+        cron = f"{data.get('interval', '*/1')} {data.get('day', '*')} * * *"
+
+    if vm_name is not None or not partial:
+        if not vm_name or not isinstance(vm_name, str):
+            raise ValueError("vm_name is required")
+        fields["vm_name"] = vm_name
+    if prefix is not None or not partial:
+        if not prefix or not isinstance(prefix, str):
+            raise ValueError("snapshot_name is required")
+        fields["snapshot_prefix"] = prefix
+    if cron is not None:
+        fields["cron"] = parse_cron(str(cron)).expression
+
+    for key, minimum in (("jitter", 0), ("keep_last", 1), ("max_age_days", 1)):
+        if key in data:
+            fields[key] = _optional_int(data, key, minimum)
+    if fields.get("jitter") is not None and fields["jitter"] > SNAPSHOT_MAX_JITTER:
+        raise ValueError(f"jitter must be at most {SNAPSHOT_MAX_JITTER} seconds")
+    if "enabled" in data:
+        fields["enabled"] = bool(data["enabled"])
+    return fields
+
+
+def default_jitter(cron: str) -> int:
+    """
+    The jitter, in seconds, of a schedule that does not set one: ``SNAPSHOT_JITTER_FRACTION``
+    of its shortest interval, at most ``SNAPSHOT_MAX_JITTER``.
+    """
+    return min(SNAPSHOT_MAX_JITTER, int(parse_cron(cron).min_interval() * 60 * SNAPSHOT_JITTER_FRACTION))
+
+
+def jitter_offset(schedule_id: int, jitter: Optional[int], cron: str) -> float:
+    """
+    The delay, in seconds, between a schedule's cron time and its snapshot.
+
+    The offset is random across schedules but fixed for each one, so schedules sharing a
+    cron time are spread out while each keeps a regular interval between its snapshots.
+    A ``jitter`` of None picks ``default_jitter``; 0 turns jitter off.
+    """
+    if jitter is None:
+        jitter = default_jitter(cron)
+    if not jitter:
+        return 0.0
+    return random.Random(schedule_id).uniform(0, jitter)
+
+
+def scheduled_snapshot_name(prefix: str, moment: datetime) -> str:
+    return f"{prefix}-{moment.strftime(SNAPSHOT_TIME_FORMAT)}"
+
+
+class SnapshotScheduler:
+    """
+    Takes snapshots on cron schedules from inside the web service.
+
+    Schedules are read from the ``snapshot_schedules`` table once a minute, so changes made
+    through the API apply from the next minute on. A due schedule waits for its jitter
+    offset and is then submitted to the job queue, so it never overlaps other operations
+    on the same VM; a schedule whose previous snapshot is still queued or running is
+    skipped for that tick. After each snapshot the schedule's retention policy is applied.
+    """
+
+    def __init__(
+        self,
+        app: Any,
+        take_snapshot: Callable[[libvirt.virConnect, str, str], Any],
+        submit: Callable[[str, str, Callable[[], Any]], Any] = job_queue.submit,
+    ):
+        self.app = app
+        self.take_snapshot = take_snapshot
+        self.submit = submit
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # (run at, schedule id, schedule fields) of due schedules waiting out their jitter
+        self._pending: List[tuple] = []
+        self._running: Set[int] = set()
+        self._last_tick: Optional[datetime] = None
+
+    def start(self) -> None:
+        """
+        Start the scheduler thread. Calling it again is a no-op.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._last_tick = datetime.now().replace(second=0, microsecond=0)
+            self._thread = threading.Thread(target=self._run, name="snapshot-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._tick()
+                self._dispatch()
+            except Exception as e:
+                logger.error(f"Snapshot scheduler tick failed: {e}")
+            now = time.time()
+            wait = 60 - now % 60
+            with self._lock:
+                if self._pending:
+                    wait = min(wait, self._pending[0][0] - now)
+            self._stop.wait(max(0.05, wait))
+
+    def _load_schedules(self) -> List[Dict[str, Any]]:
+        with self.app.app_context():
+            return [schedule.as_dict() for schedule in SnapshotSchedule.query.filter_by(enabled=True).all()]
+
+    def _tick(self) -> None:
+        minute = datetime.now().replace(second=0, microsecond=0)
+        if minute <= self._last_tick:
+            return
+        ticks = []
+        moment = max(self._last_tick + timedelta(minutes=1), minute - timedelta(minutes=SNAPSHOT_CATCH_UP - 1))
+        while moment <= minute:
+            ticks.append(moment)
+            moment += timedelta(minutes=1)
+        self._last_tick = minute
+
+        schedules = self._load_schedules()
+        with self._lock:
+            for tick in ticks:
+                for schedule in schedules:
+                    try:
+                        due = parse_cron(schedule["cron"]).matches(tick)
+                    except ValueError as e:
+                        logger.error(f"Snapshot schedule {schedule['id']} has an invalid cron expression: {e}")
+                        continue
+                    if due:
+                        run_at = tick.timestamp() + jitter_offset(schedule["id"], schedule["jitter"], schedule["cron"])
+                        heapq.heappush(self._pending, (run_at, schedule["id"], schedule))
+
+    def _dispatch(self) -> None:
+        now = time.time()
+        with self._lock:
+            while self._pending and self._pending[0][0] <= now:
+                _, schedule_id, schedule = heapq.heappop(self._pending)
+                if schedule_id in self._running:
+                    logger.warning(f"Snapshot schedule {schedule_id} is still running, skipping this run")
+                    continue
+                self._running.add(schedule_id)
+                self.submit(schedule["vm_name"], "scheduled_snapshot", lambda schedule=schedule: self._take(schedule))
+
+    def _take(self, schedule: Dict[str, Any]) -> Dict[str, Any]:
+        name = scheduled_snapshot_name(schedule["snapshot_prefix"], datetime.now())
+        status, error = "succeeded", None
+        try:
+            with get_pool(name="jobs", size=JOB_WORKERS).connection() as conn:
+                self.take_snapshot(conn, schedule["vm_name"], name)
+                pruned = []
+                if schedule["keep_last"] or schedule["max_age_days"]:
+                    policy = RetentionPolicy(
+                        keep_last=schedule["keep_last"],
+                        max_age_days=schedule["max_age_days"],
+                        prefix=schedule["snapshot_prefix"] + "-",
+                    )
+                    pruned = retention_engine.prune(conn, schedule["vm_name"], policy)["deleted"]
+            logger.info(f"Took snapshot {name} of {schedule['vm_name']}, pruned {len(pruned)}")
+            return {"snapshot": name, "pruned": pruned}
+        except Exception as e:
+            logger.error(f"Scheduled snapshot {name} of {schedule['vm_name']} failed: {e}")
+            status, error = "failed", str(e)
+            raise
+        finally:
+            with self._lock:
+                self._running.discard(schedule["id"])
+            self._record(schedule["id"], status, error)
+
+    def _record(self, schedule_id: int, status: str, error: Optional[str]) -> None:
+        with self.app.app_context():
+            schedule = SnapshotSchedule.query.get(schedule_id)
+            if schedule is None:
+                return
+            schedule.last_run_at = datetime.now()
+            schedule.last_status = status
+            schedule.last_error = error
+            db.session.commit()
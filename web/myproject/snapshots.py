@@ -0,0 +1,176 @@
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import libvirt
+
+# Domains whose parsed snapshot descriptions are kept before the least recently listed are dropped.
+SNAPSHOT_CACHE_DOMAINS = 1024
+
+
+class SnapshotInfo:
+    """
+    The parts of a domain snapshot XML description used to list and prune snapshots.
+    """
+
+    __slots__ = ("name", "created_at", "state", "parent", "current", "external", "disk_files")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.created_at: Optional[datetime] = None
+        self.state: Optional[str] = None
+        self.parent: Optional[str] = None
+        self.current = False
+        # External snapshots keep their data in separate overlay files and cannot be deleted
+        # with a plain virDomainSnapshotDelete.
+        self.external = False
+        # Overlay files written by an external snapshot
+        self.disk_files: List[str] = []
+
+    def copy(self) -> "SnapshotInfo":
+        info = SnapshotInfo(self.name)
+        for attribute in self.__slots__:
+            setattr(info, attribute, getattr(self, attribute))
+        return info
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "state": self.state,
+            "parent": self.parent,
+            "current": self.current,
+            "external": self.external,
+        }
+
+
+def parse_snapshot_xml(xml_desc: str) -> SnapshotInfo:
+    """
+    Extract the name, creation time, state, parent and snapshot type from a snapshot XML description.
+
+    :param xml_desc: The snapshot XML as returned by ``virDomainSnapshot.getXMLDesc``.
+    :return: The extracted description; ``current`` is left False.
+    :raises ET.ParseError: If the XML is malformed.
+    """
+    root = ET.fromstring(xml_desc)
+    info = SnapshotInfo(root.findtext("name", ""))
+    creation_time = root.findtext("creationTime")
+    if creation_time:
+        info.created_at = datetime.fromtimestamp(int(creation_time))
+    info.state = root.findtext("state")
+    info.parent = root.findtext("parent/name")
+    for element in [*root.iterfind("memory"), *root.iterfind("disks/disk")]:
+        if element.get("snapshot") != "external":
+            continue
+        info.external = True
+        source = element.find("source")
+        if element.tag == "disk" and source is not None and source.get("file"):
+            info.disk_files.append(source.get("file"))
+    return info
+
+
+def current_snapshot_name(domain: libvirt.virDomain) -> Optional[str]:
+    try:
+        return domain.snapshotCurrent(0).getName()
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+            return None
+        raise
+
+
+class SnapshotInfoCache:
+    """
+    Parsed snapshot descriptions keyed by domain UUID and snapshot name.
+
+    Each listing only fetches the XML of snapshots it has not seen before. A snapshot's XML
+    does change when its parent is deleted, which reparents it, or when it is redefined, so
+    every change made through this service drops all descriptions of the domain with
+    ``discard``. A listing that finds a snapshot gone, deleted by someone else, starts over
+    for the same reason.
+    """
+
+    def __init__(self, domains: int = SNAPSHOT_CACHE_DOMAINS):
+        self.domains = domains
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, SnapshotInfo]]" = OrderedDict()
+
+    def list(self, domain: libvirt.virDomain) -> List[SnapshotInfo]:
+        """
+        Describe every snapshot of a domain.
+
+        :param domain: The libvirt domain.
+        :return: One description per snapshot, in the order libvirt lists them, with
+            ``current`` set on the current snapshot.
+        """
+        uuid = domain.UUIDString()
+        current = current_snapshot_name(domain)
+        snapshots = domain.listAllSnapshots(0)
+        with self._lock:
+            known = self._entries.get(uuid, {})
+        names = [snapshot.getName() for snapshot in snapshots]
+        if set(known) - set(names):
+            # The children of the deleted snapshots have new parents.
+            known = {}
+
+        listed: Dict[str, SnapshotInfo] = {}
+        for name, snapshot in zip(names, snapshots):
+            info = known.get(name)
+            if info is None:
+                info = parse_snapshot_xml(snapshot.getXMLDesc(0))
+            listed[name] = info
+
+        with self._lock:
+            self._entries[uuid] = listed
+            self._entries.move_to_end(uuid)
+            while len(self._entries) > self.domains:
+                self._entries.popitem(last=False)
+
+        infos = []
+        for info in listed.values():
+            # The cached descriptions are shared, so the current flag goes on a copy.
+            info = info.copy()
+            info.current = info.name == current
+            infos.append(info)
+        return infos
+
+    def discard(self, uuid: str) -> None:
+        """
+        Forget every snapshot of a domain, after a snapshot of it was created, deleted or redefined.
+        """
+        with self._lock:
+            self._entries.pop(uuid, None)
+
+
+snapshot_info_cache = SnapshotInfoCache()
+
+
+def list_snapshot_infos(domain: libvirt.virDomain) -> List[SnapshotInfo]:
+    """
+    Describe every snapshot of a domain, fetching only the XML not seen before.
+
+    :param domain: The libvirt domain.
+    :return: One description per snapshot, in the order libvirt lists them.
+    """
+    return snapshot_info_cache.list(domain)
+
+
+def snapshot_disk_size(conn: libvirt.virConnect, disk_files: List[str]) -> Optional[int]:
+    """
+    Measure the host storage allocated to the overlay files of an external snapshot, in bytes.
+
+    libvirt has no per-snapshot size for internal snapshots, whose data lives inside the
+    disk image itself, so those report None, as do overlays outside any storage pool.
+
+    :param disk_files: The ``disk_files`` of the snapshot.
+    """
+    if not disk_files:
+        return None
+    total = 0
+    for path in disk_files:
+        try:
+            total += conn.storageVolLookupByPath(path).info()[2]
+        except libvirt.libvirtError:
+            return None
+    return total
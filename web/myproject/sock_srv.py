@@ -1,10 +1,45 @@
-import socket
-import libvirt
+import asyncio
 import json
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+import libvirt
+
 import back
+import tracing
+from kvmproto import JSON, ProtocolError, choose_codec, encode_frame, read_frame
+from pool import get_pool
+
+logging.basicConfig(level=logging.INFO)
+
+HOST = os.getenv("KVM_AGENT_HOST", "0.0.0.0")
+PORT = int(os.getenv("KVM_AGENT_PORT", "12345"))
+# Threads available for blocking libvirt calls; further requests wait for a free one.
+WORKERS = int(os.getenv("KVM_AGENT_WORKERS", "16"))
+# Seconds a client may take to send its request.
+READ_TIMEOUT = float(os.getenv("KVM_AGENT_READ_TIMEOUT", "30"))
+# Seconds a persistent connection may sit idle between requests.
+IDLE_TIMEOUT = float(os.getenv("KVM_AGENT_IDLE_TIMEOUT", "300"))
+# Requests a single connection may have outstanding at once.
+MAX_IN_FLIGHT = int(os.getenv("KVM_AGENT_MAX_IN_FLIGHT", "64"))
+# Seconds in-flight requests get to finish after a shutdown signal.
+SHUTDOWN_GRACE = float(os.getenv("KVM_AGENT_SHUTDOWN_GRACE", "30"))
 
-# Connect to the local libvirt daemon
-conn = libvirt.open('qemu:///system')
+DEFAULT_TIMEOUT = 30.0
+# Per-command limits for calls that are expected to run long.
+COMMAND_TIMEOUTS = {
+		'create_vm'       : 120.0,
+		'delete_vm'       : 120.0,
+		'create_snapshots': 900.0,
+		'shutdown_vm'     : 120.0,
+}
+
+
+def list_vms():
+	with get_pool().connection() as conn:
+		return [vm.name() for vm in conn.listAllDomains()]
 
 
 def handle_request(request):
@@ -20,7 +55,7 @@ def handle_request(request):
 	command = request.get('command')
 	
 	if command == 'list_vms':
-		response = [vm.name() for vm in conn.listAllDomains()]
+		response = list_vms()
 	elif command == 'create_vm':
 		vm_data = request.get('vm_data')
 		response = back.create_vm(vm_data)
@@ -58,41 +93,196 @@ def handle_request(request):
 	return response
 
 
-def start_server():
-	host = '0.0.0.0'
-	port = 12345
-	server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	server_socket.bind((host, port))
-	server_socket.listen(5)
-	print("KVM socket server listening...")
-	
+async def read_request(reader, buffer=b''):
+	"""
+	Reads one unframed JSON request from a legacy client, however many reads it takes to arrive.
+
+	Parameters:
+	- reader (asyncio.StreamReader): The client stream.
+	- buffer (bytes): Bytes already read from the stream.
+
+	Returns:
+	- dict: The decoded request, or None if the client closed the connection first.
+
+	Raises:
+	- json.JSONDecodeError: If the client closed the connection on an incomplete or invalid document.
+	"""
+	decoder = json.JSONDecoder()
 	while True:
-		client_socket, addr = server_socket.accept()
-		print(f"Connection from {addr}")
-		
 		try:
-			data = client_socket.recv(4096).decode()
-			if not data:
-				print("No data received")  # Debugging: Log no data received
+			request, _ = decoder.raw_decode(buffer.decode().lstrip())
+			return request
+		except (json.JSONDecodeError, UnicodeDecodeError):
+			pass
+		chunk = await reader.read(65536)
+		if not chunk:
+			if not buffer.strip():
+				return None
+			return json.loads(buffer)
+		buffer += chunk
+
+
+def traced_request(request):
+	"""
+	Runs `handle_request` as one trace, so slow commands are logged with their libvirt calls.
+	"""
+	with tracing.trace(f"agent {request.get('command')}"):
+		return handle_request(request)
+
+
+class KVMServer:
+	"""
+	Asyncio socket server that runs KVM agent commands on a bounded thread pool.
+
+	Clients speak the framed protocol from ``kvmproto``: a persistent connection carries many
+	pipelined requests, each answered as soon as its command finishes, in the payload encoding
+	negotiated by the optional opening handshake. Clients that send a bare
+	JSON document instead get the old one-request-per-connection behaviour. Blocking libvirt calls
+	run on ``workers`` threads and each command is bounded by its timeout from ``COMMAND_TIMEOUTS``.
+	"""
+	
+	def __init__(self, host=HOST, port=PORT, workers=WORKERS):
+		self.host = host
+		self.port = port
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kvm-agent')
+		self._server = None
+		self._connections = set()
+		self._inflight = set()
+	
+	async def run_command(self, request):
+		command = request.get('command')
+		timeout = COMMAND_TIMEOUTS.get(command, DEFAULT_TIMEOUT)
+		loop = asyncio.get_running_loop()
+		try:
+			return await asyncio.wait_for(loop.run_in_executor(self.executor, traced_request, request), timeout)
+		except asyncio.TimeoutError:
+			# The libvirt call keeps its worker until it returns; only the client is released.
+			logging.error(f"Command {command} timed out after {timeout}s")
+			return {'status': 'error', 'message': f'Command {command} timed out after {timeout}s'}
+		except libvirt.libvirtError as e:
+			return {'status': 'error', 'message': str(e)}
+		except Exception as e:
+			# Any failure is still answered, so neither framed nor legacy clients wait in vain.
+			logging.exception(f"Command {command} failed")
+			return {'status': 'error', 'message': str(e)}
+	
+	def _track(self, coro):
+		task = asyncio.ensure_future(coro)
+		self._inflight.add(task)
+		task.add_done_callback(self._inflight.discard)
+		return task
+	
+	async def respond(self, message, writer, write_lock, slots, codec):
+		try:
+			response = await self.run_command(message)
+			try:
+				frame = encode_frame({'id': message.get('id'), 'response': response}, codec)
+			except (TypeError, ValueError, ProtocolError) as e:
+				# A response the codec cannot carry is still answered, as an error.
+				logging.error(f"Could not encode the response to request {message.get('id')}: {e}")
+				frame = encode_frame({'id': message.get('id'), 'response': {'status': 'error', 'message': str(e)}}, codec)
+			async with write_lock:
+				writer.write(frame)
+				await writer.drain()
+		except (ConnectionError, ProtocolError) as e:
+			logging.error(f"Could not answer request {message.get('id')}: {e}")
+		finally:
+			slots.release()
+	
+	async def serve_framed(self, reader, writer, header):
+		write_lock = asyncio.Lock()
+		slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+		tasks = set()
+		codec = JSON
+		first = True
+		while True:
+			try:
+				message = await asyncio.wait_for(read_frame(reader, header, codec), IDLE_TIMEOUT)
+			except asyncio.TimeoutError:
 				break
-			
-			print("Data received:", data)  # Debugging: Log the data received
-			request = json.loads(data)
-			response = handle_request(request)
-			response_json = json.dumps(response)
-			print("Sending response:", response_json)  # Debugging: Log the response
-			client_socket.send(response_json.encode())
-		
+			header = b''
+			if message is None:
+				break
+			if first and 'hello' in message:
+				# The handshake is always JSON; everything after it uses the agreed codec.
+				codec = choose_codec((message['hello'] or {}).get('codecs') or [])
+				writer.write(encode_frame({'hello': {'codec': codec.name}}))
+				await writer.drain()
+				first = False
+				continue
+			first = False
+			# Stop reading new requests from a client that already has MAX_IN_FLIGHT outstanding.
+			await slots.acquire()
+			task = self._track(self.respond(message, writer, write_lock, slots, codec))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		if tasks:
+			await asyncio.wait(tasks)
+	
+	async def serve_legacy(self, reader, writer, buffer):
+		try:
+			request = await asyncio.wait_for(read_request(reader, buffer), READ_TIMEOUT)
 		except json.JSONDecodeError:
-			print("Invalid JSON received")  # Debugging: Log invalid JSON
-			client_socket.send(json.dumps({'status': 'error', 'message': 'Invalid JSON'}).encode())
+			response = {'status': 'error', 'message': 'Invalid JSON'}
+		except asyncio.TimeoutError:
+			response = {'status': 'error', 'message': 'Timed out waiting for request'}
+		else:
+			if request is None:
+				return
+			response = await self._track(self.run_command(request))
+		writer.write(json.dumps(response).encode())
+		await writer.drain()
+	
+	async def handle_client(self, reader, writer):
+		addr = writer.get_extra_info('peername')
+		logging.info(f"Connection from {addr}")
+		self._connections.add(asyncio.current_task())
+		try:
+			first = await asyncio.wait_for(reader.read(1), READ_TIMEOUT)
+			if not first:
+				logging.info(f"No data received from {addr}")
+			elif first in (b'{', b'['):
+				await self.serve_legacy(reader, writer, first)
+			else:
+				await self.serve_framed(reader, writer, first)
+		except (asyncio.TimeoutError, ProtocolError) as e:
+			logging.error(f"Dropping connection from {addr}: {e}")
 		except Exception as e:
-			print(f"Unexpected error: {e}")  # Debugging: Log any unexpected error
-			client_socket.send(json.dumps({'status': 'error', 'message': str(e)}).encode())
+			logging.error(f"Unexpected error: {e}")
 		finally:
-			client_socket.close()
+			self._connections.discard(asyncio.current_task())
+			writer.close()
 	
-	server_socket.close()
+	async def serve(self):
+		self._server = await asyncio.start_server(self.handle_client, self.host, self.port)
+		loop = asyncio.get_running_loop()
+		stop = asyncio.Event()
+		for sig in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(sig, stop.set)
+		logging.info(f"KVM socket server listening on {self.host}:{self.port}...")
+		
+		await stop.wait()
+		await self.shutdown()
+	
+	async def shutdown(self):
+		"""
+		Stops accepting connections and gives in-flight requests ``SHUTDOWN_GRACE`` seconds to finish.
+		"""
+		logging.info("Shutting down KVM socket server...")
+		self._server.close()
+		if self._inflight:
+			done, pending = await asyncio.wait(set(self._inflight), timeout=SHUTDOWN_GRACE)
+			for task in pending:
+				task.cancel()
+		# Idle persistent connections would otherwise wait for their next request forever.
+		for task in set(self._connections):
+			task.cancel()
+		await self._server.wait_closed()
+		self.executor.shutdown(wait=False)
+
+
+def start_server():
+	asyncio.run(KVMServer().serve())
 
 
 if __name__ == '__main__':
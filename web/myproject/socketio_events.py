@@ -1,3 +1,9 @@
+from flask_socketio import join_room, leave_room
+
+from . import socketio
+from .broadcast import HOST_ID, get_broadcaster, host_room, vm_room
+
+
 @socketio.on("connect")
 def handle_connect():
     print("Client connected")
@@ -12,3 +18,34 @@ def handle_disconnect():
 def handle_message(message):
     print("Received message:", message)
     socketio.emit("message_from_server", message)
+
+
+def subscription_rooms(data):
+    """
+    Map a subscribe/unsubscribe payload to Socket.IO rooms.
+
+    ``{"vm": "<name>"}`` or ``{"vms": [...]}`` selects single VMs; anything else, including
+    ``{"host": "<host>"}``, selects every VM on a host (this one by default).
+    """
+    data = data or {}
+    names = data.get("vms") or ([data["vm"]] if data.get("vm") else [])
+    if names:
+        return [vm_room(name) for name in names]
+    return [host_room(data.get("host", HOST_ID))]
+
+
+@socketio.on("subscribe")
+def handle_subscribe(data):
+    get_broadcaster(socketio)
+    rooms = subscription_rooms(data)
+    for room in rooms:
+        join_room(room)
+    return {"rooms": rooms}
+
+
+@socketio.on("unsubscribe")
+def handle_unsubscribe(data):
+    rooms = subscription_rooms(data)
+    for room in rooms:
+        leave_room(room)
+    return {"rooms": rooms}
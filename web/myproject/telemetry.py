@@ -0,0 +1,293 @@
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import libvirt
+
+from .pool import DEFAULT_URI, get_pool
+
+logger = logging.getLogger(__name__)
+
+TELEMETRY_INTERVAL = float(os.getenv("TELEMETRY_INTERVAL", "5"))
+# Samples kept per VM when there are few VMs.
+TELEMETRY_HISTORY = int(os.getenv("TELEMETRY_HISTORY", "720"))
+# Samples kept across all VMs. With many VMs each keeps fewer, so memory stays bounded.
+TELEMETRY_MAX_SAMPLES = int(os.getenv("TELEMETRY_MAX_SAMPLES", "500000"))
+# Samples each VM keeps however many VMs there are; this floor may exceed the global budget.
+TELEMETRY_MIN_HISTORY = int(os.getenv("TELEMETRY_MIN_HISTORY", "12"))
+
+TELEMETRY_STATS = (
+    libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+    | libvirt.VIR_DOMAIN_STATS_BALLOON
+    | libvirt.VIR_DOMAIN_STATS_VCPU
+    | libvirt.VIR_DOMAIN_STATS_INTERFACE
+    | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+
+# Fields of each sample, in ring buffer column order.
+FIELDS = (
+    "cpu_percent",
+    "memory_used",
+    "memory_rss",
+    "block_read_iops",
+    "block_write_iops",
+    "block_read_bps",
+    "block_write_bps",
+    "net_rx_bps",
+    "net_tx_bps",
+    "net_rx_pps",
+    "net_tx_pps",
+)
+
+
+def _sum_devices(stats: Dict[str, Any], group: str, field: str) -> float:
+    return sum(stats.get(f"{group}.{index}.{field}", 0) for index in range(stats.get(f"{group}.count", 0)))
+
+
+def read_counters(stats: Dict[str, Any]) -> Tuple[float, ...]:
+    """
+    Pull the cumulative counters the rates are computed from out of one domain's bulk stats.
+
+    Block and network counters are summed over all devices of the domain.
+    """
+    return (
+        stats.get("cpu.time", math.nan),
+        _sum_devices(stats, "block", "rd.reqs"),
+        _sum_devices(stats, "block", "wr.reqs"),
+        _sum_devices(stats, "block", "rd.bytes"),
+        _sum_devices(stats, "block", "wr.bytes"),
+        _sum_devices(stats, "net", "rx.bytes"),
+        _sum_devices(stats, "net", "tx.bytes"),
+        _sum_devices(stats, "net", "rx.pkts"),
+        _sum_devices(stats, "net", "tx.pkts"),
+    )
+
+
+def compute_rates(
+    stats: Dict[str, Any],
+    counters: Tuple[float, ...],
+    previous: Optional[Tuple[float, Tuple[float, ...]]],
+    now: float,
+) -> Tuple[float, ...]:
+    """
+    Turn two readings of a domain's counters into one sample of ``FIELDS``.
+
+    CPU percent is relative to all vCPUs of the domain, so a fully busy guest reads 100.
+    Memory is reported as of this reading, in KiB. Rates are NaN on the first reading and
+    after a counter went backwards, which happens when the guest restarts.
+    """
+    current = stats.get("balloon.current")
+    unused = stats.get("balloon.unused")
+    memory_used = current - unused if current is not None and unused is not None else math.nan
+    memory_rss = stats.get("balloon.rss", math.nan)
+
+    if previous is None:
+        return (math.nan, memory_used, memory_rss) + (math.nan,) * (len(FIELDS) - 3)
+    elapsed = now - previous[0]
+    deltas = [value - before for value, before in zip(counters, previous[1])]
+    if elapsed <= 0:
+        deltas = [math.nan] * len(deltas)
+    rates = [delta / elapsed if delta >= 0 else math.nan for delta in deltas]
+
+    vcpus = stats.get("vcpu.current") or 1
+    # cpu.time is in nanoseconds
+    cpu_percent = rates[0] / 1e9 / vcpus * 100
+    return (cpu_percent, memory_used, memory_rss) + tuple(rates[1:])
+
+
+class SampleRing:
+    """
+    A fixed-size ring buffer of samples, stored in flat arrays of doubles rather than per-sample objects.
+    """
+
+    __slots__ = ("capacity", "times", "values", "start", "size")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity * len(FIELDS)))
+        self.start = 0
+        self.size = 0
+
+    def append(self, timestamp: float, sample: Tuple[float, ...]) -> None:
+        slot = (self.start + self.size) % self.capacity
+        if self.size == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.size += 1
+        self.times[slot] = timestamp
+        self.values[slot * len(FIELDS) : (slot + 1) * len(FIELDS)] = array("d", sample)
+
+    def _slots(self) -> List[int]:
+        return [(self.start + offset) % self.capacity for offset in range(self.size)]
+
+    def resize(self, capacity: int) -> "SampleRing":
+        """
+        Copy the newest ``capacity`` samples into a ring of that size.
+        """
+        ring = SampleRing(capacity)
+        for slot in self._slots()[-capacity:]:
+            ring.append(self.times[slot], tuple(self.values[slot * len(FIELDS) : (slot + 1) * len(FIELDS)]))
+        return ring
+
+    def _sample(self, slot: int) -> Dict[str, Any]:
+        sample: Dict[str, Any] = {"time": self.times[slot]}
+        for index, field in enumerate(FIELDS):
+            value = self.values[slot * len(FIELDS) + index]
+            sample[field] = None if math.isnan(value) else round(value, 3)
+        return sample
+
+    def newest(self) -> Optional[Dict[str, Any]]:
+        if not self.size:
+            return None
+        return self._sample((self.start + self.size - 1) % self.capacity)
+
+    def samples(self, since: float = 0.0) -> List[Dict[str, Any]]:
+        """
+        The samples taken at or after ``since``, oldest first, with NaN reported as None.
+        """
+        return [self._sample(slot) for slot in self._slots() if self.times[slot] >= since]
+
+
+class TelemetrySampler:
+    """
+    Samples the runtime stats of every running VM with one bulk call per interval.
+
+    Each VM keeps its recent samples in a ``SampleRing``. The ring size shrinks as VMs are
+    added so all rings together hold at most ``max_samples`` samples, and the rings of VMs
+    that stopped are dropped on the next sample. Listeners get the newest sample of every
+    VM after each interval.
+    """
+
+    def __init__(
+        self,
+        uri: str = DEFAULT_URI,
+        interval: float = TELEMETRY_INTERVAL,
+        history: int = TELEMETRY_HISTORY,
+        max_samples: int = TELEMETRY_MAX_SAMPLES,
+    ):
+        self.uri = uri
+        self.interval = interval
+        self.history = history
+        self.max_samples = max_samples
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._rings: Dict[str, SampleRing] = {}
+        # Last counter reading per domain UUID, so a re-created domain with the same name starts over.
+        self._previous: Dict[str, Tuple[float, Tuple[float, ...]]] = {}
+        self._uuids: Dict[str, str] = {}
+        self._listeners: List[Callable[[Dict[str, Dict[str, Any]]], None]] = []
+
+    def start(self) -> None:
+        """
+        Start the sampler thread. Calling it again is a no-op.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="telemetry-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def add_listener(self, listener: Callable[[Dict[str, Dict[str, Any]]], None]) -> None:
+        """
+        Register a callback run on the sampler thread with ``{name: newest sample}`` after each interval.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def ring_capacity(self, vms: int) -> int:
+        return max(min(TELEMETRY_MIN_HISTORY, self.history), min(self.history, self.max_samples // max(1, vms)))
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Telemetry sample failed: {e}")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def sample(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Take one sample of every running VM.
+
+        :return: The newest sample of each VM.
+        """
+        with get_pool(self.uri).connection() as conn:
+            records = conn.getAllDomainStats(TELEMETRY_STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        now = time.time()
+
+        latest = {}
+        with self._lock:
+            capacity = self.ring_capacity(len(records))
+            rings, previous, uuids = {}, {}, {}
+            for domain, stats in records:
+                name, uuid = domain.name(), domain.UUIDString()
+                counters = read_counters(stats)
+                sample = compute_rates(stats, counters, self._previous.get(uuid), now)
+                previous[uuid] = (now, counters)
+                uuids[name] = uuid
+
+                ring = self._rings.get(name) if self._uuids.get(name) == uuid else None
+                if ring is None:
+                    ring = SampleRing(capacity)
+                elif ring.capacity != capacity:
+                    ring = ring.resize(capacity)
+                ring.append(now, sample)
+                rings[name] = ring
+                latest[name] = ring.newest()
+            # Rebuilding the maps drops every VM that is no longer running.
+            self._rings, self._previous, self._uuids = rings, previous, uuids
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            try:
+                listener(latest)
+            except Exception as e:
+                logger.error(f"Telemetry listener {listener!r} failed: {e}")
+        return latest
+
+    def samples(self, name: str, window: Optional[float] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        The samples of a VM, oldest first.
+
+        :param name: The VM.
+        :param window: Only return samples from the last ``window`` seconds.
+        :return: The samples, or None if the VM is not being sampled.
+        """
+        since = time.time() - window if window is not None else 0.0
+        with self._lock:
+            ring = self._rings.get(name)
+            if ring is None:
+                return None
+            return ring.samples(since)
+
+
+_samplers: Dict[str, TelemetrySampler] = {}
+_samplers_lock = threading.Lock()
+
+
+def get_telemetry_sampler(uri: str = DEFAULT_URI) -> TelemetrySampler:
+    """
+    Get the process-wide telemetry sampler for a libvirt URI.
+
+    The sampler is not started here: only the process holding the leader lease (see
+    leader.py) starts it, after uWSGI forked its workers.
+
+    :param uri: The libvirt connection URI.
+    :return: The sampler.
+    """
+    with _samplers_lock:
+        sampler = _samplers.get(uri)
+        if sampler is None:
+            sampler = _samplers[uri] = TelemetrySampler(uri)
+    return sampler
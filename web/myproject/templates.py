@@ -0,0 +1,155 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import libvirt
+
+from .batch import BATCH_PARALLELISM, run_batch
+
+logger = logging.getLogger(__name__)
+
+# Storage pool the per-VM overlay volumes are created in.
+TEMPLATE_STORAGE_POOL = os.getenv("TEMPLATE_STORAGE_POOL", "default")
+# Clones a single instantiate request may create.
+TEMPLATE_MAX_INSTANCES = int(os.getenv("TEMPLATE_MAX_INSTANCES", "100"))
+
+# Formats a template image may have; overlays are always qcow2.
+_BACKING_FORMATS = ("qcow2", "raw")
+
+
+def overlay_volume_name(name: str) -> str:
+    return f"{name}.qcow2"
+
+
+def inspect_image(conn: libvirt.virConnect, path: str) -> Dict[str, Any]:
+    """
+    Look up a template image in its storage pool.
+
+    :param path: The image path. It must belong to a storage pool libvirt knows.
+    :return: The image ``path``, ``format`` and virtual ``capacity`` in bytes.
+    :raises ValueError: If the image format cannot back a qcow2 overlay.
+    :raises libvirt.libvirtError: If no storage volume has that path.
+    """
+    volume = conn.storageVolLookupByPath(path)
+    target_format = ET.fromstring(volume.XMLDesc(0)).find("target/format")
+    image_format = target_format.get("type") if target_format is not None else None
+    if image_format not in _BACKING_FORMATS:
+        raise ValueError(f"Template image {path} is {image_format or 'of unknown format'}, expected qcow2 or raw")
+    return {"path": volume.path(), "format": image_format, "capacity": volume.info()[1]}
+
+
+def overlay_volume_xml(name: str, backing_path: str, backing_format: str, capacity: int) -> str:
+    """
+    Describe a qcow2 volume that stores only its differences from ``backing_path``.
+    """
+    volume = ET.Element("volume")
+    ET.SubElement(volume, "name").text = overlay_volume_name(name)
+    ET.SubElement(volume, "capacity", unit="bytes").text = str(capacity)
+    ET.SubElement(ET.SubElement(volume, "target"), "format", type="qcow2")
+    backing = ET.SubElement(volume, "backingStore")
+    ET.SubElement(backing, "path").text = backing_path
+    ET.SubElement(backing, "format", type=backing_format)
+    return ET.tostring(volume, encoding="unicode")
+
+
+def create_overlay(conn: libvirt.virConnect, name: str, template: Dict[str, Any]) -> libvirt.virStorageVol:
+    """
+    Create the disk of a new VM as a thin overlay on a template image.
+
+    Only qcow2 metadata is written, so this takes the same time however large the image is.
+
+    :param name: The VM the disk is for.
+    :param template: The template, as returned by ``VMTemplate.as_dict``.
+    :return: The new storage volume.
+    """
+    pool = conn.storagePoolLookupByName(template["storage_pool"])
+    xml = overlay_volume_xml(name, template["image_path"], template["image_format"], template["capacity"])
+    return pool.createXML(xml, 0)
+
+
+def delete_overlay(conn: libvirt.virConnect, name: str, domain_xml: str) -> Optional[str]:
+    """
+    Delete the overlay volume ``instantiate`` created as the disk of a VM being removed.
+
+    The ``vda`` disk is only deleted if it is a storage volume named after the VM with a
+    backing image, so an image the VM was merely pointed at is kept.
+
+    :param domain_xml: The XML of the VM, read before it was undefined.
+    :return: The path of the deleted overlay, or None if the VM had none.
+    """
+    path = None
+    for disk in ET.fromstring(domain_xml).iterfind("devices/disk"):
+        target, source = disk.find("target"), disk.find("source")
+        if target is not None and target.get("dev") == "vda" and source is not None:
+            path = source.get("file")
+    if not path:
+        return None
+    try:
+        volume = conn.storageVolLookupByPath(path)
+    except libvirt.libvirtError:
+        # Not in any storage pool, so not an overlay of ours
+        return None
+    if volume.name() != overlay_volume_name(name) or ET.fromstring(volume.XMLDesc(0)).find("backingStore/path") is None:
+        return None
+    volume.delete(0)
+    return path
+
+
+def free_names(conn: libvirt.virConnect, template: Dict[str, Any], prefix: str, count: int) -> List[str]:
+    """
+    Pick ``count`` names ``<prefix>-<n>`` used by neither a domain nor an overlay volume.
+    """
+    pool = conn.storagePoolLookupByName(template["storage_pool"])
+    taken = {domain.name() for domain in conn.listAllDomains(0)}
+    volumes = {volume.name() for volume in pool.listAllVolumes(0)}
+    names, index = [], 1
+    while len(names) < count:
+        name = f"{prefix}-{index}"
+        if name not in taken and overlay_volume_name(name) not in volumes:
+            names.append(name)
+        index += 1
+    return names
+
+
+def instantiate(
+    conn: libvirt.virConnect,
+    name: str,
+    template: Dict[str, Any],
+    create_domain: Callable[..., Dict[str, Any]],
+    *args: Any,
+) -> Dict[str, Any]:
+    """
+    Create a VM from a template.
+
+    The overlay disk is created first and then ``create_domain(conn, name, *args, disk_path=...)``
+    defines the domain on it. The overlay is deleted again if that fails.
+
+    :return: The result of ``create_domain`` with the overlay path as ``disk``.
+    """
+    volume = create_overlay(conn, name, template)
+    disk_path = volume.path()
+    try:
+        result = create_domain(conn, name, *args, disk_path=disk_path)
+    except Exception:
+        try:
+            volume.delete(0)
+        except libvirt.libvirtError as e:
+            logger.warning(f"Could not delete overlay {disk_path} of failed VM {name}: {e}")
+        raise
+    return {**result, "disk": disk_path, "template": template["name"]}
+
+
+def instantiate_many(
+    names: List[str],
+    template: Dict[str, Any],
+    create_domain: Callable[..., Dict[str, Any]],
+    *args: Any,
+    parallelism: int = BATCH_PARALLELISM,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Create many VMs from a template as background jobs, ``parallelism`` at a time.
+
+    :return: An iterator of ``run_batch`` results whose ``result`` is the ``instantiate`` report.
+    """
+    return run_batch(names, "instantiate", instantiate, template, create_domain, *args, parallelism=parallelism)
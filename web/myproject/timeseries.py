@@ -0,0 +1,411 @@
+import fcntl
+import logging
+import math
+import os
+import shutil
+import struct
+import threading
+import time
+from array import array
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from .telemetry import FIELDS
+
+logger = logging.getLogger(__name__)
+
+TIMESERIES_DIR = os.getenv(
+    "TIMESERIES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "timeseries")
+)
+# Seconds between writes of buffered records to disk.
+TIMESERIES_FLUSH_INTERVAL = float(os.getenv("TIMESERIES_FLUSH_INTERVAL", "60"))
+# Points a range query returns at most before it moves to a coarser tier.
+TIMESERIES_MAX_POINTS = int(os.getenv("TIMESERIES_MAX_POINTS", "2000"))
+
+DAY = 86400
+
+
+class Tier:
+    """
+    One resolution of the store: records ``step`` seconds apart, kept for ``retention``
+    seconds in segment directories that each cover ``segment`` seconds.
+    """
+
+    __slots__ = ("name", "step", "retention", "segment")
+
+    def __init__(self, name: str, step: int, retention: int, segment: int):
+        self.name = name
+        self.step = step
+        self.retention = retention
+        self.segment = segment
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "step": self.step, "retention": self.retention, "segment": self.segment}
+
+
+TIERS = (
+    Tier("10s", 10, int(float(os.getenv("TIMESERIES_RETENTION_10S", "1")) * DAY), 6 * 3600),
+    Tier("1m", 60, int(float(os.getenv("TIMESERIES_RETENTION_1M", "7")) * DAY), DAY),
+    Tier("1h", 3600, int(float(os.getenv("TIMESERIES_RETENTION_1H", "30")) * DAY), 7 * DAY),
+)
+
+# A record is the bucket start as seconds since the epoch followed by the mean of each field.
+RECORD = struct.Struct("<I" + "f" * len(FIELDS))
+
+
+class Bucket:
+    """
+    The running per-field sums of one tier interval that is still being filled.
+
+    NaN values are left out, so a field missing from some samples averages over the rest.
+    """
+
+    __slots__ = ("start", "sums", "counts")
+
+    def __init__(self, start: int):
+        self.start = start
+        self.sums = array("d", bytes(8 * len(FIELDS)))
+        self.counts = array("I", bytes(4 * len(FIELDS)))
+
+    def add(self, values: Tuple[float, ...]) -> None:
+        for index, value in enumerate(values):
+            if not math.isnan(value):
+                self.sums[index] += value
+                self.counts[index] += 1
+
+    def means(self) -> Tuple[float, ...]:
+        return tuple(
+            total / count if count else math.nan for total, count in zip(self.sums, self.counts)
+        )
+
+
+class Series:
+    """
+    The in-memory state of one VM: an open bucket per tier and, per tier, the closed
+    records not yet written, held column-wise in arrays.
+    """
+
+    __slots__ = ("buckets", "closed", "times", "values")
+
+    def __init__(self):
+        self.buckets: List[Optional[Bucket]] = [None] * len(TIERS)
+        # Start of the last closed bucket per tier
+        self.closed: List[int] = [-1] * len(TIERS)
+        self.times = [array("I") for _ in TIERS]
+        self.values = [array("f") for _ in TIERS]
+
+
+class TimeSeriesStore:
+    """
+    An embedded, append-only store of VM telemetry at several resolutions.
+
+    Samples are averaged into 10 second records, which are averaged into 1 minute records,
+    which are averaged into 1 hour records. Closed records are buffered in memory and
+    appended every ``flush_interval`` seconds to one file per VM, tier and segment of
+    fixed-size records, so a range read can binary search a file by time. Old data is
+    removed a whole segment directory at a time once it falls out of its tier's retention,
+    which bounds disk use by the number of VMs alone.
+
+    Only one process may write a directory. The first flush takes an exclusive lock on it;
+    a process that does not get the lock drops its records instead of interleaving them
+    with the writer's, which would break the time order reads rely on.
+    """
+
+    def __init__(self, directory: str = TIMESERIES_DIR, flush_interval: float = TIMESERIES_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        # Held while writing files, so flushes and retention never run concurrently.
+        self._write_lock = threading.Lock()
+        self._series: Dict[str, Series] = {}
+        self._next_flush = time.time() + flush_interval
+        self._writer_lock: Optional[Any] = None
+
+    def record_samples(self, samples: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Add the newest telemetry sample of each VM. Used as a telemetry sampler listener.
+
+        :param samples: ``{name: sample}`` with a ``time`` and a value or None per field.
+        """
+        for name, sample in samples.items():
+            values = tuple(math.nan if sample.get(field) is None else sample[field] for field in FIELDS)
+            self.record(name, sample["time"], values)
+        if time.time() >= self._next_flush:
+            self.flush()
+
+    def record(self, name: str, timestamp: float, values: Tuple[float, ...]) -> None:
+        """
+        Add one sample of a VM.
+
+        :param name: The VM.
+        :param timestamp: Seconds since the epoch.
+        :param values: One value per field of ``FIELDS``, NaN where unknown.
+        """
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = Series()
+            self._add(series, 0, int(timestamp), values)
+
+    def _add(self, series: Series, level: int, timestamp: int, values: Tuple[float, ...]) -> None:
+        tier = TIERS[level]
+        start = timestamp - timestamp % tier.step
+        if start <= series.closed[level]:
+            # A sample for a closed interval would break the append-only time order.
+            return
+        bucket = series.buckets[level]
+        if bucket is not None and bucket.start != start:
+            if start < bucket.start:
+                return
+            self._close(series, level)
+            bucket = None
+        if bucket is None:
+            bucket = series.buckets[level] = Bucket(start)
+        bucket.add(values)
+
+    def _close(self, series: Series, level: int) -> None:
+        bucket = series.buckets[level]
+        series.buckets[level] = None
+        series.closed[level] = bucket.start
+        means = bucket.means()
+        series.times[level].append(bucket.start)
+        series.values[level].extend(means)
+        if level + 1 < len(TIERS):
+            self._add(series, level + 1, bucket.start, means)
+
+    def _path(self, tier: Tier, segment: int, name: str) -> str:
+        return os.path.join(self.directory, tier.name, str(segment), quote(name, safe="") + ".bin")
+
+    def flush(self, now: Optional[float] = None) -> int:
+        """
+        Write the buffered records to disk and apply retention.
+
+        Open buckets whose interval ended a full step ago are closed first, so VMs that
+        stopped reporting do not keep state in memory.
+
+        :return: The number of records written.
+        """
+        now = now or time.time()
+        with self._write_lock:
+            with self._lock:
+                self._next_flush = now + self.flush_interval
+                pending = []
+                for name, series in list(self._series.items()):
+                    for level, tier in enumerate(TIERS):
+                        bucket = series.buckets[level]
+                        if bucket is not None and bucket.start + 2 * tier.step <= now:
+                            self._close(series, level)
+                    for level in range(len(TIERS)):
+                        if series.times[level]:
+                            pending.append((name, level, series.times[level], series.values[level]))
+                            series.times[level], series.values[level] = array("I"), array("f")
+                    if not any(series.buckets):
+                        del self._series[name]
+
+            if not self._is_writer():
+                return 0
+            written = 0
+            for name, level, times, values in pending:
+                written += self._append(TIERS[level], name, times, values)
+            self._expire(now)
+        return written
+
+    def _is_writer(self) -> bool:
+        if self._writer_lock is not None:
+            return True
+        path = os.path.join(self.directory, ".writer.lock")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            file = open(path, "a")
+        except OSError as e:
+            logger.error(f"Cannot open {path}: {e}")
+            return False
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            logger.warning(f"Another process writes {self.directory}; dropping this process's records")
+            return False
+        self._writer_lock = file
+        return True
+
+    def _last_timestamp(self, path: str) -> int:
+        try:
+            with open(path, "rb") as file:
+                count = os.fstat(file.fileno()).st_size // RECORD.size
+                if not count:
+                    return -1
+                file.seek((count - 1) * RECORD.size)
+                return struct.unpack("<I", file.read(4))[0]
+        except FileNotFoundError:
+            return -1
+
+    def _append(self, tier: Tier, name: str, times: array, values: array) -> int:
+        segments: Dict[int, bytearray] = {}
+        last: Dict[int, int] = {}
+        written = 0
+        for index, timestamp in enumerate(times):
+            segment = timestamp - timestamp % tier.segment
+            if segment not in last:
+                last[segment] = self._last_timestamp(self._path(tier, segment, name))
+            if timestamp <= last[segment]:
+                # Already on disk, e.g. from a writer that ran before this one took over.
+                continue
+            record = RECORD.pack(timestamp, *values[index * len(FIELDS) : (index + 1) * len(FIELDS)])
+            segments.setdefault(segment, bytearray()).extend(record)
+            written += 1
+        for segment, data in segments.items():
+            path = self._path(tier, segment, name)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "ab") as file:
+                    file.write(data)
+            except OSError as e:
+                logger.error(f"Could not write {tier.name} metrics of {name}: {e}")
+        return written
+
+    def _expire(self, now: float) -> None:
+        for tier in TIERS:
+            root = os.path.join(self.directory, tier.name)
+            try:
+                segments = os.listdir(root)
+            except FileNotFoundError:
+                continue
+            for segment in segments:
+                if segment.isdigit() and int(segment) + tier.segment < now - tier.retention:
+                    shutil.rmtree(os.path.join(root, segment), ignore_errors=True)
+
+    def choose_tier(self, start: float, end: float, now: Optional[float] = None) -> Tier:
+        """
+        Pick the finest tier that still holds ``start`` and answers within the point limit.
+        """
+        age = (now or time.time()) - start
+        for tier in TIERS:
+            if age <= tier.retention and (end - start) / tier.step <= TIMESERIES_MAX_POINTS:
+                return tier
+        return TIERS[-1]
+
+    def _read_file(self, path: str, start: float, end: float) -> Iterator[Tuple[Any, ...]]:
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            count = os.fstat(file.fileno()).st_size // RECORD.size
+
+            def timestamp_at(index):
+                file.seek(index * RECORD.size)
+                return struct.unpack("<I", file.read(4))[0]
+
+            # Records are appended in time order, so the first one in range can be bisected.
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if timestamp_at(middle) < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            file.seek(low * RECORD.size)
+            data = file.read((count - low) * RECORD.size)
+        for record in RECORD.iter_unpack(data):
+            if record[0] > end:
+                break
+            yield record
+
+    def query(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        tier: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Read the records of a VM between two times, including those not yet written.
+
+        :param name: The VM.
+        :param start: Seconds since the epoch, inclusive. Times before the tier's retention
+            are not searched.
+        :param end: Seconds since the epoch, inclusive.
+        :param tier: The tier name; chosen with ``choose_tier`` when not given.
+        :param fields: The fields to return. Defaults to all of ``FIELDS``.
+        :return: ``{"tier", "step", "times": [...], "fields": {field: [...]}}`` with one
+            entry per record, None where a value is unknown.
+        :raises ValueError: If the tier or a field is unknown.
+        """
+        if tier is None:
+            selected = self.choose_tier(start, end)
+        else:
+            selected = next((candidate for candidate in TIERS if candidate.name == tier), None)
+            if selected is None:
+                raise ValueError(f"Unknown tier {tier!r}, expected one of {[t.name for t in TIERS]}")
+        fields = fields or list(FIELDS)
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields {unknown}, expected some of {list(FIELDS)}")
+        level = TIERS.index(selected)
+        now = time.time()
+        start = max(start, now - selected.retention - selected.segment)
+        end = min(end, now)
+
+        with self._lock:
+            series = self._series.get(name)
+            buffered_times = array("I", series.times[level]) if series else array("I")
+            buffered_values = array("f", series.values[level]) if series else array("f")
+
+        records: List[Tuple[Any, ...]] = []
+        segment = int(start) - int(start) % selected.segment
+        while segment <= end:
+            records.extend(self._read_file(self._path(selected, segment, name), start, end))
+            segment += selected.segment
+        for index, timestamp in enumerate(buffered_times):
+            if start <= timestamp <= end and (not records or timestamp > records[-1][0]):
+                records.append(
+                    (timestamp, *buffered_values[index * len(FIELDS) : (index + 1) * len(FIELDS)])
+                )
+
+        columns = {field: [] for field in fields}
+        indexes = [FIELDS.index(field) + 1 for field in fields]
+        for record in records:
+            for field, index in zip(fields, indexes):
+                value = record[index]
+                columns[field].append(None if math.isnan(value) else round(value, 3))
+        return {
+            "tier": selected.name,
+            "step": selected.step,
+            "times": [record[0] for record in records],
+            "fields": columns,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Describe the tiers and how much memory and disk the store uses.
+        """
+        with self._lock:
+            series = len(self._series)
+            buffered = sum(len(times) for entry in self._series.values() for times in entry.times)
+        tiers = []
+        for tier in TIERS:
+            files = size = 0
+            for root, _, names in os.walk(os.path.join(self.directory, tier.name)):
+                for file_name in names:
+                    files += 1
+                    size += os.path.getsize(os.path.join(root, file_name))
+            tiers.append(dict(tier.as_dict(), files=files, bytes=size))
+        return {"directory": self.directory, "series": series, "buffered_records": buffered, "tiers": tiers}
+
+
+_store: Optional[TimeSeriesStore] = None
+_store_lock = threading.Lock()
+
+
+def get_timeseries_store() -> TimeSeriesStore:
+    """
+    Get the process-wide time-series store.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TimeSeriesStore()
+        return _store
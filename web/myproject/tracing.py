@@ -0,0 +1,345 @@
+"""
+Per-request timing spans for libvirt calls.
+
+A trace is started for each HTTP request (or agent command) and every libvirt call made
+through a traced connection, including calls on the domains and snapshots it returns, is
+recorded as a span. Finished traces become a ``Server-Timing`` header, a log line when they
+exceed ``SLOW_REQUEST_THRESHOLD``, and optionally OTLP/JSON records written to a file or
+posted to an OpenTelemetry collector.
+
+The module only depends on the standard library and libvirt so it can be imported by the
+Flask package and by the standalone agent alike. Connection pools pick it up through
+``pool.set_instrumentation``.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import libvirt
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1").lower() in ("1", "true", "yes")
+# Requests slower than this many seconds are logged with their span breakdown.
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", "1.0"))
+# Append finished traces as OTLP/JSON lines to this file.
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+# Post finished traces as OTLP/JSON to this collector endpoint, e.g. http://localhost:4318/v1/traces.
+TRACE_EXPORT_URL = os.getenv("TRACE_EXPORT_URL")
+# Share of traces exported; slow traces are always exported.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "qemu_web")
+# Distinct span names listed in a Server-Timing header; the slowest are kept.
+SERVER_TIMING_ENTRIES = 20
+
+# Methods answered from the Python object without an RPC; they are not worth a span.
+_LOCAL_METHODS = {"name", "ID", "UUID", "UUIDString", "getName", "connect", "domain", "getConnect", "getDomain"}
+_TRACED_TYPES = (
+    libvirt.virConnect,
+    libvirt.virDomain,
+    libvirt.virDomainSnapshot,
+    libvirt.virNetwork,
+    libvirt.virStoragePool,
+    libvirt.virStorageVol,
+)
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "kind", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], kind: int, attributes: Dict[str, Any]):
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """
+        Seconds the span took, or has taken so far.
+        """
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+
+class Trace:
+    """
+    The spans of one request. A trace belongs to the thread that handles the request.
+    """
+
+    def __init__(self, name: str, attributes: Optional[Dict[str, Any]] = None):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, None, SPAN_KIND_SERVER, attributes or {})
+        self.spans: List[Span] = [self.root]
+        self._stack: List[Span] = [self.root]
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes: Any) -> Iterator[Span]:
+        span = Span(name, self._stack[-1].span_id, kind, attributes)
+        self.spans.append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e) or type(e).__name__
+            raise
+        finally:
+            span.end = time.time_ns()
+            self._stack.pop()
+
+    def finish(self) -> "Trace":
+        if self.root.end is None:
+            self.root.end = time.time_ns()
+        return self
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        """
+        Total time and count per span name, slowest first, not counting the root span.
+        """
+        totals: Dict[str, List[float]] = {}
+        for span in self.spans[1:]:
+            entry = totals.setdefault(span.name, [0.0, 0])
+            entry[0] += span.duration
+            entry[1] += 1
+        return [
+            {"name": name, "seconds": round(seconds, 6), "count": count}
+            for name, (seconds, count) in sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
+        ]
+
+    def server_timing(self) -> str:
+        """
+        Render the breakdown as a ``Server-Timing`` header value, with the whole request as ``total``.
+        """
+        entries = []
+        for entry in self.breakdown()[:SERVER_TIMING_ENTRIES]:
+            metric = "".join(char if char.isalnum() or char in "-_" else "-" for char in entry["name"])
+            entries.append(f'{metric};dur={entry["seconds"] * 1000:.2f};desc="{entry["count"]} calls"')
+        entries.append(f"total;dur={self.root.duration * 1000:.2f}")
+        return ", ".join(entries)
+
+    def as_otlp(self, service_name: str = TRACE_SERVICE_NAME) -> Dict[str, Any]:
+        """
+        The trace as an OTLP/JSON ``ExportTraceServiceRequest``.
+        """
+
+        def attributes(values):
+            return [{"key": key, "value": {"stringValue": str(value)}} for key, value in values.items()]
+
+        spans = []
+        for span in self.spans:
+            otlp = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": span.kind,
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end or span.start),
+                "attributes": attributes(span.attributes),
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                otlp["parentSpanId"] = span.parent_id
+            spans.append(otlp)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": attributes({"service.name": service_name})},
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+                }
+            ]
+        }
+
+
+_current: "contextvars.ContextVar[Optional[Trace]]" = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+def start_trace(name: str, **attributes: Any) -> Optional[Trace]:
+    """
+    Start a trace for the current thread, replacing any trace left behind.
+
+    :return: The trace, or None if tracing is disabled.
+    """
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(name, attributes)
+    _current.set(trace)
+    return trace
+
+
+def end_trace() -> Optional[Trace]:
+    """
+    Finish the current thread's trace, log it if slow and hand it to the exporter.
+
+    :return: The finished trace, or None if there was none.
+    """
+    trace = _current.get()
+    if trace is None:
+        return None
+    _current.set(None)
+    trace.finish()
+    slow = trace.root.duration >= SLOW_REQUEST_THRESHOLD
+    if slow:
+        spans = ", ".join(f'{entry["name"]}={entry["seconds"] * 1000:.1f}ms x{entry["count"]}' for entry in trace.breakdown())
+        logger.warning(f"Slow request {trace.root.name} took {trace.root.duration * 1000:.1f}ms: {spans or 'no libvirt calls'}")
+    if exporter is not None and (slow or random.random() < TRACE_SAMPLE_RATE):
+        exporter.export(trace)
+    return trace
+
+
+@contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Optional[Trace]]:
+    """
+    Trace the body of a ``with`` block as one request.
+    """
+    started = start_trace(name, **attributes)
+    try:
+        yield started
+    except Exception as e:
+        if started is not None:
+            started.root.error = str(e) or type(e).__name__
+        raise
+    finally:
+        if started is not None:
+            end_trace()
+
+
+@contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Record the body of a ``with`` block as a span of the current trace, if there is one.
+    """
+    current = _current.get()
+    if current is None:
+        yield None
+        return
+    with current.span(name, kind, **attributes) as recorded:
+        yield recorded
+
+
+class TracedLibvirt:
+    """
+    Wraps a libvirt object and records a span for every RPC made through it.
+
+    Libvirt objects returned by the wrapped calls are wrapped too. Attribute reads such as
+    ``_o`` pass through, so a wrapped object can be handed back to libvirt calls.
+    """
+
+    __slots__ = ("_target",)
+
+    def __init__(self, target: Any):
+        self._target = target
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._target, attr)
+        if attr.startswith("_") or attr in _LOCAL_METHODS or not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            current = _current.get()
+            if current is None:
+                return wrap(value(*args, **kwargs))
+            attributes = {}
+            if isinstance(self._target, libvirt.virDomain):
+                attributes["domain"] = self._target.name()
+            with current.span(f"libvirt.{attr}", SPAN_KIND_CLIENT, **attributes):
+                return wrap(value(*args, **kwargs))
+
+        return call
+
+    def __repr__(self) -> str:
+        return f"TracedLibvirt({self._target!r})"
+
+
+def wrap(value: Any) -> Any:
+    """
+    Wrap libvirt objects, including those inside lists and ``getAllDomainStats`` tuples.
+    Anything else is returned as is.
+    """
+    if not TRACING_ENABLED:
+        return value
+    if isinstance(value, _TRACED_TYPES):
+        return TracedLibvirt(value)
+    if isinstance(value, list):
+        return [wrap(item) for item in value]
+    if isinstance(value, tuple) and value and isinstance(value[0], _TRACED_TYPES):
+        return (TracedLibvirt(value[0]),) + value[1:]
+    return value
+
+
+def unwrap(value: Any) -> Any:
+    return value._target if isinstance(value, TracedLibvirt) else value
+
+
+class SpanExporter:
+    """
+    Writes finished traces as OTLP/JSON on a background thread.
+
+    Each trace is appended as one line to ``path`` and/or posted to ``url``. When the queue
+    is full traces are dropped, so exporting never slows a request down.
+    """
+
+    def __init__(self, path: Optional[str] = None, url: Optional[str] = None, capacity: int = 1000):
+        self.path = path
+        self.url = url
+        self.dropped = 0
+        self._queue: "queue.Queue[Trace]" = queue.Queue(capacity)
+        self._lock = threading.Lock()
+        # Process that runs the exporter thread: threads do not survive uWSGI's fork
+        self._pid: Optional[int] = None
+
+    def export(self, finished: Trace) -> None:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            finished = self._queue.get()
+            try:
+                self._write(json.dumps(finished.as_otlp()))
+            except Exception as e:
+                # A single bad trace or endpoint must not stop the exporter for good
+                logger.error(f"Could not export trace: {e}")
+
+    def _write(self, payload: str) -> None:
+        if self.path:
+            try:
+                with open(self.path, "a") as file:
+                    file.write(payload + "\n")
+            except OSError as e:
+                logger.error(f"Could not write trace to {self.path}: {e}")
+        if self.url:
+            request = urllib.request.Request(
+                self.url, data=payload.encode(), headers={"Content-Type": "application/json"}
+            )
+            try:
+                urllib.request.urlopen(request, timeout=5).close()
+            except OSError as e:
+                logger.error(f"Could not post trace to {self.url}: {e}")
+
+exporter = SpanExporter(TRACE_EXPORT_FILE, TRACE_EXPORT_URL) if TRACING_ENABLED and (TRACE_EXPORT_FILE or TRACE_EXPORT_URL) else None
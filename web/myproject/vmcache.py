@@ -0,0 +1,336 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import libvirt
+
+from .inventory import collect_vms, vm_summary
+from .pool import DEFAULT_URI, get_pool, start_event_loop
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how old cached data may get, even when no event says it changed.
+MAX_AGE = float(os.getenv("INVENTORY_MAX_AGE", "30"))
+# Seconds to wait before retrying a failed event connection.
+RECONNECT_DELAY = float(os.getenv("INVENTORY_RECONNECT_DELAY", "5"))
+
+# Lifecycle events after which the domain XML may differ from what was last parsed.
+_CONFIG_LIFECYCLE_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED,
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED,
+    libvirt.VIR_DOMAIN_EVENT_STARTED,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED,
+}
+
+_DOMAIN_EVENTS = (
+    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+    libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+    libvirt.VIR_DOMAIN_EVENT_ID_DISK_CHANGE,
+    libvirt.VIR_DOMAIN_EVENT_ID_TRAY_CHANGE,
+)
+# Events other than lifecycle ones after which the domain XML may have changed.
+_CONFIG_EVENTS = {
+    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+    libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+    libvirt.VIR_DOMAIN_EVENT_ID_DISK_CHANGE,
+    libvirt.VIR_DOMAIN_EVENT_ID_TRAY_CHANGE,
+}
+
+
+class InventoryCache:
+    """
+    In-process copy of the VM inventory of one libvirt URI.
+
+    The listing is loaded once and then kept current by domain lifecycle, reboot, device
+    and media change events delivered on the libvirt event loop thread. Per-domain views
+    such as the detail page or the snapshot list are loaded on first use and dropped
+    whenever an event arrives for that domain. Nothing is served older than ``max_age`` seconds, and
+    everything is reloaded live while the event connection is down.
+    """
+
+    def __init__(self, uri: str = DEFAULT_URI, max_age: float = MAX_AGE):
+        self.uri = uri
+        self.max_age = max_age
+        self.generation = 0
+
+        self._lock = threading.RLock()
+        self._event_conn: Optional[libvirt.virConnect] = None
+        self._retry_at = 0.0
+        self._callback_ids: List[int] = []
+        self._vms: Dict[str, Dict[str, Any]] = {}
+        self._names: Dict[str, str] = {}
+        self._loaded_at = 0.0
+        # (kind, name) -> (loaded at, version, view); every load gets a new version
+        self._views: Dict[Tuple[str, str], Tuple[float, int, Any]] = {}
+        self._view_version = 0
+        self._config_epoch = 0
+        self._config_generations: Dict[str, int] = {}
+        self._listeners: List[Callable[[Dict[str, Optional[Dict[str, Any]]]], None]] = []
+
+    # Event connection
+
+    def start(self) -> None:
+        """
+        Open the event connection, subscribe to domain events and load the inventory.
+
+        Failures are logged; the cache then keeps serving live data until a later call
+        manages to connect.
+        """
+        start_event_loop()
+        with self._lock:
+            if self._event_conn is not None:
+                return
+            try:
+                conn = libvirt.open(self.uri)
+                conn.registerCloseCallback(self._on_close, None)
+                self._callback_ids = [
+                    conn.domainEventRegisterAny(None, event_id, self._on_domain_event, event_id)
+                    for event_id in _DOMAIN_EVENTS
+                ]
+            except libvirt.libvirtError as e:
+                logger.warning(f"Inventory events unavailable for {self.uri}: {e}")
+                self._retry_at = time.monotonic() + RECONNECT_DELAY
+                return
+            self._event_conn = conn
+            # Events may have been missed while disconnected, so no parsed XML can be trusted.
+            self._config_epoch += 1
+            self._config_generations = {}
+        self.refresh()
+
+    def stop(self) -> None:
+        """
+        Unsubscribe from domain events and close the event connection.
+        """
+        with self._lock:
+            conn, self._event_conn = self._event_conn, None
+            callback_ids, self._callback_ids = self._callback_ids, []
+        if conn is None:
+            return
+        for callback_id in callback_ids:
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        try:
+            conn.unregisterCloseCallback()
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    @property
+    def connected(self) -> bool:
+        return self._event_conn is not None
+
+    def _on_close(self, conn: libvirt.virConnect, reason: int, opaque: Any) -> None:
+        logger.warning(f"Inventory event connection to {self.uri} closed (reason {reason})")
+        with self._lock:
+            if self._event_conn is conn:
+                self._event_conn = None
+                self._callback_ids = []
+
+    def _on_domain_event(self, conn: libvirt.virConnect, domain: libvirt.virDomain, *args: Any) -> None:
+        # Every callback signature ends with the opaque value, which holds the event ID.
+        event_id = args[-1]
+        lifecycle = args[0] if event_id == libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE else None
+        removed = lifecycle == libvirt.VIR_DOMAIN_EVENT_UNDEFINED
+        config_changed = lifecycle in _CONFIG_LIFECYCLE_EVENTS or event_id in _CONFIG_EVENTS
+        summary = None
+        if not removed:
+            try:
+                summary = vm_summary(domain)
+            except libvirt.libvirtError as e:
+                # A transient domain is gone once it stops, without an UNDEFINED event.
+                removed = e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN
+                logger.debug(f"Could not refresh {domain.name()} after event {event_id}: {e}")
+        with self._lock:
+            self._drop(domain.name())
+            if config_changed:
+                self._config_generations[domain.name()] = self._config_generations.get(domain.name(), 0) + 1
+            if summary is not None:
+                self._store(summary)
+            elif not removed:
+                # Force a full reload on the next read rather than serve a stale entry.
+                self._loaded_at = 0.0
+            self.generation += 1
+        if summary is not None or removed:
+            self._notify({domain.name(): summary})
+
+    # Cache state
+
+    def _store(self, vm: Dict[str, Any]) -> None:
+        self._vms[vm["uuid"]] = vm
+        self._names[vm["name"]] = vm["uuid"]
+
+    def _drop(self, name: str) -> None:
+        uuid = self._names.pop(name, None)
+        if uuid is not None:
+            self._vms.pop(uuid, None)
+        for key in [key for key in self._views if key[1] == name]:
+            del self._views[key]
+
+    def _is_fresh(self, loaded_at: float) -> bool:
+        return self.connected and time.monotonic() - loaded_at < self.max_age
+
+    def _ensure_connected(self) -> None:
+        if not self.connected and time.monotonic() >= self._retry_at:
+            self.start()
+
+    def refresh(self) -> List[Dict[str, Any]]:
+        """
+        Reload the whole inventory from libvirt and drop every cached per-domain view.
+
+        :return: The reloaded VM listing.
+        :raises libvirt.libvirtError: If the listing could not be fetched.
+        :raises TimeoutError: If no pooled connection was free.
+        """
+        with get_pool(self.uri).connection() as conn:
+            vms = collect_vms(conn)
+        with self._lock:
+            previous = {vm["name"]: vm for vm in self._vms.values()}
+            self._vms = {}
+            self._names = {}
+            for vm in vms:
+                self._store(vm)
+            self._views = {}
+            self._loaded_at = time.monotonic()
+            self.generation += 1
+        changes: Dict[str, Optional[Dict[str, Any]]] = {
+            vm["name"]: vm for vm in vms if previous.pop(vm["name"], None) != vm
+        }
+        changes.update(dict.fromkeys(previous))
+        if changes:
+            self._notify(changes)
+        return vms
+
+    def add_listener(self, listener: Callable[[Dict[str, Optional[Dict[str, Any]]]], None]) -> None:
+        """
+        Register a callback for inventory changes.
+
+        The callback receives a mapping of domain name to its new VM dictionary, or ``None``
+        for domains that were removed. It runs on the thread that observed the change, which
+        is usually the libvirt event loop thread, so it must not block.
+
+        :param listener: The callback to register.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def _notify(self, changes: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                logger.error(f"Inventory listener {listener!r} failed: {e}")
+
+    def config_generation(self, name: str) -> Optional[Tuple[int, int]]:
+        """
+        Return a token that changes whenever the XML description of a domain may have changed.
+
+        :param name: The domain name.
+        :return: The configuration generation, or None while events are not being received.
+        """
+        with self._lock:
+            if not self.connected:
+                return None
+            return self._config_epoch, self._config_generations.get(name, 0)
+
+    def invalidate(self, name: str) -> None:
+        """
+        Drop the cached per-domain views of a domain after changing it through this process.
+
+        :param name: The domain name.
+        """
+        with self._lock:
+            for key in [key for key in self._views if key[1] == name]:
+                del self._views[key]
+            self.generation += 1
+
+    # Reads
+
+    def list_vms(self, refresh: bool = False) -> List[Dict[str, Any]]:
+        """
+        Return the VM listing, served from memory while the cache is fresh.
+
+        :param refresh: Reload from libvirt regardless of freshness.
+        :return: A list of VM dictionaries as served by ``GET /api/vms``.
+        """
+        self._ensure_connected()
+        with self._lock:
+            if not refresh and self._is_fresh(self._loaded_at):
+                return list(self._vms.values())
+        return self.refresh()
+
+    def domain_view(
+        self,
+        kind: str,
+        name: str,
+        loader: Callable[[libvirt.virConnect, str], Any],
+        refresh: bool = False,
+    ) -> Any:
+        """
+        Return a per-domain view, loading it with ``loader`` when missing or stale.
+
+        :param kind: The kind of view, e.g. ``"details"`` or ``"snapshots"``.
+        :param name: The domain name.
+        :param loader: Called as ``loader(conn, name)`` to build the view from libvirt.
+        :param refresh: Reload from libvirt regardless of freshness.
+        :return: The cached or freshly loaded view.
+        """
+        return self.versioned_domain_view(kind, name, loader, refresh)[1]
+
+    def versioned_domain_view(
+        self,
+        kind: str,
+        name: str,
+        loader: Callable[[libvirt.virConnect, str], Any],
+        refresh: bool = False,
+    ) -> Tuple[int, Any]:
+        """
+        Like ``domain_view``, with a version that changes whenever the view is loaded again,
+        including reloads after ``max_age`` that no event triggered.
+
+        :return: The version and the view.
+        """
+        self._ensure_connected()
+        key = (kind, name)
+        with self._lock:
+            cached = self._views.get(key)
+            generation = self.generation
+            if cached is not None and not refresh and self._is_fresh(cached[0]):
+                return cached[1], cached[2]
+        with get_pool(self.uri).connection() as conn:
+            value = loader(conn, name)
+        with self._lock:
+            self._view_version += 1
+            version = self._view_version
+            # Only keep the result if no event arrived while it was loading.
+            if self.generation == generation:
+                self._views[key] = (time.monotonic(), version, value)
+        return version, value
+
+
+_caches: Dict[str, InventoryCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_inventory_cache(uri: str = DEFAULT_URI) -> InventoryCache:
+    """
+    Get the process-wide inventory cache for a libvirt URI.
+
+    The cache connects and loads the inventory on its first read, so each forked uWSGI
+    worker subscribes to events with its own connection.
+
+    :param uri: The libvirt connection URI.
+    :return: The inventory cache for the URI.
+    """
+    with _caches_lock:
+        cache = _caches.get(uri)
+        if cache is None:
+            cache = _caches[uri] = InventoryCache(uri)
+        return cache